@@ -0,0 +1,234 @@
+"""
+Durable file writes with group commit
+
+A file is first written to a temporary file next to its target, and is only renamed
+to the target once its contents are flushed to disk, so a crash never leaves a torn
+file behind. The rename itself only survives a crash once the directory is flushed.
+
+The writers only write their temporary files. One thread commits all the files written
+in the meantime: it flushes their contents with one syncfs per file system (an fsync
+per file where syncfs is not available), renames them and flushes their directory
+once. A commit waits up to FSYNC_WINDOW milliseconds (or until FSYNC_BATCH_BYTES are
+pending) for concurrent writes to join it. The writers return once their commit is done.
+"""
+import ctypes
+import os
+import threading
+import time
+import uuid
+
+# How long a commit waits for concurrent writes to join it, in milliseconds
+FSYNC_WINDOW = float(os.environ.get('FSYNC_WINDOW', 2))
+# A commit starts right away once this many bytes are waiting for it
+FSYNC_BATCH_BYTES = int(os.environ.get('FSYNC_BATCH_BYTES', 4 * 1024 * 1024))
+
+TEMP_SUFFIX = '.tmp'
+
+
+def _load_syncfs():
+    # syncfs(2) flushes a whole file system with one call, it only exists on Linux
+    try:
+        syncfs = ctypes.CDLL(None, use_errno=True).syncfs
+    except (OSError, AttributeError):
+        return None
+
+    def _syncfs(fd):
+        if syncfs(fd) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    return _syncfs
+
+
+_syncfs = _load_syncfs()
+
+
+class _PendingWrite:
+
+    def __init__(self, temp_path, path, file, size):
+        self.temp_path = temp_path
+        self.path = path
+        # The open temporary file, until its contents are flushed
+        self.file = file
+        self.size = size
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommitter:
+    """
+    Writes files atomically and durably, flushing them to disk in batches.
+    """
+
+    def __init__(self, window=FSYNC_WINDOW, batch_bytes=FSYNC_BATCH_BYTES):
+        """
+        :param window: How long a commit waits for concurrent writes, in milliseconds
+        :param batch_bytes: The number of pending bytes that starts a commit right away
+        """
+        self._window = window / 1000
+        self._batch_bytes = batch_bytes
+        self._cond = threading.Condition()
+        # The written files waiting for the next commit
+        self._pending = []
+        self._pending_bytes = 0
+        # The number of writes that are still writing their temporary file
+        self._writing = 0
+        self._thread = None
+        # The number of commits so far
+        self.commits = 0
+
+    def write(self, path, data):
+        """
+        Write a file and return once it is on disk. The file is either written
+        completely or not at all, an existing file is replaced.
+
+        :param path: The path of the file
+        :param data: A bytes-like object with the file contents, or a list of them
+        :raises OSError: If the file could not be written
+        """
+        with self._cond:
+            self._writing += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+                self._thread.start()
+
+        write = None
+        try:
+            directory, name = os.path.split(path)
+            temp_path = os.path.join(directory, '.%s.%s%s' % (name, uuid.uuid4().hex[:8], TEMP_SUFFIX))
+            f = os.fdopen(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666), 'wb')
+            try:
+                for part in (data if isinstance(data, list) else [data]):
+                    f.write(part)
+                # Hand the contents to the OS, the commit flushes them to disk
+                f.flush()
+            except BaseException:
+                f.close()
+                os.remove(temp_path)
+                raise
+            write = _PendingWrite(temp_path, path, f, f.tell())
+        finally:
+            with self._cond:
+                self._writing -= 1
+                if write is not None:
+                    self._pending.append(write)
+                    self._pending_bytes += write.size
+                self._cond.notify_all()
+
+        write.done.wait()
+        if write.error is not None:
+            raise write.error
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+
+                # Let the writes that are in progress join this commit,
+                # unless enough data is waiting already
+                deadline = time.monotonic() + self._window
+                while self._writing and self._pending_bytes < self._batch_bytes:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+                batch, self._pending = self._pending, []
+                self._pending_bytes = 0
+
+            try:
+                self._commit(batch)
+            except BaseException as e:
+                # Fail the writes of this batch, but keep committing the later ones
+                _abort(batch, e)
+            finally:
+                for write in batch:
+                    write.done.set()
+            self.commits += 1
+
+    @staticmethod
+    def _commit(batch):
+        # Flush the contents of all files, then move them into place
+        try:
+            _sync_files(batch)
+        finally:
+            for write in batch:
+                try:
+                    write.file.close()
+                except OSError as e:
+                    write.error = write.error or e
+
+        directories = {}
+        for write in batch:
+            try:
+                if write.error is not None:
+                    raise write.error
+                os.replace(write.temp_path, write.path)
+                directories.setdefault(os.path.dirname(os.path.abspath(write.path)), []).append(write)
+            except OSError as e:
+                write.error = e
+                try:
+                    os.remove(write.temp_path)
+                except OSError:
+                    pass
+
+        # Flush the renames, once per directory for the whole batch
+        for directory, writes in directories.items():
+            try:
+                fd = os.open(directory, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError as e:
+                for write in writes:
+                    write.error = e
+
+
+def _abort(batch, error):
+    # Fail the writes of a batch whose commit was interrupted, and remove their temporary files
+    for write in batch:
+        if write.error is None:
+            write.error = error
+        for cleanup in (write.file.close, lambda: os.remove(write.temp_path)):
+            try:
+                cleanup()
+            except OSError:
+                pass
+
+
+def _sync_files(batch):
+    # Flush the contents of the written files to disk, with one syncfs per file
+    # system if possible. A failure fails every write it covers.
+    if _syncfs is None:
+        for write in batch:
+            try:
+                os.fsync(write.file.fileno())
+            except OSError as e:
+                write.error = e
+        return
+
+    by_device = {}
+    for write in batch:
+        try:
+            by_device.setdefault(os.fstat(write.file.fileno()).st_dev, []).append(write)
+        except OSError as e:
+            write.error = e
+    for writes in by_device.values():
+        try:
+            _syncfs(writes[0].file.fileno())
+        except OSError as e:
+            for write in writes:
+                write.error = e
+
+
+def remove_temp_files(folder):
+    """
+    Remove the temporary files of writes that were interrupted, e.g. by a crash.
+
+    :param folder: The folder the files are written to
+    """
+    for name in os.listdir(folder):
+        if name.startswith('.') and name.endswith(TEMP_SUFFIX):
+            os.remove(os.path.join(folder, name))
@@ -6,6 +6,7 @@ import zmq
 import messages_pb2
 import utils
 import logging
+from liveness import LivenessMonitor
 from utils import random_string
 
 STORAGE_NODES_NUM = 4
@@ -58,10 +59,11 @@ def store_file(file_data: bytearray, k: int, context: zmq.Context, original_file
     hdfs_send_data_socket = context.socket(zmq.REQ)
     hdfs_send_data_socket.connect('tcp://' + next_node + ':5560')
 
+    # Send the file data without copying it into the message
     hdfs_send_data_socket.send_multipart([
         task.SerializeToString(),
         file_data
-    ])
+    ], copy=False)
 
     resp = hdfs_send_data_socket.recv_string()
     print('Received: %s' % resp)
@@ -89,42 +91,57 @@ def store_file(file_data: bytearray, k: int, context: zmq.Context, original_file
     return storage_details
 
 
-def get_file(storage_details, context: zmq.Context):
+def get_file(replicas, context: zmq.Context, liveness: LivenessMonitor, offset: int = 0, length: int = 0):
     """
     Implements retrieving a file that is stored with RAID 1 using 4 storage nodes.
 
-    :param storage_details: The storage details for a file saved in hdfs method.
+    :param replicas: The replicas of the file, as rows of the fragment table (see metadata.py)
     :param context: A ZMQ Context
-    :return: The original file contents
+    :param liveness: The LivenessMonitor of the storage nodes
+    :param offset: The first byte of the file to retrieve
+    :param length: The number of bytes to retrieve, 0 for the rest of the file
+    :return: The original file contents (or the requested part of it),
+             or None if no node with a replica answered
     """
     # Select one filename
-    filename = storage_details['filename']
-    replica_locations = storage_details['replica_locations']
+    filename = replicas[0]['name']
+    replica_locations = [replica['node_id'] for replica in replicas]
 
     # Request both chunks in parallel
     task = messages_pb2.getdata_request()
     task.filename = filename
+    task.offset = offset
+    task.length = length
 
     # Try the replica locations, one by one, to find an online node.
-    for location in replica_locations:
-
-        if not utils.check_node_online(location, context):
-            continue
+    # Nodes known to be alive are tried first, dead nodes are skipped.
+    for location in liveness.by_liveness(replica_locations):
 
         hdfs_data_req_socket = context.socket(zmq.REQ)
+        hdfs_data_req_socket.setsockopt(zmq.LINGER, 0)
         hdfs_data_req_socket.connect('tcp://' + location + ':5561')
         hdfs_data_req_socket.send(task.SerializeToString())
         print('Trying to get file from: ' + location)
 
-        # Receive file
-        result = hdfs_data_req_socket.recv_multipart()
+        # Receive file, unless the node failed since it was last seen
+        if not hdfs_data_req_socket.poll(REQUEST_TIMEOUT):
+            print("No response from %s" % location)
+            hdfs_data_req_socket.close()
+            continue
+        result = hdfs_data_req_socket.recv_multipart(copy=False)
+        hdfs_data_req_socket.close()
+        # The node only replies with the file name if it does not have the file
+        if len(result) < 2:
+            print("File not found on %s" % location)
+            continue
         # First frame: file name (string)
-        filename_received = result[0].decode('utf-8')
-        # Second frame: data
-        file_data = result[1]
+        filename_received = result[0].bytes.decode('utf-8')
+        # Second frame: data, without copying it out of the message
+        file_data = result[1].buffer
 
         print("Received %s" % filename_received)
 
-        hdfs_data_req_socket.close()
-
         return file_data
+
+    print("No replica of the file is available")
+    return None
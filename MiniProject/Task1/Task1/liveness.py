@@ -0,0 +1,133 @@
+"""
+Liveness of the storage nodes
+
+A background thread of the controller keeps one connection to the status socket
+of every storage node and probes it at a fixed interval. Each node is in one of
+three states:
+
+- alive: it answered the last probe
+- suspect: it missed a probe (or has not answered any yet)
+- dead: it missed DEAD_AFTER probes in a row
+
+The read paths look the state up instead of opening a socket and waiting for
+an answer before every replica attempt.
+"""
+import threading
+import time
+
+import zmq
+
+ALIVE = 'alive'
+SUSPECT = 'suspect'
+DEAD = 'dead'
+
+# Milliseconds between two probes of a node
+PROBE_INTERVAL = 500
+# The number of missed probes in a row after which a node is considered dead
+DEAD_AFTER = 3
+
+
+class LivenessMonitor:
+    """
+    Probes the storage nodes on a background thread and keeps their liveness state.
+    """
+
+    def __init__(self, context: zmq.Context, node_ips, interval=PROBE_INTERVAL, dead_after=DEAD_AFTER):
+        """
+        :param context: A ZMQ Context
+        :param node_ips: The addresses of the storage nodes to monitor
+        :param interval: Milliseconds between two probes of a node
+        :param dead_after: The number of missed probes after which a node is considered dead
+        """
+        self.interval = interval
+        self.dead_after = dead_after
+        # Node IP -> probes missed in a row (dead_after - 1 for nodes that never answered,
+        # so they are suspect until they answer, and dead after one more miss)
+        self._missed = {node_ip: dead_after - 1 for node_ip in node_ips}
+        self._last_seen = {}
+        self._lock = threading.Lock()
+
+        # The sockets are only used by the monitor thread
+        self._sockets = {}
+        for node_ip in node_ips:
+            socket = context.socket(zmq.REQ)
+            # Allow sending the next probe before the previous one was answered,
+            # and drop the late answers to earlier probes
+            socket.setsockopt(zmq.REQ_RELAXED, 1)
+            socket.setsockopt(zmq.REQ_CORRELATE, 1)
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.connect('tcp://' + node_ip + ':6666')
+            self._sockets[socket] = node_ip
+
+        thread = threading.Thread(target=self._run, name="liveness-monitor", daemon=True)
+        thread.start()
+
+    def state(self, node_ip):
+        """
+        :return: ALIVE, SUSPECT or DEAD
+        """
+        with self._lock:
+            missed = self._missed.get(node_ip, self.dead_after - 1)
+        if missed == 0:
+            return ALIVE
+        if missed < self.dead_after:
+            return SUSPECT
+        return DEAD
+
+    def is_online(self, node_ip):
+        """
+        :return: Whether the node is worth trying, i.e. it is not dead
+        """
+        return self.state(node_ip) != DEAD
+
+    def by_liveness(self, node_ips):
+        """
+        Order nodes so that the alive nodes are tried first, then the suspect ones.
+        Dead nodes are left out.
+
+        :param node_ips: The addresses of the nodes, in order of preference
+        :return: The addresses of the nodes that are not dead
+        """
+        states = [(node_ip, self.state(node_ip)) for node_ip in node_ips]
+        return ([node_ip for node_ip, state in states if state == ALIVE] +
+                [node_ip for node_ip, state in states if state == SUSPECT])
+
+    def last_seen(self):
+        """
+        :return: A dictionary with the seconds since every node last answered a probe
+        """
+        now = time.monotonic()
+        with self._lock:
+            return {node_ip: now - last_seen for node_ip, last_seen in self._last_seen.items()}
+
+    def _run(self):
+        poller = zmq.Poller()
+        for socket in self._sockets:
+            poller.register(socket, zmq.POLLIN)
+
+        while True:
+            answered = set()
+            for socket in self._sockets:
+                socket.send_string('are you online?')
+
+            # Collect the answers until the next round of probes is due
+            deadline = time.monotonic() + self.interval / 1000
+            while len(answered) < len(self._sockets):
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                for socket, _ in poller.poll(timeout * 1000):
+                    socket.recv_string()
+                    answered.add(self._sockets[socket])
+
+            now = time.monotonic()
+            with self._lock:
+                for node_ip in self._missed:
+                    if node_ip in answered:
+                        self._missed[node_ip] = 0
+                        self._last_seen[node_ip] = now
+                    else:
+                        self._missed[node_ip] = min(self._missed[node_ip] + 1, self.dead_after)
+
+            # All nodes answered early: wait for the next round
+            time.sleep(max(0, deadline - time.monotonic()))
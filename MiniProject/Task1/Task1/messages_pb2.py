@@ -13,7 +13,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0emessages.proto\"@\n\x11storedata_request\x12\x10\n\x08\x66ilename\x18\x01 \x01(\t\x12\x19\n\x11replica_locations\x18\x02 \x03(\t\"#\n\x0fgetdata_request\x12\x10\n\x08\x66ilename\x18\x01 \x01(\tb\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0emessages.proto\"T\n\x11storedata_request\x12\x10\n\x08\x66ilename\x18\x01 \x01(\t\x12\x19\n\x11replica_locations\x18\x02 \x03(\t\x12\x12\n\nrequest_id\x18\x03 \x01(\t\"W\n\x0fgetdata_request\x12\x10\n\x08\x66ilename\x18\x01 \x01(\t\x12\x0e\n\x06offset\x18\x02 \x01(\x04\x12\x0e\n\x06length\x18\x03 \x01(\x04\x12\x12\n\nrequest_id\x18\x04 \x01(\tb\x06proto3')
 
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'messages_pb2', globals())
@@ -21,7 +21,7 @@ if _descriptor._USE_C_DESCRIPTORS == False:
 
   DESCRIPTOR._options = None
   _STOREDATA_REQUEST._serialized_start=18
-  _STOREDATA_REQUEST._serialized_end=82
-  _GETDATA_REQUEST._serialized_start=84
-  _GETDATA_REQUEST._serialized_end=119
+  _STOREDATA_REQUEST._serialized_end=102
+  _GETDATA_REQUEST._serialized_start=104
+  _GETDATA_REQUEST._serialized_end=191
 # @@protoc_insertion_point(module_scope)
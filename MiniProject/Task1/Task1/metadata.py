@@ -0,0 +1,107 @@
+"""
+Replica metadata in the database
+
+Every replica of a file has a row in the `fragment` table, with its index, its name,
+the storage node that stores it, its size and checksum. The replicas of a file, or
+those stored on a node, are found with an index instead of parsing the storage
+details of every file.
+
+Files stored before the table existed kept their replica names in the storage
+details JSON. They are copied into the table at startup.
+"""
+import json
+
+CREATE_FRAGMENT_TABLE = """
+CREATE TABLE IF NOT EXISTS `fragment` (
+   `file_id` INTEGER NOT NULL REFERENCES `file`(`id`),
+   `stripe` INTEGER NOT NULL,
+   `idx` INTEGER NOT NULL,
+   `name` TEXT NOT NULL,
+   `node_id` TEXT,
+   `size` INTEGER,
+   `checksum` TEXT,
+   PRIMARY KEY (`file_id`, `stripe`, `idx`)
+);
+CREATE INDEX IF NOT EXISTS `fragment_node_id` ON `fragment`(`node_id`);
+"""
+
+
+def init_db(db):
+    """
+    Create the fragment table if it does not exist, and migrate the files stored before it.
+
+    :param db: A sqlite3 connection
+    """
+    db.executescript(CREATE_FRAGMENT_TABLE)
+    migrate_storage_details(db)
+    db.commit()
+
+
+def migrate_storage_details(db):
+    """
+    Insert the replicas of the files that only list them in their storage details.
+    Files that already have replicas are skipped, so this can run at every start.
+    """
+    files = db.execute(
+        "SELECT `id`, `size`, `storage_details` FROM `file` "
+        "WHERE `id` NOT IN (SELECT DISTINCT `file_id` FROM `fragment`)"
+    ).fetchall()
+
+    for file_id, size, storage_details in files:
+        fragments = replica_fragments(json.loads(storage_details), size)
+        if not fragments:
+            continue
+        insert_fragments(db, file_id, fragments)
+        print("Migrated the replicas of file %d" % file_id)
+
+
+def replica_fragments(storage_details, size=None, checksum=None):
+    """
+    Returns the fragment rows of the replicas listed in the storage details
+    returned by raid1.store_file_2 or hdfs.store_file.
+
+    :param storage_details: The storage details of a RAID1 or HDFS file
+    :param size: The size of every replica (the file size)
+    :param checksum: The checksum of every replica
+    :return: A list of dictionaries with the stripe, idx, name, node_id, size and checksum
+    """
+    if 'filenames_and_locations' in storage_details:
+        replicas = list(storage_details['filenames_and_locations'].items())
+    elif 'replica_locations' in storage_details:
+        replicas = [(storage_details['filename'], location) for location in storage_details['replica_locations']]
+    else:
+        return []
+
+    return [{"stripe": 0, "idx": idx, "name": name, "node_id": node_id, "size": size, "checksum": checksum}
+            for idx, (name, node_id) in enumerate(replicas)]
+
+
+def insert_fragments(db, file_id, fragments):
+    """
+    Insert the replicas of a file. The caller commits the transaction.
+
+    :param db: A sqlite3 connection
+    :param file_id: The ID of the file
+    :param fragments: A list of dictionaries with the stripe, idx, name and optionally
+                      the node_id, size and checksum of every replica
+    """
+    db.executemany(
+        "INSERT INTO `fragment`(`file_id`, `stripe`, `idx`, `name`, `node_id`, `size`, `checksum`) "
+        "VALUES (?,?,?,?,?,?,?)",
+        [(file_id, fragment['stripe'], fragment['idx'], fragment['name'], fragment.get('node_id'),
+          fragment.get('size'), fragment.get('checksum'))
+         for fragment in fragments]
+    )
+
+
+def get_fragments(db, file_id):
+    """
+    Returns the replicas of a file, ordered by index.
+
+    :param db: A sqlite3 connection
+    :param file_id: The ID of the file
+    :return: A list of dictionaries with the columns of the fragment table
+    """
+    cursor = db.execute("SELECT * FROM `fragment` WHERE `file_id`=? ORDER BY `stripe`, `idx`", [file_id])
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
@@ -1,22 +1,28 @@
+import pickle
 import time
 
 import zmq
 
 import messages_pb2
 import utils
+from dispatcher import ResponseChannel
+from liveness import LivenessMonitor
 from utils import random_string
 
 STORAGE_NODES_NUM = 4
 
+# Milliseconds to wait for a replica before trying the next one
+REQUEST_TIMEOUT = 1000
 
-def store_file_2(file_data: bytearray, k: int, send_task_socket: zmq.Socket, response_socket: zmq.Socket, original_filename: str, measure: bool):
+
+def store_file_2(file_data: bytearray, k: int, send_task_socket: zmq.Socket, responses: ResponseChannel, original_filename: str, measure: bool):
     """
     Implements storing a file with RAID 1 using 4 storage nodes.
 
     :param file_data: A bytearray that holds the file contents
     :param k: The number of replicas to store
     :param send_task_socket: A ZMQ PUSH socket to the storage nodes
-    :param response_socket: A ZMQ PULL socket where the storage nodes respond.
+    :param responses: The response channel of the request (see dispatcher.py)
     :param original_filename: The filename put into the http request
     :param measure: Bool. True if replica generation measurements should be made
     :return: Storage Details
@@ -35,15 +41,17 @@ def store_file_2(file_data: bytearray, k: int, send_task_socket: zmq.Socket, res
         task = messages_pb2.storedata_request()
         task.filename = random_string()
         task.replica_locations[:] = [] # Is not used here.
-        send_task_socket.send_multipart([
+        task.request_id = responses.request_id
+        # Send the file data without copying it into the message
+        responses.send(send_task_socket, [
             task.SerializeToString(),
             file_data
-        ])
+        ], copy=False)
 
     filenames_and_locations = {}
     # Wait until we receive k responses from the workers
     for task_nbr in range(k):
-        resp = response_socket.recv_pyobj()
+        resp = pickle.loads(responses.recv_multipart()[0])
         print('Received: %s' % resp)
         filenames_and_locations[resp['filename']] = resp['ip']
 
@@ -64,35 +72,49 @@ def store_file_2(file_data: bytearray, k: int, send_task_socket: zmq.Socket, res
     return storage_details
 
 
-def get_file_2(storage_details, data_req_socket: zmq.Socket, response_socket: zmq.Socket, context: zmq.Context):
+def get_file_2(replicas, data_req_socket: zmq.Socket, responses: ResponseChannel, liveness: LivenessMonitor,
+               offset: int = 0, length: int = 0):
     """
     Implements retrieving a file that is stored with RAID 1 using 4 storage nodes.
 
-    :param storage_details: Storage details as return by store_file function.
+    :param replicas: The replicas of the file, as rows of the fragment table (see metadata.py)
     :param data_req_socket: A ZMQ SUB socket to request chunks from the storage nodes
-    :param response_socket: A ZMQ PULL socket where the storage nodes respond.
-    :param context: A ZMQ Context
-    :return: The original file contents
+    :param responses: The response channel of the request (see dispatcher.py)
+    :param liveness: The LivenessMonitor of the storage nodes
+    :param offset: The first byte of the file to retrieve
+    :param length: The number of bytes to retrieve, 0 for the rest of the file
+    :return: The original file contents (or the requested part of it),
+             or None if no node with a replica answered
     """
 
+    filenames = {replica['node_id']: replica['name'] for replica in replicas}
+
     # Try each filename one by one, until the file is successfully received.
-    for filename, ip in storage_details['filenames_and_locations'].items():
-        if not utils.check_node_online(ip, context):
-            continue
+    # Nodes known to be alive are tried first, dead nodes are skipped.
+    for ip in liveness.by_liveness(list(filenames)):
+        filename = filenames[ip]
 
         task = messages_pb2.getdata_request()
         task.filename = filename
-        data_req_socket.send(
-            task.SerializeToString()
-        )
-
-        # Receive file
-        result = response_socket.recv_multipart()
+        task.offset = offset
+        task.length = length
+        task.request_id = responses.request_id
+        # Only the node with the replica (subscribed to its IP) receives the request
+        responses.send(data_req_socket, [utils.node_topic(ip), task.SerializeToString()])
+
+        # Receive file, unless the node failed since it was last seen
+        if not responses.poll(REQUEST_TIMEOUT):
+            print("No response from %s" % ip)
+            continue
+        result = responses.recv_multipart(copy=False)
         # First frame: file name (string)
-        filename_received = result[0].decode('utf-8')
-        # Second frame: data
-        file_data = result[1]
+        filename_received = result[0].bytes.decode('utf-8')
+        # Second frame: data, without copying it out of the message
+        file_data = result[1].buffer
 
         print("Received %s" % filename_received)
 
-        return file_data
\ No newline at end of file
+        return file_data
+
+    print("No replica of the file is available")
+    return None
\ No newline at end of file
@@ -8,13 +8,17 @@ import logging
 import sqlite3
 import sys
 import time  # For waiting a second for ZMQ connections
+import zlib  # For the replica checksums
 
 import zmq  # For ZMQ
 from flask import Flask, make_response, g, request, send_file
 
 import hdfs
+import metadata
 import raid1
-from utils import is_raspberry_pi, is_docker
+from dispatcher import ResponseDispatcher
+from liveness import LivenessMonitor
+from utils import is_raspberry_pi, is_docker, get_file_validators, get_requested_range, get_node_ips
 
 import json
 
@@ -56,6 +60,13 @@ response_socket.bind("tcp://*:5558")
 data_req_socket = context.socket(zmq.PUB)
 data_req_socket.bind("tcp://*:5559")
 
+# Route the responses of the storage nodes to the requests waiting for them,
+# so several requests can be served at the same time
+dispatcher = ResponseDispatcher(response_socket)
+
+# Probe the storage nodes in the background, so downloads skip dead nodes without waiting
+liveness = LivenessMonitor(context, get_node_ips())
+
 n_replicas_k = data_folder = int(sys.argv[1]) if len(sys.argv) > 1 else 3
 
 # Wait for all workers to start and connect. 
@@ -66,6 +77,9 @@ print("Listening to ZMQ messages on tcp://*:5558 and tcp://*:5561")
 app = Flask(__name__)
 # Close the DB connection after serving the request
 app.teardown_appcontext(close_db)
+# Create the fragment table and move the replica locations of older files into it
+with app.app_context():
+    metadata.init_db(get_db())
 
 
 @app.route('/')
@@ -103,18 +117,39 @@ def download_file(file_id):
     f = dict(f)
     print("File requested: {}".format(f['filename']))
 
-    # Parse the storage details JSON string
-    storage_details = json.loads(f['storage_details'])
+    # The replicas of the file and the nodes that store them
+    replicas = metadata.get_fragments(db, file_id)
+
+    # Serve only a part of the file if the client asks for a byte range
+    etag, last_modified = get_file_validators(f)
+    byte_range = get_requested_range(request, f['size'], etag, last_modified)
+    if byte_range is False:
+        response = make_response('Requested range not satisfiable', 416)
+        response.headers['Content-Range'] = 'bytes */%d' % f['size']
+        return response
+    start, stop = byte_range or (0, f['size'])
 
     if f['storage_mode'] == RAID1:
         # Get file using Raid1
-        file_data = raid1.get_file_2(storage_details, data_req_socket, response_socket, context)
+        with dispatcher.open_channel() as responses:
+            file_data = raid1.get_file_2(replicas, data_req_socket, responses, liveness,
+                                         start, stop - start)
 
     elif f['storage_mode'] == HDFS:
         # Get file using HDFS-like
-        file_data = hdfs.get_file(storage_details, context)
+        file_data = hdfs.get_file(replicas, context, liveness, start, stop - start)
 
-    return send_file(io.BytesIO(file_data), mimetype=f['content_type'])
+    if file_data is None:
+        return make_response({"message": "No replica available"}, 503)
+
+    response = send_file(io.BytesIO(file_data), mimetype=f['content_type'], etag=etag,
+                         last_modified=last_modified, conditional=False)
+    response.accept_ranges = 'bytes'
+    if byte_range:
+        response.status_code = 206
+        response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, f['size'])
+
+    return response
 
 
 # HTTP HEAD requests are served by the GET endpoint of the same URL,
@@ -176,8 +211,8 @@ def add_files_multipart():
     # The sender encodes a file name and type together with the file contents
     filename = file.filename
     content_type = file.mimetype
-    # Load the file contents into a bytearray and measure its size
-    data = bytearray(file.read())
+    # Load the file contents and measure its size (sent to the storage nodes without further copies)
+    data = file.read()
     size = len(data)
     print("File received: %s, size: %d bytes, type: %s" % (filename, size, content_type))
 
@@ -189,18 +224,24 @@ def add_files_multipart():
 
     if storage_mode == RAID1:
         # Raid1 using k replicas
-        storage_details = raid1.store_file_2(data, n_replicas_k, send_task_socket, response_socket, filename, measure)
+        with dispatcher.open_channel() as responses:
+            storage_details = raid1.store_file_2(data, n_replicas_k, send_task_socket, responses, filename, measure)
 
     elif storage_mode == HDFS:
         # HDFS-like, using delegation
         storage_details = hdfs.store_file(data, n_replicas_k, context, filename, measure)
 
-    # Insert the File record in the DB
+    # The replica names and locations are kept in the fragment table
+    fragments = metadata.replica_fragments(storage_details, size, "%08x" % zlib.crc32(data))
+    storage_details = {"n_replicas_k": storage_details["n_replicas_k"]}
+
+    # Insert the File record and its replicas in the DB
     db = get_db()
     cursor = db.execute(
         "INSERT INTO `file`(`filename`, `size`, `content_type`, `storage_mode`, `storage_details`) VALUES (?,?,?,?,?)",
         (filename, size, content_type, storage_mode, json.dumps(storage_details))
     )
+    metadata.insert_fragments(db, cursor.lastrowid, fragments)
     db.commit()
 
     print('Storage details: (filename: ' + filename + ', size: ' + str(size) + ', content_type: ' + content_type
@@ -4,39 +4,111 @@ Aarhus University - Distributed Storage course - Lab 7
 Storage Node
 """
 import os
+import pickle
 import socket
 import sys
 import logging
 import zmq
 
 import messages_pb2
-from utils import random_string, write_file, is_raspberry_pi, is_docker
+from utils import random_string, write_file, load_file, is_raspberry_pi, is_docker, node_topic
+from workers import WorkerPool
+from group_commit import remove_temp_files
 
 
-def find_and_send_file(recv_socker: zmq.Socket, response_socket: zmq.Socket):
+def find_and_send_file(recv_socker: zmq.Socket, response_socket: zmq.Socket, rep=False):
     # Data request for files using hdfs method
-    msg = recv_socker.recv()
+    # RAID 1 requests are preceded by a topic frame
+    msg = recv_socker.recv_multipart()
 
-    # Parse the Protobuf message from the first frame
+    # Parse the Protobuf message from the last frame
     task = messages_pb2.getdata_request()
-    task.ParseFromString(msg)
+    task.ParseFromString(msg[-1])
 
+    # Read the file on a worker, the response is sent once it is read
+    if rep:
+        submit_request(response_socket, read_file, task, True, error_reply=[bytes(task.filename, 'utf-8')])
+    else:
+        workers.submit(response_socket, read_file, task)
+
+
+# The jobs below run on the worker threads (see workers.py). They return the
+# frames of the reply, which the polling thread sends, or None for no reply.
+
+def read_file(task, rep=False):
+    """
+    Read the requested byte range of a file, if it is stored on this node.
+
+    :param task: The getdata_request
+    :param rep: Whether the request came from a REP socket, which must always reply
+    :return: The response frames. If the file is not found, None, or only the
+             file name for a REP socket.
+    """
     filename = task.filename
     print("File request: %s" % filename)
 
     # Try to load the requested file from the local file system,
     # send response only if found
     try:
-        with open(data_folder + '/' + filename, "rb") as in_file:
-            print("Found chunk %s, sending it back" % filename)
-
-            response_socket.send_multipart([
-                bytes(filename, 'utf-8'),
-                in_file.read()
-            ])
+        # Only read the requested byte range, large ranges are mapped and sent without copying
+        data = load_file(data_folder + '/' + filename, task.offset, task.length or None)
+        print("Found chunk %s, sending it back" % filename)
+
+        frames = [bytes(filename, 'utf-8'), data]
+        # RAID 1 responses start with the request ID, so the controller can route them
+        if task.request_id:
+            frames.insert(0, task.request_id.encode('utf-8'))
+        return frames
     except FileNotFoundError:
         # This is OK here
-        pass
+        return [bytes(filename, 'utf-8')] if rep else None
+
+
+def store_file(filename, data, reply):
+    """
+    Write a received file to disk.
+
+    :param filename: The name of the file
+    :param data: The file contents
+    :param reply: The frames to reply with once the file is written
+    """
+    print('File to save: %s, size: %d bytes' % (filename, len(data)))
+
+    # Store the chunk with the given filename
+    chunk_local_path = data_folder + '/' + filename
+    # Only acknowledge the file once it is on disk
+    if write_file(data, chunk_local_path) is None:
+        raise IOError('Could not store file %s' % filename)
+    print("File saved to %s" % chunk_local_path)
+
+    return reply
+
+
+def forward_file(filename, data, replica_locations_left):
+    """
+    Send a file stored in HDFS mode to the next node of the replica chain, or report
+    that the chain is complete.
+    """
+    if len(replica_locations_left) > 0:
+        next_node = replica_locations_left.pop(0)
+        delegated_send_socket = context.socket(zmq.REQ)
+        delegated_send_socket.connect('tcp://' + next_node + ':5560')
+
+        next_node_task = messages_pb2.storedata_request()
+        next_node_task.filename = filename
+        next_node_task.replica_locations[:] = replica_locations_left
+
+        delegated_send_socket.send_multipart([
+            next_node_task.SerializeToString(),
+            data
+        ], copy=False)
+        delegated_send_socket.close()
+    else:
+        time_measure_socket = context.socket(zmq.REQ)
+        addr = "192.168.0.101" if is_raspberry_pi() else "server"
+        time_measure_socket.connect('tcp://' + addr + ':7777')
+        time_measure_socket.send_string("done")
+        time_measure_socket.close()
 
 # Read the folder name where chunks should be stored from the first program argument
 # (or use the current folder if none was given)
@@ -50,6 +122,9 @@ if data_folder != "./":
         pass
 print("Data folder: %s" % data_folder)
 
+# Remove the temporary files of writes that were interrupted by a crash
+remove_temp_files(data_folder)
+
 # Check whether the node has an id. If it doesn't, generate one and save it to disk.
 try:
     with open(data_folder + '/.id', "r") as id_file:
@@ -98,8 +173,10 @@ sender.connect(push_address)
 # Socket to receive Get Chunk messages from the controller
 raid1_data_req_socket = context.socket(zmq.SUB)
 raid1_data_req_socket.connect(subscriber_address)
-# Receive every message (empty subscription)
-raid1_data_req_socket.setsockopt(zmq.SUBSCRIBE, b'')
+# Receive requests broadcast to all nodes, and those for the files stored on this node
+# (the controller records the IP of the node that stored each replica)
+raid1_data_req_socket.setsockopt(zmq.SUBSCRIBE, b'all_nodes')
+raid1_data_req_socket.setsockopt(zmq.SUBSCRIBE, node_topic(own_ip))
 
 # HDFS sockets:
 hdfs_receive_socket = context.socket(zmq.REP)
@@ -112,6 +189,9 @@ hdfs_data_req_socket.bind("tcp://*:5561")
 status_socket = context.socket(zmq.REP)
 status_socket.bind("tcp://*:6666")
 
+# Disk I/O runs on worker threads, so the sockets are polled while it is busy
+workers = WorkerPool(context)
+
 # Use a Poller to monitor three sockets at the same time
 poller = zmq.Poller()
 poller.register(raid1_receive_socket, zmq.POLLIN)
@@ -119,6 +199,17 @@ poller.register(raid1_data_req_socket, zmq.POLLIN)
 poller.register(hdfs_receive_socket, zmq.POLLIN)
 poller.register(hdfs_data_req_socket, zmq.POLLIN)
 poller.register(status_socket, zmq.POLLIN)
+poller.register(workers.results, zmq.POLLIN)
+
+
+def submit_request(rep_socket, fn, *args, error_reply):
+    """
+    Run the job of a request received on a REP socket. A REP socket must reply before
+    it receives the next request, so it is not polled until the job is done.
+    """
+    poller.unregister(rep_socket)
+    workers.submit(rep_socket, fn, *args, error_reply=error_reply,
+                   on_done=lambda: poller.register(rep_socket, zmq.POLLIN))
 
 while True:
     try:
@@ -132,75 +223,50 @@ while True:
 
     if hdfs_receive_socket in socks:
         # Incoming message on the 'receiver' socket where we get tasks to store a file
-        msg = hdfs_receive_socket.recv_multipart()
+        # Receive the frames without copying them, the data is written and forwarded as it is
+        msg = hdfs_receive_socket.recv_multipart(copy=False)
         # Parse the Protobuf message from the first frame
         task = messages_pb2.storedata_request()
-        task.ParseFromString(msg[0])
+        task.ParseFromString(msg[0].bytes)
 
         # The data is the second frame
-        data = msg[1]
+        data = msg[1].buffer
 
         filename = task.filename
-        replica_locations_left = task.replica_locations
+        replica_locations_left = list(task.replica_locations)
         print(f'replica_locations_left: {replica_locations_left}')
 
-        print('File to save: %s, size: %d bytes' % (filename, len(data)))
-
-        # Store the chunk with the given filename
-        chunk_local_path = data_folder + '/' + filename
-        write_file(data, chunk_local_path)
-        print("File saved to %s" % chunk_local_path)
-
-        # Send response (just the file name)
-        hdfs_receive_socket.send_string(filename)
-
-        if len(replica_locations_left) > 0:
-            next_node = replica_locations_left.pop(0)
-            delegated_send_socket = context.socket(zmq.REQ)
-            delegated_send_socket.connect('tcp://' + next_node + ':5560')
-
-            next_node_task = messages_pb2.storedata_request()
-            next_node_task.filename = filename
-            next_node_task.replica_locations[:] = replica_locations_left
-
-            delegated_send_socket.send_multipart([
-                next_node_task.SerializeToString(),
-                data
-            ])
-            delegated_send_socket.close()
-        else:
-            time_measure_socket = context.socket(zmq.REQ)
-            addr = "192.168.0.101" if is_raspberry_pi() else "server"
-            time_measure_socket.connect('tcp://' + addr + ':7777')
-            time_measure_socket.send_string("done")
-            time_measure_socket.close()
+        # Store the file on a worker, then send the response (just the file name).
+        # Pass the file on to the next node in the meantime.
+        submit_request(hdfs_receive_socket, store_file, filename, data, [bytes(filename, 'utf-8')],
+                       error_reply=[b''])
+        workers.submit(None, forward_file, filename, data, replica_locations_left)
 
     if hdfs_data_req_socket in socks:
-        find_and_send_file(hdfs_data_req_socket, hdfs_data_req_socket)
+        find_and_send_file(hdfs_data_req_socket, hdfs_data_req_socket, rep=True)
 
     if raid1_receive_socket in socks:
         # Incoming message on the 'receiver' socket where we get tasks to store a file
-        msg = raid1_receive_socket.recv_multipart()
+        # Receive the frames without copying them, the data is written to disk as it is
+        msg = raid1_receive_socket.recv_multipart(copy=False)
         # Parse the Protobuf message from the first frame
         task = messages_pb2.storedata_request()
-        task.ParseFromString(msg[0])
+        task.ParseFromString(msg[0].bytes)
 
         # The data is the second frame
-        data = msg[1]
+        data = msg[1].buffer
 
-        filename = task.filename
-        print('File to save: %s, size: %d bytes' % (filename, len(data)))
-
-        # Store the chunk with the given filename
-        chunk_local_path = data_folder + '/' + filename
-        write_file(data, chunk_local_path)
-        print("File saved to %s" % chunk_local_path)
-        # Send response (filename + ip)
-        sender.send_pyobj({'filename': task.filename, 'ip': own_ip})
+        # Store the file on a worker, then send the response (request ID, then filename + ip)
+        workers.submit(sender, store_file, task.filename, data,
+                       [task.request_id.encode('utf-8'), pickle.dumps({'filename': task.filename, 'ip': own_ip})])
 
     if raid1_data_req_socket in socks:
         find_and_send_file(raid1_data_req_socket, sender)
 
+    if workers.results in socks:
+        # Send the replies of the jobs that are done
+        workers.send_results()
+
     if status_socket in socks:
         req = status_socket.recv_string()
         status_socket.send_string("OK")
@@ -1,9 +1,17 @@
+import mmap
+import os
 import platform
 import random
 import string
+from datetime import datetime, timezone
 
 import zmq
 
+from group_commit import GroupCommitter
+
+# Files at least this large are memory-mapped when they are read (see load_file)
+MMAP_THRESHOLD = int(os.environ.get('MMAP_THRESHOLD', zmq.COPY_THRESHOLD))
+
 node_ips = ['192.168.0.10' + i for i in ["1", "2", "3", "4"]]
 node_names_for_docker = ['node' + i for i in ["1", "2", "3", "4"]]
 
@@ -19,11 +27,17 @@ def random_string(length=8):
     return ''.join([random.SystemRandom().choice(string.ascii_letters + string.digits) for n in range(length)])
 
 
+# Flushes the written files to disk in batches
+committer = GroupCommitter()
+
+
 def write_file(data, filename=None):
     """
-    Write the given data to a local file with the given filename
+    Write the given data to a local file with the given filename.
+    Returns once the file is durably stored.
 
-    :param data: A bytes object that stores the file contents
+    :param data: A bytes-like object that stores the file contents, or a list of them
+                 (e.g. the buffers of received ZMQ frames) that are written one after the other
     :param filename: The file name. If not given, a random string is generated
     :return: The file name of the newly written file, or None if there was an error
     """
@@ -34,11 +48,9 @@ def write_file(data, filename=None):
         filename += ".bin"
 
     try:
-        # Open filename for writing binary content ('wb')
-        # note: when a file is opened using the 'with' statment, 
-        # it is closed automatically when the scope ends
-        with open('./' + filename, 'wb') as f:
-            f.write(data)
+        # The file is written to a temporary file first and renamed once it is on disk,
+        # so it is either complete or missing after a crash (see group_commit.py)
+        committer.write('./' + filename, data)
     except EnvironmentError as e:
         print("Error writing file: {}".format(e))
         return None
@@ -46,6 +58,44 @@ def write_file(data, filename=None):
     return filename
 
 
+def map_file(fd, offset, length):
+    """
+    Memory-map a part of an open file.
+
+    :param fd: The file descriptor, the mapping stays valid after it is closed
+    :param offset: The offset of the part
+    :param length: The length of the part, at least 1
+    :return: A memoryview of the mapped part
+    """
+    # Mappings must start at a multiple of the allocation granularity
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    mapped = mmap.mmap(fd, offset + length - start, offset=start, access=mmap.ACCESS_READ)
+    return memoryview(mapped)[offset - start:]
+
+
+def load_file(path, offset=0, length=None):
+    """
+    Read a file, or a part of it. Large parts are memory-mapped instead of read into a new
+    bytes object, so they can be sent as zero-copy ZMQ frames: ZMQ keeps a reference to the
+    mapping until the frame is sent, and it is unmapped once the last reference is gone.
+
+    :param path: The path of the file
+    :param offset: The offset to start reading from
+    :param length: The number of bytes to read, or None to read until the end of the file
+    :return: A bytes-like object with the contents
+    :raises FileNotFoundError: If the file does not exist
+    """
+    with open(path, 'rb') as in_file:
+        size = os.fstat(in_file.fileno()).st_size
+        length = max(min(size - offset, length if length is not None else size), 0)
+
+        # pyzmq copies small frames anyway, and mapping them is slower than reading them
+        if length < MMAP_THRESHOLD:
+            in_file.seek(offset)
+            return in_file.read(length)
+        return map_file(in_file.fileno(), offset, length)
+
+
 def is_raspberry_pi():
     """
     Returns True if the current platform is a Raspberry Pi, otherwise False.
@@ -57,27 +107,77 @@ def is_docker():
     return 'WSL' in platform.uname().release
 
 
+def get_node_ips():
+    """
+    Returns the addresses of all storage nodes.
+    """
+    if is_docker():
+        return node_names_for_docker
+    return node_ips
+
+
 def get_k_node_ips(k: int):
-    if is_raspberry_pi():
-        return random.sample(node_ips, k)
-    elif is_docker():
-        return random.sample(node_names_for_docker, k)
-    else:
-        return random.sample(node_ips, k)
+    return random.sample(get_node_ips(), k)
+
+
+def node_topic(node_ip: str):
+    """
+    Returns the PUB/SUB topic of the requests for one storage node. ZMQ matches topics
+    by prefix, so the IP is terminated, otherwise e.g. 10.0.0.1 would also get the
+    requests of 10.0.0.12.
+    """
+    return (node_ip + '/').encode('utf-8')
+
+
+def get_file_validators(f):
+    """
+    Returns the ETag and the Last-Modified date of a stored file. Stored files are
+    never modified, so both are derived from the file record.
+
+    :param f: The file record from the database, as a dictionary
+    :return: The (unquoted) entity tag and the last modification time
+    """
+    last_modified = datetime.strptime(f['created'], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+    etag = "%d-%d-%d" % (f['id'], f['size'], last_modified.timestamp())
+    return etag, last_modified
 
 
-def check_node_online(node_ip: str, context: zmq.Context):
-    sender = context.socket(zmq.REQ)
-    sender.connect('tcp://' + node_ip + ':6666')
-    sender.send_string('are you online?')
+def get_requested_range(request, size, etag, last_modified):
+    """
+    Evaluates the Range and If-Range headers of a download request.
+    Only single byte ranges are supported, anything else is answered with the whole file.
+
+    :param request: The Flask request
+    :param size: The size of the requested file
+    :param etag: The current entity tag of the file
+    :param last_modified: The last modification time of the file
+    :return: A (start, stop) tuple for a partial response, None if the whole file
+             should be sent, or False if the range cannot be satisfied
+    """
+    byte_range = request.range
+    if byte_range is None or byte_range.units != 'bytes' or len(byte_range.ranges) != 1:
+        return None
 
-    # Check that node is online
-    if (sender.poll(1000) & zmq.POLLIN) != 0:
-        resp = sender.recv_string()
-        print(node_ip + ' says: ' + resp)
-        sender.close()
-        return True
+    # If-Range: only send a part if the client's copy is still current (strong comparison)
+    if 'If-Range' in request.headers:
+        if request.headers['If-Range'].startswith('W/'):
+            return None
+        if_range = request.if_range
+        if if_range.etag is not None and if_range.etag != etag:
+            return None
+        if if_range.etag is None and if_range.date != last_modified:
+            return None
+
+    start, stop = byte_range.ranges[0]
+    if stop is None:
+        if start < 0:
+            # Suffix range, e.g. the last 500 bytes
+            start = max(size + start, 0)
+        stop = size
     else:
-        print(node_ip + ' is offline :(')
-        sender.close()
-        return False
\ No newline at end of file
+        stop = min(stop, size)
+
+    if start >= stop:
+        return False
+
+    return start, stop
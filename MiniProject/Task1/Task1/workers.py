@@ -0,0 +1,92 @@
+"""
+Worker threads of the storage node
+
+The storage node polls all its sockets on one thread. Anything that can take long
+(reading and writing fragments, encoding and decoding) runs on a pool of worker
+threads instead, so heartbeats and small requests are still answered while large
+transfers are in flight.
+
+ZMQ sockets must only be used by the thread that polls them, so the workers do not
+reply themselves: they send the reply frames back to the polling thread through an
+inproc socket, and the polling thread sends them on.
+"""
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import zmq
+
+# The number of worker threads
+IO_WORKERS = int(os.environ.get('IO_WORKERS', 4))
+
+
+class WorkerPool:
+    """
+    Runs jobs on worker threads and hands their replies back to the polling thread.
+    """
+
+    def __init__(self, context: zmq.Context, workers=IO_WORKERS):
+        """
+        :param context: The ZMQ Context of the storage node
+        :param workers: The number of worker threads
+        """
+        self._context = context
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='io-worker')
+        self._address = 'inproc://worker-results-%d' % id(self)
+        # The jobs that are not finished yet: job ID -> (socket, on_done, error_reply)
+        self._jobs = {}
+        self._next_job = 0
+        # The socket of every worker thread to the polling thread
+        self._local = threading.local()
+
+        # Register this socket in the poller of the storage node and call send_results when it is readable
+        self.results = context.socket(zmq.PULL)
+        self.results.bind(self._address)
+
+    def submit(self, socket, fn, *args, on_done=None, error_reply=None):
+        """
+        Run fn(*args) on a worker thread. It returns the frames of the reply, which the
+        polling thread sends on the given socket, or None if there is nothing to send.
+
+        :param socket: The socket to send the reply on
+        :param on_done: Called on the polling thread once the job is done and the reply is sent
+        :param error_reply: The frames to send if fn raises an exception, e.g. so a REP socket can
+                            take the next request. Nothing is sent if None.
+        """
+        job = self._next_job
+        self._next_job += 1
+        self._jobs[job] = (socket, on_done, error_reply)
+        self._executor.submit(self._run, job, fn, args)
+
+    def _run(self, job, fn, args):
+        try:
+            reply = fn(*args)
+            frames = [b'ok'] + list(reply) if reply is not None else [b'none']
+        except Exception:
+            traceback.print_exc()
+            frames = [b'error']
+
+        socket = getattr(self._local, 'socket', None)
+        if socket is None:
+            socket = self._local.socket = self._context.socket(zmq.PUSH)
+            socket.connect(self._address)
+        # The data frames are passed on without copying them
+        socket.send_multipart([str(job).encode('utf-8')] + frames, copy=False)
+
+    def send_results(self):
+        """
+        Send the replies of the finished jobs. Must be called by the polling thread.
+        """
+        while self.results.poll(0):
+            frames = self.results.recv_multipart(copy=False)
+            socket, on_done, error_reply = self._jobs.pop(int(frames[0].bytes))
+            status = frames[1].bytes
+
+            if status == b'ok':
+                socket.send_multipart(frames[2:], copy=False)
+            elif status == b'error' and error_reply is not None:
+                socket.send_multipart(error_reply)
+
+            if on_done is not None:
+                on_done()
@@ -0,0 +1,59 @@
+"""
+Aarhus University - Distributed Storage course - Mini Project
+
+Benchmark of the Reed Solomon codec backends. Encodes and decodes random data
+with every available backend and prints the throughput as CSV:
+codec,size,fragments,max_erasures,encode MB/s,decode MB/s
+
+Usage: python benchmark_codecs.py [repetitions]
+"""
+import math
+import os
+import sys
+import time
+
+import rs_codec
+from reedsolomon import get_coefficients
+
+FILE_SIZES = [10 * 1024, 100 * 1024, 1024 * 1024, 10 * 1024 * 1024]
+CODE_PARAMETERS = [(4, 1), (4, 2), (6, 3), (14, 4)]  # (fragments, max_erasures)
+
+
+def benchmark(codec, size, n_fragments, max_erasures, repetitions):
+    data = bytearray(os.urandom(size))
+    symbols = n_fragments - max_erasures
+    symbol_size = math.ceil(size / symbols)
+    coefficients = [get_coefficients(i, symbols) for i in range(n_fragments)]
+
+    t1 = time.perf_counter()
+    for _ in range(repetitions):
+        coded_symbols = codec.encode(data, symbols, symbol_size, coefficients)
+    encode_duration = (time.perf_counter() - t1) / repetitions
+
+    # Decode from the last fragments, as if the first max_erasures nodes were lost
+    t1 = time.perf_counter()
+    for _ in range(repetitions):
+        decoded = codec.decode(coefficients[max_erasures:], coded_symbols[max_erasures:], symbol_size)
+    decode_duration = (time.perf_counter() - t1) / repetitions
+
+    assert decoded[:size] == data
+    return size / encode_duration / 1e6, size / decode_duration / 1e6
+
+
+if __name__ == '__main__':
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    codecs = []
+    for name in rs_codec.CODECS:
+        try:
+            codecs.append(rs_codec.get_codec(name))
+        except RuntimeError as e:
+            print("Skipping %s: %s" % (name, e), file=sys.stderr)
+
+    print("codec,size,fragments,max_erasures,encode_mbps,decode_mbps")
+    for codec in codecs:
+        for size in FILE_SIZES:
+            for n_fragments, max_erasures in CODE_PARAMETERS:
+                encode_mbps, decode_mbps = benchmark(codec, size, n_fragments, max_erasures, repetitions)
+                print("%s,%d,%d,%d,%.1f,%.1f" % (codec.name, size, n_fragments, max_erasures,
+                                                 encode_mbps, decode_mbps))
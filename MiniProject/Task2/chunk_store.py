@@ -0,0 +1,619 @@
+"""
+Fragment storage of the storage node
+
+The layout of the data folder is selected with the CHUNK_STORE environment variable:
+
+- 'files' (the default): every fragment is a file named after the fragment.
+- 'pack': the fragments are appended to large pack files, and an in-memory index maps
+  every fragment name to its position. This avoids millions of small files (and an inode
+  and a directory lookup for each of them) when the fragments are small.
+
+Every record of a pack file is a header, the fragment name and the fragment data. Deleting
+a fragment appends a record without data (a tombstone). The index is checkpointed to disk
+regularly, so a restarted node only reads the records written after the last checkpoint.
+A background thread reclaims the space of overwritten and deleted fragments: it copies the
+records that are still live out of mostly dead pack files and then removes those files.
+
+Either store can be wrapped in a CachedChunkStore, which keeps the most requested fragments
+in memory (up to FRAGMENT_CACHE_SIZE bytes).
+"""
+import collections
+import os
+import pickle
+import re
+import struct
+import threading
+import time
+import zlib
+
+from utils import committer, write_file, load_file, map_file, MMAP_THRESHOLD
+
+# The layout of the data folder, 'files' or 'pack'
+CHUNK_STORE = os.environ.get('CHUNK_STORE', 'files')
+# A new pack file is started once the current one is this large
+PACK_SIZE = int(os.environ.get('PACK_SIZE', 64 * 1024 * 1024))
+# How often the index is checkpointed and the pack files are compacted, in seconds
+PACK_CHECKPOINT_INTERVAL = float(os.environ.get('PACK_CHECKPOINT_INTERVAL', 30))
+# A pack file is compacted once this share of it is taken by dead records
+PACK_COMPACT_THRESHOLD = float(os.environ.get('PACK_COMPACT_THRESHOLD', 0.5))
+# The memory budget of the fragment cache in bytes, 0 to disable it
+FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE', 64 * 1024 * 1024))
+
+# CRC-32 of the rest of the record, record type, length of the name, length of the data
+RECORD_HEADER = struct.Struct('<IBHI')
+RECORD_PUT = 0
+RECORD_DELETE = 1
+
+# Passed as the expected index entry when appending a record unconditionally
+_ANY = object()
+
+PACK_NAME = re.compile(r'^pack-(\d{6})\.dat$')
+CHECKPOINT_NAME = 'pack-index.ckpt'
+
+
+def open_chunk_store(folder, kind=CHUNK_STORE):
+    """
+    Open the fragment store in the given folder.
+
+    :param folder: The data folder of the storage node
+    :param kind: The layout, 'files' or 'pack'
+    """
+    if kind == 'files':
+        return FileChunkStore(folder)
+    if kind == 'pack':
+        return PackChunkStore(folder)
+    raise ValueError("Unknown chunk store: %s" % kind)
+
+
+class FileChunkStore:
+    """
+    Stores every fragment in its own file.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def _path(self, name):
+        return self.folder + '/' + name
+
+    def put(self, name, data):
+        """
+        Store a fragment and return once it is on disk.
+
+        :param name: The name of the fragment
+        :param data: A bytes-like object with the contents, or a list of them
+        :raises IOError: If the fragment could not be stored
+        """
+        if write_file(data, self._path(name)) is None:
+            raise IOError('Could not store chunk %s' % name)
+
+    def get(self, name):
+        """
+        :return: The contents of the fragment, or None if it is not stored
+        """
+        try:
+            return load_file(self._path(name))
+        except FileNotFoundError:
+            return None
+
+    def contains(self, name):
+        return os.path.isfile(self._path(name))
+
+    def delete(self, name):
+        """
+        :return: Whether the fragment was stored
+        """
+        try:
+            os.remove(self._path(name))
+            return True
+        except FileNotFoundError:
+            return False
+
+
+def _encode_record(kind, name, data):
+    name = name.encode('utf-8')
+    size = sum(len(part) for part in data)
+    # The CRC covers everything after its own field
+    header = RECORD_HEADER.pack(0, kind, len(name), size)[4:]
+    crc = zlib.crc32(name, zlib.crc32(header))
+    for part in data:
+        crc = zlib.crc32(part, crc)
+    return b''.join([struct.pack('<I', crc), header, name] + data)
+
+
+def _decode_header(header):
+    """
+    :return: The record type, the name length and the data length
+    """
+    return RECORD_HEADER.unpack(header)[1:]
+
+
+def _check_record(record):
+    crc, = struct.unpack_from('<I', record)
+    if zlib.crc32(memoryview(record)[4:]) != crc:
+        raise IOError('Corrupt record')
+
+
+class _Pack:
+    """
+    An open pack file.
+    """
+
+    def __init__(self, pack_id, path):
+        self.id = pack_id
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o666)
+        self.size = os.fstat(self.fd).st_size
+        # Everything before this offset is on disk
+        self.synced = self.size
+        self.syncing = False
+        # The number of bytes taken by overwritten and deleted fragments, and by tombstones
+        self.dead = 0
+        # Reads in progress; a compacted pack is closed once they are done
+        self.readers = 0
+        self.retired = False
+
+    def records(self, offset=0):
+        """
+        Read the records from the given offset on. Stops at the end of the file or at a
+        record that runs past it. A corrupt record is skipped using the length in its header,
+        it is yielded with None as the record type and the name.
+
+        :return: A generator of (offset, record type, name, record) tuples
+        """
+        while offset + RECORD_HEADER.size <= self.size:
+            header = os.pread(self.fd, RECORD_HEADER.size, offset)
+            kind, name_length, data_length = _decode_header(header)
+            length = RECORD_HEADER.size + name_length + data_length
+            if offset + length > self.size:
+                return
+            record = os.pread(self.fd, length, offset)
+            try:
+                _check_record(record)
+                name = record[RECORD_HEADER.size:RECORD_HEADER.size + name_length].decode('utf-8')
+            except (IOError, UnicodeDecodeError):
+                print("Skipping a corrupt record in %s (offset %d)" % (self.path, offset))
+                kind = name = None
+            yield offset, kind, name, record
+            offset += length
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PackChunkStore:
+    """
+    Appends the fragments to pack files. Safe to use from several threads.
+    """
+
+    def __init__(self, folder, pack_size=PACK_SIZE, checkpoint_interval=PACK_CHECKPOINT_INTERVAL,
+                 compact_threshold=PACK_COMPACT_THRESHOLD):
+        """
+        :param folder: The data folder of the storage node
+        :param pack_size: A new pack file is started once the current one is this large
+        :param checkpoint_interval: How often the index is checkpointed, in seconds
+        :param compact_threshold: The share of dead records that makes a pack file be compacted
+        """
+        self.folder = folder
+        self._pack_size = pack_size
+        self._compact_threshold = compact_threshold
+        # Guards the index and the pack files, and signals finished fsyncs
+        self._cond = threading.Condition()
+        # Pack ID -> _Pack
+        self._packs = {}
+        # Fragment name -> (pack ID, offset, record length)
+        self._index = {}
+        # Whether records were written since the last checkpoint
+        self._dirty = False
+
+        self._load()
+
+        threading.Thread(target=self._maintain, args=(checkpoint_interval,), name='pack-maintenance',
+                         daemon=True).start()
+
+    def _path(self, name):
+        return self.folder + '/' + name
+
+    # Reading and writing
+
+    def put(self, name, data):
+        """
+        Store a fragment and return once it is on disk.
+
+        :param name: The name of the fragment
+        :param data: A bytes-like object with the contents, or a list of them
+        :raises IOError: If the fragment could not be stored
+        """
+        data = data if isinstance(data, list) else [data]
+        self._sync(*self._append(_encode_record(RECORD_PUT, name, data), RECORD_PUT, name))
+
+    def get(self, name):
+        """
+        :return: The contents of the fragment, or None if it is not stored
+        :raises IOError: If the stored record is corrupt
+        """
+        with self._cond:
+            location = self._index.get(name)
+            if location is None:
+                return None
+            pack_id, offset, length = location
+            pack = self._packs[pack_id]
+            pack.readers += 1
+        try:
+            # Large records are mapped, so they are sent without copying them (see load_file)
+            record = map_file(pack.fd, offset, length) if length >= MMAP_THRESHOLD else os.pread(pack.fd, length, offset)
+        finally:
+            with self._cond:
+                pack.readers -= 1
+                if pack.retired and not pack.readers:
+                    pack.close()
+
+        _check_record(record)
+        return memoryview(record)[RECORD_HEADER.size + len(name.encode('utf-8')):]
+
+    def contains(self, name):
+        return name in self._index
+
+    def delete(self, name):
+        """
+        :return: Whether the fragment was stored
+        """
+        appended = self._append(_encode_record(RECORD_DELETE, name, []), RECORD_DELETE, name)
+        if appended is None:
+            return False
+        self._sync(*appended)
+        return True
+
+    def _append(self, record, kind, name, expected=_ANY):
+        """
+        Append a record to the current pack file and update the index.
+
+        :param expected: Only append if this is the index entry of the name (None if it must not
+                         be stored), so a compaction does not undo what was written meanwhile
+        :return: The pack file and its size after the record, which the caller waits
+                 to be on disk, or None if nothing was appended
+        """
+        with self._cond:
+            if expected is _ANY and kind == RECORD_DELETE and name not in self._index:
+                return None
+            if expected is not _ANY and self._index.get(name) != expected:
+                return None
+
+            pack = self._packs[max(self._packs)]
+            offset = pack.size
+            view = memoryview(record)
+            while view:
+                view = view[os.write(pack.fd, view):]
+            pack.size += len(record)
+
+            self._apply(pack, offset, kind, name, len(record))
+            self._dirty = True
+
+            if pack.size >= self._pack_size:
+                self._new_pack(pack.id + 1)
+            return pack, offset + len(record)
+
+    def _apply(self, pack, offset, kind, name, length):
+        # Update the index with a record, which makes the previous one for the name dead
+        previous = self._index.pop(name, None)
+        if previous is not None and previous[0] in self._packs:
+            self._packs[previous[0]].dead += previous[2]
+        if kind == RECORD_PUT:
+            self._index[name] = (pack.id, offset, length)
+        else:
+            pack.dead += length
+
+    def _sync(self, pack, end):
+        """
+        Wait until the pack file is on disk up to the given offset. Concurrent writers
+        share the fsync: one of them flushes everything that is written so far, and the
+        others wait for it.
+        """
+        with self._cond:
+            while pack.synced < end:
+                if pack.syncing:
+                    self._cond.wait()
+                    continue
+
+                pack.syncing = True
+                target = pack.size
+                self._cond.release()
+                try:
+                    os.fsync(pack.fd)
+                finally:
+                    self._cond.acquire()
+                    pack.syncing = False
+                    self._cond.notify_all()
+                pack.synced = target
+
+    def _new_pack(self, pack_id):
+        pack = _Pack(pack_id, self._path('pack-%06d.dat' % pack_id))
+        self._packs[pack_id] = pack
+        # Make sure the new file is still there after a crash
+        fd = os.open(self.folder, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return pack
+
+    # Checkpoints and recovery
+
+    def _load(self):
+        for name in os.listdir(self.folder):
+            match = PACK_NAME.match(name)
+            if match:
+                pack_id = int(match.group(1))
+                self._packs[pack_id] = _Pack(pack_id, self._path(name))
+
+        # Start from the last checkpoint, then read the records written after it
+        start_pack, start_offset = 0, 0
+        checkpoint = self._read_checkpoint()
+        if checkpoint is not None:
+            self._index = checkpoint['index']
+            for pack_id, dead in checkpoint['dead'].items():
+                if pack_id in self._packs:
+                    self._packs[pack_id].dead = dead
+            start_pack, start_offset = checkpoint['position']
+
+        replayed = 0
+        newest = max(self._packs, default=None)
+        for pack_id in sorted(self._packs):
+            if pack_id < start_pack:
+                continue
+            pack = self._packs[pack_id]
+            end = offset = start_offset if pack_id == start_pack else 0
+            for offset, kind, name, record in pack.records(offset):
+                end = offset + len(record)
+                if kind is None:
+                    # Its space is reclaimed when the pack file is compacted
+                    pack.dead += len(record)
+                    continue
+                self._apply(pack, offset, kind, name, len(record))
+                replayed += 1
+            if end == pack.size:
+                continue
+            if pack_id == newest:
+                # An incomplete record from a crash, it was never acknowledged
+                print("Truncating %s at a torn record (offset %d)" % (pack.path, end))
+                os.ftruncate(pack.fd, end)
+                pack.size = pack.synced = end
+            else:
+                # Records are only appended to the newest pack file, so this is damage
+                print("%s has an unreadable record at offset %d, keeping the file" % (pack.path, end))
+                pack.dead += pack.size - end
+
+        if not self._packs:
+            self._new_pack(1)
+        self._dirty = replayed > 0
+        print("Pack store: %d fragments in %d pack files, %d records replayed" %
+              (len(self._index), len(self._packs), replayed))
+
+    def _read_checkpoint(self):
+        try:
+            with open(self._path(CHECKPOINT_NAME), 'rb') as in_file:
+                checkpoint = pickle.load(in_file)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print("Ignoring the index checkpoint: %s" % e)
+            return None
+
+        # Compacted pack files are only removed after a checkpoint without them was written
+        if not all(pack_id in self._packs for pack_id, _, _ in checkpoint['index'].values()):
+            print("Ignoring the index checkpoint: it refers to missing pack files")
+            return None
+        return checkpoint
+
+    def checkpoint(self):
+        """
+        Write the index to disk, so it does not have to be rebuilt from the pack files on restart.
+        """
+        with self._cond:
+            if not self._dirty:
+                return
+            self._dirty = False
+            current = self._packs[max(self._packs)]
+            checkpoint = {
+                'position': (current.id, current.size),
+                'index': dict(self._index),
+                'dead': {pack.id: pack.dead for pack in self._packs.values()},
+            }
+            unsynced = [(pack, pack.size) for pack in self._packs.values() if pack.synced < pack.size]
+
+        # The checkpoint must not refer to records that are not on disk yet
+        for pack, end in unsynced:
+            self._sync(pack, end)
+        try:
+            committer.write(self._path(CHECKPOINT_NAME), pickle.dumps(checkpoint, protocol=pickle.HIGHEST_PROTOCOL))
+        except OSError:
+            with self._cond:
+                self._dirty = True
+            raise
+
+    # Compaction
+
+    def compact(self):
+        """
+        Copy the live records out of the pack files that are mostly dead, and remove those files.
+        """
+        with self._cond:
+            current = max(self._packs)
+            candidates = [pack for pack in self._packs.values()
+                          if pack.id != current and pack.synced == pack.size
+                          and pack.dead >= pack.size * self._compact_threshold]
+        if not candidates:
+            return
+
+        for pack in candidates:
+            self._copy_live_records(pack)
+
+        # The index must not refer to the removed files after a restart
+        with self._cond:
+            removed = {pack.id for pack in candidates}
+            lost = [name for name, (pack_id, _, _) in self._index.items() if pack_id in removed]
+            for name in lost:
+                # The record is corrupt, so it could not be copied
+                print("Dropping the corrupt fragment %s" % name)
+                del self._index[name]
+            self._dirty = True
+        self.checkpoint()
+
+        with self._cond:
+            for pack in candidates:
+                del self._packs[pack.id]
+                os.remove(pack.path)
+                pack.retired = True
+                if not pack.readers:
+                    pack.close()
+        print("Compacted %d pack files" % len(candidates))
+
+    def _copy_live_records(self, pack):
+        appended = []
+        for offset, kind, name, record in pack.records():
+            if kind is None:
+                continue
+            if kind == RECORD_PUT:
+                result = self._append(record, kind, name, expected=(pack.id, offset, len(record)))
+            else:
+                # A tombstone is only needed while an older pack file may hold the deleted
+                # fragment, and while the fragment was not stored again
+                with self._cond:
+                    needed = min(self._packs) < pack.id
+                result = self._append(record, kind, name, expected=None) if needed else None
+            if result is not None:
+                appended.append(result)
+        for target, end in appended:
+            self._sync(target, end)
+
+    def _maintain(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.compact()
+                self.checkpoint()
+            except OSError as e:
+                print("Pack store maintenance failed: %s" % e)
+
+
+class CachedChunkStore:
+    """
+    Keeps the most requested fragments of another store in memory.
+
+    The cache is a segmented LRU: a fragment starts in the probation segment and moves to
+    the protected segment when it is read again. Fragments are evicted from the probation
+    segment first, so fragments that are only read once (e.g. during a repair) do not push
+    out the ones that are read all the time.
+    """
+
+    # The share of the budget for the protected segment
+    PROTECTED_SHARE = 0.8
+    # The share of the budget a single fragment may take, larger ones are not cached
+    MAX_FRAGMENT_SHARE = 1 / 8
+
+    def __init__(self, store, budget=FRAGMENT_CACHE_SIZE):
+        """
+        :param store: The store to cache the fragments of
+        :param budget: The memory budget in bytes, 0 to disable caching
+        """
+        self.store = store
+        self._budget = budget
+        self._protected_budget = int(budget * self.PROTECTED_SHARE)
+        self._max_fragment = int(budget * self.MAX_FRAGMENT_SHARE)
+        self._lock = threading.Lock()
+        # Fragment name -> contents, from the least to the most recently used
+        self._probation = collections.OrderedDict()
+        self._protected = collections.OrderedDict()
+        self._size = 0
+        self._protected_size = 0
+        # The fragments being read from the store: name -> token. A write or a delete
+        # removes the token, so the contents that were read before are not cached.
+        self._loading = {}
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, name, data):
+        self.store.put(name, data)
+        self._invalidate(name)
+
+    def get(self, name):
+        with self._lock:
+            data = self._lookup(name)
+            if data is not None:
+                self.hits += 1
+                return data
+            self.misses += 1
+            token = self._loading[name] = object()
+
+        try:
+            data = self.store.get(name)
+            if data is not None and len(data) <= self._max_fragment:
+                # Copy the contents out of a mapping, the cache must not keep files open
+                data = bytes(data)
+        finally:
+            with self._lock:
+                loaded = self._loading.get(name) is token
+                if loaded:
+                    del self._loading[name]
+        if loaded and data is not None and len(data) <= self._max_fragment:
+            with self._lock:
+                self._insert(name, data)
+        return data
+
+    def contains(self, name):
+        return self.store.contains(name)
+
+    def delete(self, name):
+        deleted = self.store.delete(name)
+        self._invalidate(name)
+        return deleted
+
+    def stats(self):
+        """
+        :return: The number of hits and misses, and the size of the cached fragments in bytes
+        """
+        with self._lock:
+            return self.hits, self.misses, self._size
+
+    def _lookup(self, name):
+        data = self._protected.get(name)
+        if data is not None:
+            self._protected.move_to_end(name)
+            return data
+
+        data = self._probation.pop(name, None)
+        if data is not None:
+            # Read again: protect it, and move the least recently used protected fragments
+            # back to probation if the protected segment is full
+            self._protected[name] = data
+            self._protected_size += len(data)
+            while self._protected_size > self._protected_budget:
+                demoted, demoted_data = self._protected.popitem(last=False)
+                self._protected_size -= len(demoted_data)
+                self._probation[demoted] = demoted_data
+        return data
+
+    def _insert(self, name, data):
+        self._remove(name)
+        self._probation[name] = data
+        self._size += len(data)
+        while self._size > self._budget:
+            segment = self._probation if self._probation else self._protected
+            evicted, evicted_data = segment.popitem(last=False)
+            self._size -= len(evicted_data)
+            if segment is self._protected:
+                self._protected_size -= len(evicted_data)
+
+    def _remove(self, name):
+        data = self._probation.pop(name, None)
+        if data is None:
+            data = self._protected.pop(name, None)
+            if data is not None:
+                self._protected_size -= len(data)
+        if data is not None:
+            self._size -= len(data)
+
+    def _invalidate(self, name):
+        with self._lock:
+            self._loading.pop(name, None)
+            self._remove(name)
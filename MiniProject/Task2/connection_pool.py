@@ -0,0 +1,109 @@
+"""
+Pooled REQ connections to other nodes
+
+Delegated encoding and decoding send one request to a peer (another storage node
+or the delegate) and wait for its reply. Instead of connecting a new REQ socket
+for every request, and paying the TCP connect and ZMTP handshake each time, the
+sockets are kept open and reused for the next request to the same peer.
+
+A socket is only put back into the pool after a complete request/reply: if the
+peer did not reply in time or anything else went wrong, the REQ socket is stuck
+waiting for a reply and is closed instead. At most MAX_IDLE_PER_PEER idle sockets
+are kept per peer; concurrent requests to the same peer get their own sockets.
+"""
+import os
+import threading
+from contextlib import contextmanager
+
+import zmq
+
+# Idle sockets kept open per peer address
+MAX_IDLE_PER_PEER = int(os.environ.get('MAX_IDLE_PER_PEER', 4))
+# Milliseconds to wait for a peer's reply
+PEER_TIMEOUT = int(os.environ.get('PEER_TIMEOUT', 30000))
+
+
+class ConnectionPool:
+    """
+    Idle REQ sockets per peer address, shared by the threads of a process.
+    """
+
+    def __init__(self, context: zmq.Context, max_idle_per_peer=MAX_IDLE_PER_PEER, timeout=PEER_TIMEOUT):
+        """
+        :param context: A ZMQ Context
+        :param max_idle_per_peer: The number of idle sockets kept open per peer
+        :param timeout: Milliseconds to wait for a reply, after which receiving raises zmq.Again
+        """
+        self._context = context
+        self.max_idle_per_peer = max_idle_per_peer
+        self.timeout = timeout
+        # Peer address -> idle sockets connected to it
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def checkout(self, address):
+        """
+        Take an idle socket connected to the address, or connect a new one.
+        It must be given back with checkin or discard.
+
+        :param address: The ZMQ address of the peer, e.g. tcp://node1:5543
+        :return: A REQ socket, ready to send a request
+        """
+        with self._lock:
+            idle = self._idle.get(address)
+            if idle:
+                return idle.pop()
+
+        socket = self._context.socket(zmq.REQ)
+        socket.setsockopt(zmq.RCVTIMEO, self.timeout)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(address)
+        return socket
+
+    def checkin(self, address, socket):
+        """
+        Give a socket back after its reply was received. Sockets that are not
+        ready for the next request, or exceed the number of idle sockets, are closed.
+        """
+        if socket.closed or not socket.getsockopt(zmq.EVENTS) & zmq.POLLOUT:
+            self.discard(socket)
+            return
+
+        with self._lock:
+            idle = self._idle.setdefault(address, [])
+            if len(idle) < self.max_idle_per_peer:
+                idle.append(socket)
+                return
+        socket.close()
+
+    def discard(self, socket):
+        """
+        Close a socket whose request failed, instead of giving it back.
+        """
+        socket.close(linger=0)
+
+    @contextmanager
+    def connection(self, address):
+        """
+        A socket for one request/reply with the peer. If an exception is raised
+        (e.g. zmq.Again when the peer does not reply in time) the socket is closed.
+
+        :param address: The ZMQ address of the peer
+        """
+        socket = self.checkout(address)
+        try:
+            yield socket
+        except BaseException:
+            self.discard(socket)
+            raise
+        self.checkin(address, socket)
+
+    def close(self):
+        """
+        Close all idle sockets.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for sockets in idle.values():
+            for socket in sockets:
+                socket.close()
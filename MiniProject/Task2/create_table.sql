@@ -6,4 +6,17 @@ CREATE TABLE `file` (
    `storage_mode` TEXT,
    `storage_details` TEXT,
    `created` DATETIME DEFAULT CURRENT_TIMESTAMP
-);
\ No newline at end of file
+);
+
+CREATE TABLE `fragment` (
+   `file_id` INTEGER NOT NULL REFERENCES `file`(`id`),
+   `stripe` INTEGER NOT NULL,
+   `idx` INTEGER NOT NULL,
+   `name` TEXT NOT NULL,
+   `node_id` TEXT,
+   `size` INTEGER,
+   `checksum` TEXT,
+   PRIMARY KEY (`file_id`, `stripe`, `idx`)
+);
+
+CREATE INDEX `fragment_node_id` ON `fragment`(`node_id`);
@@ -0,0 +1,256 @@
+"""
+Routing of the storage nodes' responses to the requests waiting for them
+
+The storage nodes send all their responses to one PULL socket of the controller.
+To serve several HTTP requests at the same time, every request opens its own
+response channel with a unique request ID. The ID is put into the Protobuf requests
+sent to the storage nodes, and the nodes send it back in the first frame of their
+responses. A background thread reads the response socket and puts every response
+into the queue of its channel. Responses to unknown requests (e.g. late fragments
+of a read that has already finished) are discarded.
+
+ZMQ sockets are not thread safe, so the requests also send through the dispatcher,
+which serializes the sends on the shared sockets. The fragments of a stripe are sent
+with one send_all, so no other request's message gets in between them: the round-robin
+PUSH socket then hands them to consecutive storage nodes, one fragment per node.
+
+The asyncio controller (rest-server-async.py) uses AsyncResponseDispatcher instead,
+which reads a zmq.asyncio socket in a task and has coroutine channels.
+"""
+import asyncio
+import queue
+import threading
+import uuid
+
+import zmq
+
+
+class ResponseChannel:
+    """
+    The responses to one request. It can be used in place of the response socket:
+    it has the same poll and recv_multipart methods, but only receives the responses
+    that carry its request ID (without the ID frame).
+    """
+
+    def __init__(self, dispatcher, request_id):
+        self.request_id = request_id
+        self._dispatcher = dispatcher
+        self._queue = queue.Queue()
+        # A response taken from the queue by poll, but not yet received
+        self._next = None
+
+    def send(self, socket, frames, copy=True):
+        """
+        Send a multipart message on a socket shared by all requests.
+        """
+        self._dispatcher.send_all(socket, [frames], copy)
+
+    def send_all(self, socket, messages, copy=True):
+        """
+        Send several multipart messages on a socket shared by all requests,
+        with no message of another request in between.
+        """
+        self._dispatcher.send_all(socket, messages, copy)
+
+    def poll(self, timeout=None):
+        """
+        Wait until a response is available.
+
+        :param timeout: The timeout in milliseconds, None to wait forever
+        :return: zmq.POLLIN if a response is available, otherwise 0
+        """
+        if self._next is None:
+            try:
+                self._next = self._queue.get(timeout=timeout / 1000 if timeout is not None else None)
+            except queue.Empty:
+                return 0
+        return zmq.POLLIN
+
+    def recv_multipart(self, copy=True):
+        """
+        Receive the next response, blocking until there is one.
+
+        :param copy: If False, return the zmq.Frame objects instead of copying them into bytes
+        :return: The frames of the response, without the request ID
+        """
+        self.poll()
+        frames, self._next = self._next, None
+        if copy:
+            return [frame.bytes for frame in frames]
+        return frames
+
+    def close(self):
+        """
+        Stop receiving responses. Responses that arrive later are discarded.
+        """
+        self._dispatcher.close_channel(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class ResponseDispatcher:
+    """
+    Reads the shared response socket on a background thread and hands out response channels.
+    """
+
+    def __init__(self, response_socket):
+        """
+        :param response_socket: The ZMQ PULL socket where the storage nodes respond.
+                                It must not be used by anything else afterwards.
+        """
+        self._response_socket = response_socket
+        self._channels = {}
+        self._channels_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+
+        thread = threading.Thread(target=self._run, name="response-dispatcher", daemon=True)
+        thread.start()
+
+    def open_channel(self):
+        """
+        Start a new request.
+
+        :return: A ResponseChannel with a new unique request ID
+        """
+        channel = ResponseChannel(self, uuid.uuid4().hex)
+        with self._channels_lock:
+            self._channels[channel.request_id.encode('utf-8')] = channel
+        return channel
+
+    def close_channel(self, channel):
+        with self._channels_lock:
+            self._channels.pop(channel.request_id.encode('utf-8'), None)
+
+    def send_all(self, socket, messages, copy=True):
+        with self._send_lock:
+            for frames in messages:
+                socket.send_multipart(frames, copy=copy)
+
+    def _run(self):
+        while True:
+            frames = self._response_socket.recv_multipart(copy=False)
+            with self._channels_lock:
+                channel = self._channels.get(frames[0].bytes)
+
+            if channel is None:
+                print("Discarded response to unknown request")
+                continue
+            channel._queue.put(frames[1:])
+
+
+class AsyncResponseChannel:
+    """
+    The responses to one request of the asyncio controller. It has the same methods
+    as ResponseChannel, but send, poll and recv_multipart are coroutines.
+    """
+
+    def __init__(self, dispatcher, request_id):
+        self.request_id = request_id
+        self._dispatcher = dispatcher
+        self._queue = asyncio.Queue()
+        self._next = None
+
+    async def send(self, socket, frames, copy=True):
+        """
+        Send a multipart message on a zmq.asyncio socket shared by all requests.
+        """
+        await self._dispatcher.send_all(socket, [frames], copy)
+
+    async def send_all(self, socket, messages, copy=True):
+        """
+        Send several multipart messages on a zmq.asyncio socket shared by all requests,
+        with no message of another request in between.
+        """
+        await self._dispatcher.send_all(socket, messages, copy)
+
+    async def poll(self, timeout=None):
+        """
+        Wait until a response is available.
+
+        :param timeout: The timeout in milliseconds, None to wait forever
+        :return: zmq.POLLIN if a response is available, otherwise 0
+        """
+        if self._next is None:
+            try:
+                self._next = await asyncio.wait_for(self._queue.get(),
+                                                    timeout / 1000 if timeout is not None else None)
+            except asyncio.TimeoutError:
+                return 0
+        return zmq.POLLIN
+
+    async def recv_multipart(self, copy=True):
+        """
+        Receive the next response, waiting until there is one.
+
+        :param copy: If False, return the zmq.Frame objects instead of copying them into bytes
+        :return: The frames of the response, without the request ID
+        """
+        await self.poll()
+        frames, self._next = self._next, None
+        if copy:
+            return [frame.bytes for frame in frames]
+        return frames
+
+    def close(self):
+        """
+        Stop receiving responses. Responses that arrive later are discarded.
+        """
+        self._dispatcher.close_channel(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class AsyncResponseDispatcher:
+    """
+    Reads the shared zmq.asyncio response socket in a task and hands out response channels.
+    Everything runs on the event loop, so no locks are needed.
+    """
+
+    def __init__(self, response_socket):
+        """
+        :param response_socket: The zmq.asyncio PULL socket where the storage nodes respond.
+                                It must not be used by anything else afterwards.
+        """
+        self._response_socket = response_socket
+        self._channels = {}
+        # A send that has to wait for the socket lets other tasks run
+        self._send_lock = asyncio.Lock()
+
+    def open_channel(self):
+        """
+        Start a new request.
+
+        :return: An AsyncResponseChannel with a new unique request ID
+        """
+        channel = AsyncResponseChannel(self, uuid.uuid4().hex)
+        self._channels[channel.request_id.encode('utf-8')] = channel
+        return channel
+
+    def close_channel(self, channel):
+        self._channels.pop(channel.request_id.encode('utf-8'), None)
+
+    async def send_all(self, socket, messages, copy=True):
+        async with self._send_lock:
+            for frames in messages:
+                await socket.send_multipart(frames, copy=copy)
+
+    async def run(self):
+        """
+        Route the responses to their channels. Must be started as a task on the event loop.
+        """
+        while True:
+            frames = await self._response_socket.recv_multipart(copy=False)
+            channel = self._channels.get(frames[0].bytes)
+
+            if channel is None:
+                print("Discarded response to unknown request")
+                continue
+            channel._queue.put_nowait(frames[1:])
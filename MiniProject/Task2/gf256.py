@@ -0,0 +1,91 @@
+"""
+Arithmetic in the finite field GF(2^8), as used by the Reed Solomon codes.
+
+The field is generated by the polynomial x^8 + x^4 + x^3 + x^2 + 1 (0x11D),
+the same one kodo uses for kodo.FiniteField.binary8.
+"""
+
+PRIMITIVE_POLYNOMIAL = 0x11D
+
+# Exponent and logarithm tables of the generator element 2. The exponent table
+# is doubled, so the sum of two logarithms can be looked up without a modulo.
+EXP = [0] * 512
+LOG = [0] * 256
+
+_x = 1
+for _i in range(255):
+    EXP[_i] = _x
+    LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= PRIMITIVE_POLYNOMIAL
+for _i in range(255, 512):
+    EXP[_i] = EXP[_i - 255]
+
+
+def mul(a, b):
+    """
+    Multiplies two field elements.
+    """
+    if a == 0 or b == 0:
+        return 0
+    return EXP[LOG[a] + LOG[b]]
+
+
+def inv(a):
+    """
+    Returns the multiplicative inverse of a non-zero field element.
+    """
+    if a == 0:
+        raise ZeroDivisionError("0 has no inverse in GF(2^8)")
+    return EXP[255 - LOG[a]]
+
+
+def cauchy_row(index, symbols):
+    """
+    Returns a row of a Cauchy matrix with 'symbols' columns, with the elements
+    1 / (x_i + y_j) where x_i = index and y_j = 255 - j. Every square submatrix of
+    a Cauchy matrix is invertible, so any 'symbols' rows can be used to decode.
+    The rows of the 4x4 matrix are the coefficients the course examples use.
+
+    :param index: The index of the row, at most 255 - symbols
+    :param symbols: The number of columns
+    :return: The row as a bytearray
+    """
+    # x_i must differ from every y_j, which are the 'symbols' largest elements
+    if index + symbols > 255:
+        raise ValueError("A Cauchy matrix over GF(2^8) can have at most 256 rows and columns combined")
+
+    # Addition in GF(2^8) is XOR, and 255 - j == 255 ^ j
+    return bytearray(inv(index ^ (255 - j)) for j in range(symbols))
+
+
+def invert_matrix(matrix):
+    """
+    Inverts a square matrix with Gauss-Jordan elimination.
+
+    :param matrix: The matrix as a list of rows (sequences of field elements)
+    :return: The inverse as a list of bytearray rows
+    """
+    size = len(matrix)
+    # Augment the matrix with the identity matrix
+    rows = [bytearray(row) + bytearray(1 if i == j else 0 for j in range(size))
+            for i, row in enumerate(matrix)]
+
+    for col in range(size):
+        pivot = next((r for r in range(col, size) if rows[r][col] != 0), None)
+        if pivot is None:
+            raise ValueError("Matrix is singular")
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+
+        # Scale the pivot row, so the pivot becomes 1
+        factor = inv(rows[col][col])
+        rows[col] = bytearray(mul(factor, v) for v in rows[col])
+
+        # Eliminate the column from every other row
+        for r in range(size):
+            if r != col and rows[r][col] != 0:
+                factor = rows[r][col]
+                rows[r] = bytearray(v ^ mul(factor, p) for v, p in zip(rows[r], rows[col]))
+
+    return [row[size:] for row in rows]
@@ -0,0 +1,145 @@
+"""
+Cluster membership
+
+Instead of asking the storage nodes whether they are alive on every request, a
+background thread of the controller sends a heartbeat to all nodes at a fixed
+interval and remembers when each node last answered. Requests look the live
+nodes up in that table without waiting for the nodes.
+
+The nodes answer the heartbeats on their own socket, so liveness traffic does
+not go through the response socket used for fragments.
+
+The asyncio controller (rest-server-async.py) runs the same loop as a coroutine, see AsyncMembership.
+"""
+import os
+import threading
+import time
+
+import zmq
+from google.protobuf.message import DecodeError
+
+import messages_pb2
+
+# Seconds between two heartbeats
+HEARTBEAT_INTERVAL = float(os.environ.get('HEARTBEAT_INTERVAL', 1))
+# A node that has not answered for this many seconds is considered dead
+NODE_TIMEOUT = float(os.environ.get('NODE_TIMEOUT', 3 * HEARTBEAT_INTERVAL))
+
+
+class Membership:
+    """
+    Heartbeats the storage nodes on a background thread and keeps the time each node was last seen.
+    """
+
+    def __init__(self, heartbeat_socket, heartbeat_response_socket,
+                 interval=HEARTBEAT_INTERVAL, timeout=NODE_TIMEOUT):
+        """
+        :param heartbeat_socket: The ZMQ PUB socket to send heartbeats to the storage nodes
+        :param heartbeat_response_socket: The ZMQ PULL socket where the nodes answer the heartbeats
+        Both sockets must not be used by anything else afterwards.
+        :param interval: Seconds between two heartbeats
+        :param timeout: Seconds after which a node that has not answered is considered dead
+        """
+        self._heartbeat_socket = heartbeat_socket
+        self._heartbeat_response_socket = heartbeat_response_socket
+        self.interval = interval
+        self.timeout = timeout
+        # Node IP -> time.monotonic() of its last heartbeat response
+        self._last_seen = {}
+        # Node IP -> the counters of its fragment cache, from its last heartbeat response
+        self._cache_stats = {}
+        self._lock = threading.Lock()
+        self._start()
+
+    def _start(self):
+        thread = threading.Thread(target=self._run, name="membership", daemon=True)
+        thread.start()
+
+    def connected_nodes(self):
+        """
+        :return: The IPs of the nodes that answered a heartbeat recently
+        """
+        deadline = time.monotonic() - self.timeout
+        with self._lock:
+            return [ip for ip, last_seen in self._last_seen.items() if last_seen >= deadline]
+
+    def is_alive(self, node_ip):
+        """
+        :return: Whether the node answered a heartbeat recently
+        """
+        with self._lock:
+            last_seen = self._last_seen.get(node_ip)
+        return last_seen is not None and last_seen >= time.monotonic() - self.timeout
+
+    def last_seen(self):
+        """
+        :return: A dictionary with the seconds since every known node last answered a heartbeat
+        """
+        now = time.monotonic()
+        with self._lock:
+            return {ip: now - last_seen for ip, last_seen in self._last_seen.items()}
+
+    def _run(self):
+        task = messages_pb2.heartbeat_request().SerializeToString()
+        next_heartbeat = time.monotonic()
+
+        while True:
+            now = time.monotonic()
+            if now >= next_heartbeat:
+                self._heartbeat_socket.send_multipart([b"all_nodes", task])
+                next_heartbeat = now + self.interval
+
+            # Collect the responses until the next heartbeat is due
+            timeout = max(0, int((next_heartbeat - time.monotonic()) * 1000))
+            if self._heartbeat_response_socket.poll(timeout):
+                self._record(self._heartbeat_response_socket.recv())
+
+    def cache_stats(self):
+        """
+        Returns the fragment cache counters the nodes sent with their last heartbeat response.
+
+        :return: A dictionary of node IP -> dictionary with the hits, misses and cached bytes
+        """
+        with self._lock:
+            return dict(self._cache_stats)
+
+    def _record(self, msg):
+        """
+        Record the time of a heartbeat response.
+        """
+        response = messages_pb2.heartbeat_response()
+        try:
+            response.ParseFromString(msg)
+        except DecodeError:
+            return
+        if response.node_ip:
+            with self._lock:
+                self._last_seen[response.node_ip] = time.monotonic()
+                self._cache_stats[response.node_ip] = {"hits": response.cache_hits,
+                                                       "misses": response.cache_misses,
+                                                       "bytes": response.cache_bytes}
+
+
+class AsyncMembership(Membership):
+    """
+    Membership for the asyncio controller, with zmq.asyncio sockets. The heartbeats
+    are sent by the run coroutine instead of a thread, it must be started as a task.
+    """
+
+    def _start(self):
+        pass
+
+    async def run(self):
+        task = messages_pb2.heartbeat_request().SerializeToString()
+        next_heartbeat = time.monotonic()
+
+        while True:
+            now = time.monotonic()
+            if now >= next_heartbeat:
+                await self._heartbeat_socket.send_multipart([b"all_nodes", task])
+                next_heartbeat = now + self.interval
+
+            # Collect the responses until the next heartbeat is due
+            timeout = max(0, int((next_heartbeat - time.monotonic()) * 1000))
+            if await self._heartbeat_response_socket.poll(timeout):
+                self._record(await self._heartbeat_response_socket.recv())
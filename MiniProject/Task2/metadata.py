@@ -0,0 +1,129 @@
+"""
+Fragment metadata in the database
+
+Every coded fragment of a file has a row in the `fragment` table, with the stripe
+and index it belongs to, its name, the storage node that stores it, its size and
+checksum. The fragments of a file, or those stored on a node, are found with an
+index instead of parsing the storage details of every file.
+
+Files stored before the table existed kept their fragment names in the storage
+details JSON. They are copied into the table at startup.
+"""
+import json
+
+CREATE_FRAGMENT_TABLE = """
+CREATE TABLE IF NOT EXISTS `fragment` (
+   `file_id` INTEGER NOT NULL REFERENCES `file`(`id`),
+   `stripe` INTEGER NOT NULL,
+   `idx` INTEGER NOT NULL,
+   `name` TEXT NOT NULL,
+   `node_id` TEXT,
+   `size` INTEGER,
+   `checksum` TEXT,
+   PRIMARY KEY (`file_id`, `stripe`, `idx`)
+);
+CREATE INDEX IF NOT EXISTS `fragment_node_id` ON `fragment`(`node_id`);
+"""
+
+
+def init_db(db):
+    """
+    Create the fragment table if it does not exist, and migrate the files stored before it.
+
+    :param db: A sqlite3 connection
+    """
+    db.executescript(CREATE_FRAGMENT_TABLE)
+    migrate_storage_details(db)
+    db.commit()
+
+
+def migrate_storage_details(db):
+    """
+    Insert the fragments of the files that only list them in their storage details.
+    Files that already have fragments are skipped, so this can run at every start.
+    """
+    files = db.execute(
+        "SELECT `id`, `storage_details` FROM `file` WHERE `storage_mode`='erasure_coding_rs' "
+        "AND `id` NOT IN (SELECT DISTINCT `file_id` FROM `fragment`)"
+    ).fetchall()
+
+    for file_id, storage_details in files:
+        storage_details = json.loads(storage_details)
+        if 'stripes' in storage_details:
+            stripes = storage_details['stripes']
+        elif 'coded_fragments' in storage_details:
+            stripes = [storage_details['coded_fragments']]
+        else:
+            continue
+        locations = storage_details.get('locations') or [[None] * len(names) for names in stripes]
+
+        insert_fragments(db, file_id, [
+            {"stripe": stripe, "idx": idx, "name": name, "node_id": locations[stripe][idx]}
+            for stripe, names in enumerate(stripes)
+            for idx, name in enumerate(names)
+        ])
+        print("Migrated the fragments of file %d" % file_id)
+
+
+def insert_file(db, filename, size, content_type, storage_mode, storage_details, fragments):
+    """
+    Insert a file and its fragments. The caller commits the transaction, so the
+    files of a batch upload can be inserted in one transaction.
+
+    :param storage_details: A dictionary with the coding parameters of the file
+    :param fragments: The fragments of the file, see insert_fragments
+    :return: The ID of the file
+    """
+    cursor = db.execute(
+        "INSERT INTO `file`(`filename`, `size`, `content_type`, `storage_mode`, `storage_details`) VALUES (?,?,?,?,?)",
+        (filename, size, content_type, storage_mode, json.dumps(storage_details))
+    )
+    insert_fragments(db, cursor.lastrowid, fragments)
+    return cursor.lastrowid
+
+
+def insert_fragments(db, file_id, fragments):
+    """
+    Insert the fragments of a file. The caller commits the transaction.
+
+    :param db: A sqlite3 connection
+    :param file_id: The ID of the file
+    :param fragments: A list of dictionaries with the stripe, idx, name and optionally
+                      the node_id, size and checksum of every fragment
+    """
+    db.executemany(
+        "INSERT INTO `fragment`(`file_id`, `stripe`, `idx`, `name`, `node_id`, `size`, `checksum`) "
+        "VALUES (?,?,?,?,?,?,?)",
+        [(file_id, fragment['stripe'], fragment['idx'], fragment['name'], fragment.get('node_id'),
+          fragment.get('size'), fragment.get('checksum'))
+         for fragment in fragments]
+    )
+
+
+def get_fragments(db, file_id):
+    """
+    Returns the fragments of a file, ordered by stripe and index.
+
+    :param db: A sqlite3 connection
+    :param file_id: The ID of the file
+    :return: A list of dictionaries with the columns of the fragment table
+    """
+    cursor = db.execute("SELECT * FROM `fragment` WHERE `file_id`=? ORDER BY `stripe`, `idx`", [file_id])
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def set_fragment_node(db, file_id, name, node_id):
+    """
+    Record that a fragment is now stored on another node, e.g. after it was repaired.
+    The caller commits the transaction.
+    """
+    db.execute("UPDATE `fragment` SET `node_id`=? WHERE `file_id`=? AND `name`=?", [node_id, file_id, name])
+
+
+def delete_file(db, file_id):
+    """
+    Delete a file and its fragments. The caller commits the transaction.
+    """
+    db.execute("DELETE FROM `fragment` WHERE `file_id`=?", [file_id])
+    db.execute("DELETE FROM `file` WHERE `id`=?", [file_id])
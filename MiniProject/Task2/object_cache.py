@@ -0,0 +1,138 @@
+"""
+Cache of decoded files in the controller
+
+Popular files are kept in memory after they are decoded, so they are served without
+requesting and decoding their fragments again. Files are only cached when they are
+requested a second time and are at most OBJECT_CACHE_MAX_FILE bytes, so large files
+that are downloaded once do not push the popular ones out.
+
+A file is admitted to the cache when its download starts, and only cached once the
+download is done. Deleting the file in the meantime revokes the admission, so a
+download that was already running does not bring the deleted file back.
+"""
+import collections
+import os
+import threading
+
+# The memory budget of the cache in bytes, 0 to disable it
+OBJECT_CACHE_SIZE = int(os.environ.get('OBJECT_CACHE_SIZE', 256 * 1024 * 1024))
+# Larger files are never cached
+OBJECT_CACHE_MAX_FILE = int(os.environ.get('OBJECT_CACHE_MAX_FILE', 16 * 1024 * 1024))
+# The number of recently requested files whose request count is remembered
+ADMISSION_HISTORY = 4096
+
+
+class ObjectCache:
+    """
+    An LRU cache of file contents by file ID. Safe to use from several threads.
+    """
+
+    def __init__(self, budget=OBJECT_CACHE_SIZE, max_file=OBJECT_CACHE_MAX_FILE, history=ADMISSION_HISTORY):
+        """
+        :param budget: The memory budget in bytes, 0 to disable caching
+        :param max_file: The size of the largest file that is cached
+        :param history: The number of recently requested files that are remembered
+        """
+        self._budget = budget
+        self._max_file = min(max_file, budget)
+        self._history_size = history
+        self._lock = threading.Lock()
+        # File ID -> contents, from the least to the most recently used
+        self._files = collections.OrderedDict()
+        self._size = 0
+        # File ID -> number of requests, of the files that are not cached
+        self._history = collections.OrderedDict()
+        # File ID -> admission ticket, of the admitted files that are not cached yet.
+        # Invalidating a file drops its ticket, so the downloads that hold it do not cache it.
+        self._admitted = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, file_id):
+        """
+        :return: The contents of the file, or None if it is not cached
+        """
+        with self._lock:
+            data = self._files.get(file_id)
+            if data is not None:
+                self._files.move_to_end(file_id)
+                self.hits += 1
+                return data
+
+            self.misses += 1
+            self._history[file_id] = self._history.pop(file_id, 0) + 1
+            if len(self._history) > self._history_size:
+                self._history.popitem(last=False)
+            return None
+
+    def admits(self, file_id, size):
+        """
+        Whether a file that was not found in the cache should be cached once it is decoded.
+
+        :return: The admission ticket to pass to put, or None if the file is not cached
+        """
+        with self._lock:
+            if size > self._max_file or self._history.get(file_id, 0) < 2:
+                return None
+            # Concurrent downloads of the file share the ticket, the first one to finish caches it
+            ticket = self._admitted.get(file_id)
+            if ticket is None:
+                ticket = self._admitted[file_id] = object()
+                if len(self._admitted) > self._history_size:
+                    self._admitted.popitem(last=False)
+            return ticket
+
+    def put(self, file_id, data, ticket):
+        """
+        Cache a decoded file, unless it was invalidated since it was admitted.
+
+        :param ticket: The admission ticket of the file, see admits
+        """
+        data = bytes(data)
+        with self._lock:
+            if ticket is None or self._admitted.get(file_id) is not ticket:
+                return
+            del self._admitted[file_id]
+            self._remove(file_id)
+            self._history.pop(file_id, None)
+            self._files[file_id] = data
+            self._size += len(data)
+            while self._size > self._budget:
+                _, evicted = self._files.popitem(last=False)
+                self._size -= len(evicted)
+
+    def fill(self, file_id, stripes, ticket):
+        """
+        Pass the decoded stripes of a file through, and cache the file once all of them
+        are sent. Nothing is cached if the client disconnects before.
+
+        :param stripes: An iterator of the stripes of the whole file
+        :param ticket: The admission ticket of the file, see admits
+        :return: A generator of the stripes, as bytes
+        """
+        sent = []
+        for stripe_data in stripes:
+            stripe_data = bytes(stripe_data)
+            sent.append(stripe_data)
+            yield stripe_data
+        self.put(file_id, b''.join(sent), ticket)
+
+    def invalidate(self, file_id):
+        """
+        Remove a file from the cache, and keep the downloads in progress from caching it.
+        """
+        with self._lock:
+            self._admitted.pop(file_id, None)
+            self._remove(file_id)
+
+    def stats(self):
+        """
+        :return: A dictionary with the number of hits and misses, and the cached files and bytes
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "files": len(self._files), "bytes": self._size}
+
+    def _remove(self, file_id):
+        data = self._files.pop(file_id, None)
+        if data is not None:
+            self._size -= len(data)
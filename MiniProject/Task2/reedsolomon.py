@@ -1,70 +1,70 @@
 import time
 from time import sleep
 
-import kodo
 import math
 import random
-import copy  # for deepcopy
+import collections
+import concurrent.futures
+import zlib
 
 import zmq
 
-from utils import random_string, create_logger, get_connected_nodes, get_k_node_ips
+from utils import random_string, get_k_node_ips, STORAGE_NODES_NUM
 import messages_pb2
+import rs_codec
+import stripe_pool
+# The coding kernels, used here and by the stripe pool
+from rs_coding import get_coefficients, encode_file, decode_file
 import json
 
 import logging
 
-# Create custom loggers
-logger_encoding = create_logger("rs_encoding", "log_rs_en.log")
-logger_decoding = create_logger("rs_decoding", "log_rs_de.log")
+# Large files are split into stripes of this size, and every stripe is erasure coded
+# on its own. This way the controller never has to hold more than a few stripes in memory.
+STRIPE_SIZE = 1024 * 1024
 
-STORAGE_NODES_NUM = 4
+# How many stripes may be waiting for the storage nodes' acknowledgements at the same time.
+# Smaller stripes, e.g. of small files, count as the fraction of a full stripe they hold.
+MAX_STRIPES_IN_FLIGHT = 2
 
-RS_CAUCHY_COEFFS = [
-    bytearray([253, 126, 255, 127]),
-    bytearray([126, 253, 127, 255]),
-    bytearray([255, 127, 253, 126]),
-    bytearray([127, 255, 126, 253])
-]
+# How long to wait for the next coded fragment before giving up on the missing ones (ms)
+FRAGMENT_TIMEOUT = 1000
 
 
-def encode_file(file_data, max_erasures):
-    t1 = time.perf_counter()
-
-    # Make sure we can realize max_erasures with 4 storage nodes
-    assert (max_erasures >= 0)
-    assert (max_erasures < STORAGE_NODES_NUM)
-
-    # How many coded fragments (=symbols) will be required to reconstruct the encoded data.
-    symbols = STORAGE_NODES_NUM - max_erasures
-    # The size of one coded fragment (total size/number of symbols, rounded up)
-    symbol_size = math.ceil(len(file_data) / symbols)
-    # Kodo RLNC encoder using 2^8 finite field
-    encoder = kodo.block.Encoder(kodo.FiniteField.binary8)
-    encoder.configure(symbols, symbol_size)
-    encoder.set_symbols_storage(file_data)
-    symbol = bytearray(encoder.symbol_bytes)
+class NotEnoughFragmentsError(Exception):
+    """
+    Raised when fewer coded fragments of a stripe arrived than are needed to decode it.
+    """
 
-    encoded_fragments = []
 
-    # Generate one coded fragment for each Storage Node
-    for i in range(STORAGE_NODES_NUM):
-        # Select the next Reed Solomon coefficient vector
-        coefficients = RS_CAUCHY_COEFFS[i]
-        # Generate a coded fragment with these coefficients
-        # (trim the coeffs to the actual length we need)
-        encoder.encode_symbol(symbol, coefficients[:symbols])
+def get_coding_parameters(payload):
+    """
+    Parse the Reed Solomon parameters of an upload. Everything is a string in the
+    request parameters, so the numbers are converted manually. By default one fragment
+    is stored on each storage node, and the file survives losing one of them.
 
-        encoded_fragments.append(coefficients[:symbols] + bytearray(symbol))
+    :param payload: The request parameters (fragments, max_erasures, systematic)
+    :return: The number of coded fragments, max erasures, and whether the code is systematic
+    :raises ValueError: If the parameters are not valid, with a message for the client
+    """
+    n_fragments = int(payload.get('fragments', STORAGE_NODES_NUM))
+    max_erasures = int(payload.get('max_erasures', 1))
+    # Systematic mode stores the data as is in the first fragments, so healthy reads skip decoding
+    systematic = payload.get('systematic', 'false') == 'true'
 
-    t2 = time.perf_counter()
-    duration = t2-t1
-    logger_encoding.info(str(len(file_data)) + "," + str(max_erasures) + "," + str(duration))
+    # Every fragment must go to a different storage node, otherwise losing
+    # a node could erase more than one fragment
+    if n_fragments < 1 or n_fragments > STORAGE_NODES_NUM:
+        raise ValueError('fragments must be between 1 and the number of storage nodes (%d), please try again'
+                         % STORAGE_NODES_NUM)
+    if max_erasures < 0 or max_erasures >= n_fragments:
+        raise ValueError('max_erasures must be less than the number of fragments, please try again')
 
-    return encoded_fragments
+    return n_fragments, max_erasures, systematic
 
 
-def store_file(file_data, max_erasures, send_task_socket, response_socket):
+def store_file(file_data, max_erasures, send_task_socket, responses, systematic=False,
+               n_fragments=STORAGE_NODES_NUM):
     """
     Store a file using Reed Solomon erasure coding, protecting it against 'max_erasures'
     unavailable storage nodes.
@@ -74,105 +74,324 @@ def store_file(file_data, max_erasures, send_task_socket, response_socket):
     :param file_data: The file contents to be stored as a Python bytearray
     :param max_erasures: How many storage node failures should the data survive
     :param send_task_socket: A ZMQ PUSH socket to the storage nodes
-    :param response_socket: A ZMQ PULL socket where the storage nodes respond
-    :return: A list of the coded fragment names, e.g. (c1,c2,c3,c4)
+    :param responses: The response channel of the request (see dispatcher.py)
+    :param systematic: Store the first fragments as plain data slices, see get_coefficients
+    :param n_fragments: How many coded fragments to generate
+    :return: A list of the coded fragment names, e.g. (c1,c2,c3,c4), and a list of
+             the IDs of the storage nodes that store them
+    """
+
+    encoded_fragments = encode_file(file_data, max_erasures, systematic, n_fragments)
+    fragment_names = [fragment['name'] for fragment in send_fragments(encoded_fragments, send_task_socket,
+                                                                      responses)]
+
+    # Wait until we receive a response for every fragment
+    locations = wait_for_acks(fragment_names, responses)
+
+    return fragment_names, [locations[name] for name in fragment_names]
+
+
+def send_fragments(encoded_fragments, send_task_socket, responses):
     """
+    Send coded fragments to the storage nodes under newly generated random names.
 
-    encoded_fragments = encode_file(file_data,max_erasures)
-    fragment_names = [random_string(8) for _ in encoded_fragments]
+    :param encoded_fragments: The coded fragments, as returned by encode_file
+    :param send_task_socket: A ZMQ PUSH socket to the storage nodes
+    :param responses: The response channel of the request (see dispatcher.py)
+    :return: A list with the name, size and checksum of every fragment
+    """
+    fragments = []
+    messages = []
 
     # Generate one coded fragment for each Storage Node
-    for i, fragment in enumerate(encoded_fragments):
+    for fragment in encoded_fragments:
+        name = random_string(8)
 
-        # Send a Protobuf STORE DATA request to the Storage Nodes
+        # A Protobuf STORE DATA request to the Storage Nodes
         task = messages_pb2.storedata_request()
-        task.filename = fragment_names[i]
+        task.filename = name
+        task.request_id = responses.request_id
 
-        send_task_socket.send_multipart([
-            task.SerializeToString(),
-            fragment
-        ])
+        # The coefficients and the symbol data are sent as separate frames, without copying them
+        messages.append([task.SerializeToString()] + fragment)
 
-    # Wait until we receive a response for every fragment
-    for _ in encoded_fragments:
-        resp = response_socket.recv_string()
-        print('Received: %s' % resp)
+        fragments.append({
+            "name": name,
+            "size": sum(len(part) for part in fragment),
+            "checksum": fragment_checksum(fragment)
+        })
+
+    # Send all fragments at once, so the round-robin socket gives every node one of them.
+    # Fragments of other requests in between could put two of them on the same node.
+    responses.send_all(send_task_socket, messages, copy=False)
+    return fragments
+
+
+def fragment_checksum(fragment):
+    """
+    Returns the CRC32 checksum of a fragment as it is stored (the coefficients, then the symbol data).
+
+    :param fragment: The parts of the fragment, or the whole fragment as one bytes-like object
+    :return: The checksum as a hex string
+    """
+    if not isinstance(fragment, list):
+        fragment = [fragment]
+
+    crc = 0
+    for part in fragment:
+        crc = zlib.crc32(part, crc)
+    return '%08x' % crc
+
+
+def wait_for_acks(fragment_names, responses, acknowledged=None):
+    """
+    Block until the storage nodes have acknowledged storing the given fragments.
+
+    :param fragment_names: The names of the fragments to wait for
+    :param responses: The response channel of the request (see dispatcher.py)
+    :param acknowledged: A dictionary of the fragments that were acknowledged earlier than
+                         waited for, e.g. those of the next stripe. It is updated in place.
+    :return: A dictionary with the ID of the storage node that stores each fragment
+    """
+    if acknowledged is None:
+        acknowledged = {}
+
+    locations = {name: acknowledged.pop(name) for name in fragment_names if name in acknowledged}
+    while len(locations) < len(fragment_names):
+        resp = responses.recv_multipart()
+        if len(resp) != 2:
+            print('Discarded unexpected response')
+            continue
+
+        # The acknowledgement holds the fragment name and the ID of the node that stored it
+        name, node_id = resp[0].decode('utf-8'), resp[1].decode('utf-8')
+        print('Received: %s' % name)
+        if name in fragment_names:
+            locations[name] = node_id
+        else:
+            acknowledged[name] = node_id
+
+    return locations
+
+
+def read_stripe(stream, stripe_size):
+    """
+    Read the next stripe from a file-like object. Short reads are retried until
+    the stripe is full or the stream is exhausted.
+
+    :param stream: A file-like object, e.g. the incoming request body
+    :param stripe_size: The number of bytes to read
+    :return: The stripe as a bytearray, which is shorter than stripe_size (or empty) at the end of the stream
+    """
+    stripe = bytearray(stripe_size)
+    view = memoryview(stripe)
+    filled = 0
+    while filled < stripe_size:
+        chunk = stream.read(stripe_size - filled)
+        if not chunk:
+            break
+        view[filled:filled + len(chunk)] = chunk
+        filled += len(chunk)
+    view.release()
+
+    # Drop the unused tail of the last stripe
+    del stripe[filled:]
+    return stripe
+
+
+def store_file_stream(stream, max_erasures, send_task_socket, responses, stripe_size=STRIPE_SIZE,
+                      systematic=False, n_fragments=STORAGE_NODES_NUM):
+    """
+    Store a file of arbitrary size using Reed Solomon erasure coding, reading it from
+    a stream one stripe at a time. The stripes are encoded in parallel on the stripe pool
+    and sent to the storage nodes in order while the next ones are being read, but no
+    more than MAX_STRIPES_IN_FLIGHT stripes are waiting for acknowledgements at any time,
+    which bounds the memory use.
+
+    :param stream: A file-like object with the file contents
+    :param max_erasures: How many storage node failures should the data survive
+    :param send_task_socket: A ZMQ PUSH socket to the storage nodes
+    :param responses: The response channel of the request (see dispatcher.py)
+    :param stripe_size: The size of the stripes the file is split into
+    :param systematic: Store the first fragments as plain data slices, see get_coefficients
+    :param n_fragments: How many coded fragments to generate for each stripe
+    :return: A list with the stripe, index, name, storage node ID, size and checksum of
+             every coded fragment (see metadata.py), and the total file size
+    """
+    return store_files_stream([stream], max_erasures, send_task_socket, responses, stripe_size,
+                              systematic, n_fragments)[0]
+
+
+def store_files_stream(streams, max_erasures, send_task_socket, responses, stripe_size=STRIPE_SIZE,
+                       systematic=False, n_fragments=STORAGE_NODES_NUM):
+    """
+    Store several files one after the other, see store_file_stream. The files share one
+    pipeline: the stripes of the next file are encoded and sent while the storage nodes
+    are still storing the previous ones, so small files do not wait for each other's
+    acknowledgements. The stripes in flight are limited to MAX_STRIPES_IN_FLIGHT full
+    stripes worth of bytes, which lets many small files be in flight at the same time.
+
+    :param streams: A list of file-like objects with the file contents
+    :return: A list with the fragments and the size of every file, see store_file_stream
+    """
+    # The fragments of each stripe of every file
+    stripes = [[] for _ in streams]
+    sizes = [0] * len(streams)
+    # The file index, size and Future of the stripes that are being encoded
+    encoding = collections.deque()
+    # The fragments and size of each stripe that is not yet acknowledged
+    in_flight = collections.deque()
+    in_flight_bytes = 0
+    # Fragments of later stripes that were acknowledged while waiting for an earlier one
+    acknowledged = {}
+
+    def send_next_stripe():
+        nonlocal in_flight_bytes
+        file_idx, size, future = encoding.popleft()
+        fragments = send_fragments(future.result(), send_task_socket, responses)
+        for idx, fragment in enumerate(fragments):
+            fragment.update(stripe=len(stripes[file_idx]), idx=idx)
+        stripes[file_idx].append(fragments)
+        in_flight.append((fragments, size))
+        in_flight_bytes += size
+
+        # Throttle the reader until the oldest stripes are stored
+        while in_flight_bytes > MAX_STRIPES_IN_FLIGHT * stripe_size:
+            fragments, size = in_flight.popleft()
+            set_locations(fragments, responses, acknowledged)
+            in_flight_bytes -= size
+
+    for file_idx, stream in enumerate(streams):
+        while True:
+            stripe_data = read_stripe(stream, stripe_size)
+            if not stripe_data:
+                break
+            sizes[file_idx] += len(stripe_data)
+            encoding.append((file_idx, len(stripe_data),
+                             stripe_pool.submit_encode(stripe_data, max_erasures, systematic, n_fragments)))
+
+            # Keep every worker busy, and send the oldest stripe once it is encoded
+            while len(encoding) > stripe_pool.workers():
+                send_next_stripe()
+
+    while encoding:
+        send_next_stripe()
+    while in_flight:
+        set_locations(in_flight.popleft()[0], responses, acknowledged)
+
+    return [([fragment for fragments in file_stripes for fragment in fragments], size)
+            for file_stripes, size in zip(stripes, sizes)]
+
+
+def set_locations(fragments, responses, acknowledged):
+    """
+    Wait for the acknowledgements of a stripe (see wait_for_acks), and record
+    the ID of the storage node that stores each fragment.
+    """
+    locations = wait_for_acks([fragment['name'] for fragment in fragments], responses, acknowledged)
+    for fragment in fragments:
+        fragment['node_id'] = locations[fragment['name']]
+
+
+def get_stripes(storage_details, file_size, fragments):
+    """
+    List the stripes of a stored file. Files that were stored in one piece
+    are treated as a single stripe.
+
+    :param storage_details: The storage details of the file from the database
+    :param file_size: The original data size
+    :param fragments: The fragments of the file, ordered by stripe and index (see metadata.get_fragments)
+    :return: A list of (coded fragment names, stripe size, storage node IDs) tuples.
+             A node ID is None if the location of the fragment is not known.
+    """
+    stripe_size = storage_details.get('stripe_size', file_size)
+
+    stripes = []
+    for fragment in fragments:
+        if fragment['stripe'] == len(stripes):
+            stripes.append(([], min(stripe_size, file_size - fragment['stripe'] * stripe_size), []))
+        stripes[-1][0].append(fragment['name'])
+        stripes[-1][2].append(fragment['node_id'])
 
-    return fragment_names
+    return stripes
 
 
-def store_file_delegate(data, max_erasures, heartbeat_socket, response_socket, context):
+def store_file_delegate(data, max_erasures, membership, responses, peers, systematic=False,
+                        n_fragments=STORAGE_NODES_NUM):
     # Delegate storage
     ips = get_k_node_ips(STORAGE_NODES_NUM)
     print("Delegating encoding to", ips[0])
 
-    encode_socket = context.socket(zmq.REQ)
     addr = "tcp://" + ips[0] + ':5542'
-    encode_socket.connect(addr)
-
-    encode_socket.send_pyobj({
-        "data": data,
-        "ips": ips[1:],
-        "max_erasures": max_erasures,
-        "n_nodes": STORAGE_NODES_NUM
-    })
+    try:
+        # Reuse a connection to the delegate from the pool
+        with peers.connection(addr) as encode_socket:
+            encode_socket.send_pyobj({
+                "data": data,
+                "ips": ips[1:],
+                "max_erasures": max_erasures,
+                "n_nodes": n_fragments,
+                "systematic": systematic
+            })
 
-    result = encode_socket.recv_pyobj()
+            result = encode_socket.recv_pyobj()
+    except zmq.Again:
+        print("No response from", ips[0])
+        return None
     return result['names']
 
 
-def decode_file(symbols, max_erasures):
+def join_data_fragments(symbols, coded_fragments, symbols_num):
     """
-    Decode a file using Reed Solomon decoder and the provided coded symbols.
-    The number of symbols must be the same as STORAGE_NODES_NUM - max_erasures.
+    Rebuild systematically coded data by concatenating its data fragments, without decoding.
 
-    :param symbols: coded symbols that contain both the coefficients and symbol data
-    :return: the decoded file data
+    :param symbols: The received coded symbols, with their chunk names
+    :param coded_fragments: Names of all coded fragments, in the order they were encoded
+    :param symbols_num: How many symbols the data was split into
+    :return: The data (including padding), or None if a data fragment is missing
     """
-    t1 = time.perf_counter()
-
-    # Reconstruct the original data with a decoder
-    symbols_num = len(symbols)
-    symbol_size = len(symbols[0]['data']) - symbols_num  # subtract the coefficients' size
-    decoder = kodo.block.Decoder(kodo.FiniteField.binary8)
-    decoder.configure(symbols_num, symbol_size)
-    data_out = bytearray(decoder.block_bytes)
-    decoder.set_symbols_storage(data_out)
-
+    data_fragments = [None] * symbols_num
     for symbol in symbols:
-        # Separate the coefficients from the symbol data
-        coefficients = symbol['data'][:symbols_num]
-        symbol_data = symbol['data'][symbols_num:]
-        # Feed it to the decoder
-        decoder.decode_symbol(symbol_data, coefficients)
-
-    # Make sure the decoder successfully reconstructed the file
-    assert (decoder.is_complete())
+        if symbol['chunkname'] not in coded_fragments:
+            continue
+        index = coded_fragments.index(symbol['chunkname'])
+        if index < symbols_num:
+            data_fragments[index] = symbol['data']
 
-    t2 = time.perf_counter()
-    duration = t2-t1
-    logger_decoding.info(str(len(data_out)) + "," + str(max_erasures) + "," + str(duration))
+    if any(fragment is None for fragment in data_fragments):
+        return None
 
-    print("File decoded successfully")
+    data_out = bytearray()
+    for fragment in data_fragments:
+        # Skip the coefficients
+        data_out += memoryview(fragment)[symbols_num:]
 
+    print("Data fragments joined without decoding")
     return data_out
 
 
-def get_file(coded_fragments, max_erasures, file_size,
-             data_req_socket, heartbeat_req_socket, response_socket):
+def get_file(stripes, max_erasures,
+             data_req_socket, membership, responses, start=0, stop=None, systematic=False):
     """
-    Implements retrieving a file that is stored with Reed Solomon erasure coding
+    Implements retrieving a file that is stored with Reed Solomon erasure coding.
+    The file is not rebuilt in memory: the returned generator fetches and decodes
+    one stripe at a time, so it can be streamed to the client as it is decoded.
+    When only a byte range is requested, only the stripes covering it are fetched.
 
-    :param coded_fragments: Names of the coded fragments
+    :param stripes: The (coded fragment names, stripe size, storage node IDs) of the file's stripes, see get_stripes
     :param max_erasures: Max erasures setting that was used when storing the file
-    :param file_size: The original data size. 
-    :param data_req_socket: A ZMQ SUB socket to request chunks from the storage nodes
-    :param response_socket: A ZMQ PULL socket where the storage nodes respond.
-    :return: A list of the random generated chunk names, e.g. (c1,c2), (c3,c4)
+    :param data_req_socket: A ZMQ PUB socket to request chunks from the storage nodes
+    :param membership: The Membership of the cluster, to check that enough nodes are alive
+    :param responses: The response channel of the request (see dispatcher.py)
+    :param start: The first byte of the requested range
+    :param stop: The end of the requested range (exclusive), or None for the end of the file
+    :param systematic: Whether the file was stored in systematic mode
+    :return: A generator yielding the original file contents stripe by stripe,
+             or an error message if the file cannot be retrieved. The generator raises
+             NotEnoughFragmentsError if too few fragments of a stripe arrive.
     """
-    nodes_needed = STORAGE_NODES_NUM - max_erasures
-    connected_nodes = get_connected_nodes(heartbeat_req_socket, response_socket, STORAGE_NODES_NUM)
-    fragnames = copy.deepcopy(coded_fragments)
+    nodes_needed = len(stripes[0][0]) - max_erasures if stripes else 0
+    connected_nodes = membership.connected_nodes()
 
     # if > max_erasures nodes are dead
     if len(connected_nodes) < nodes_needed:
@@ -180,39 +399,187 @@ def get_file(coded_fragments, max_erasures, file_size,
         print(msg)
         return msg
 
+    return iter_stripes(stripes, max_erasures, data_req_socket, responses, start, stop, systematic)
+
+
+def iter_stripes(stripes, max_erasures, data_req_socket, responses, start=0, stop=None, systematic=False):
+    """
+    Generator that retrieves and decodes the stripes overlapping the byte range
+    [start, stop) in order, trimming the first and last one to the range. The next
+    stripes are fetched while the previous ones are decoded on the stripe pool, so
+    only about as many stripes as there are workers are held in memory.
+    """
+    # Futures of the stripes being decoded, with their position in the file
+    decoding = collections.deque()
+
+    stripe_start = 0
+    for coded_fragments, stripe_size, locations in stripes:
+        stripe_stop = stripe_start + stripe_size
+        if stop is not None and stripe_start >= stop:
+            break
+
+        if stripe_stop > start:
+            symbols = fetch_fragments(coded_fragments, data_req_socket, responses,
+                                      len(coded_fragments) - max_erasures, locations)
+            future = decode_stripe(symbols, coded_fragments, max_erasures, systematic)
+            decoding.append((future, stripe_start, stripe_size))
+
+            while len(decoding) > stripe_pool.workers():
+                yield trim_stripe(*decoding.popleft(), start, stop)
+
+        stripe_start = stripe_stop
+
+    while decoding:
+        yield trim_stripe(*decoding.popleft(), start, stop)
+
+
+def trim_stripe(future, stripe_start, stripe_size, start, stop):
+    """
+    Wait for a decoded stripe and cut the padding and everything outside the range [start, stop) in place.
+    """
+    stripe_data = future.result()
+    del stripe_data[stripe_size:]
+
+    if stop is not None and stop < stripe_start + stripe_size:
+        del stripe_data[stop - stripe_start:]
+    if start > stripe_start:
+        del stripe_data[:start - stripe_start]
+
+    return stripe_data
+
+
+def fetch_fragments(coded_fragments, data_req_socket, responses, needed=None, locations=None):
+    """
+    Request the coded fragments of a stripe from the storage nodes. All fragments are
+    requested, but only the first 'needed' ones to arrive are waited for, so a slow or
+    dead node does not delay the read. The responses of the remaining nodes arrive later;
+    they are discarded when the next stripe is fetched, or by the dispatcher once the request is over.
+
+    Every fragment is only requested from the storage node that stores it. Fragments with
+    an unknown location are requested from all nodes, and so are the missing ones if not
+    enough fragments arrive (e.g. because a fragment was repaired onto another node).
+
+    :param coded_fragments: Names of the coded fragments of the stripe
+    :param data_req_socket: A ZMQ PUB socket to request chunks from the storage nodes
+    :param responses: The response channel of the request (see dispatcher.py)
+    :param needed: How many fragments to wait for, all of them by default
+    :param locations: IDs of the storage nodes that store the fragments, None if not known
+    :return: The received coded symbols
+    """
+    pending = set(coded_fragments)
+    if needed is None:
+        needed = len(pending)
+    if locations is None:
+        locations = [None] * len(coded_fragments)
+
     # Request the coded fragments in parallel
-    for name in fragnames:
-        task = messages_pb2.getdata_request()
-        task.filename = name
-        data_req_socket.send(
-            task.SerializeToString()
-        )
+    for name, node_id in zip(coded_fragments, locations):
+        request_fragment(name, node_id, data_req_socket, responses)
+    symbols = receive_fragments(pending, needed, responses)
 
-    # Receive all chunks and insert them into the symbols array
+    # Fall back to asking every node for the fragments that were not where they should be
+    if len(symbols) < needed and any(locations):
+        print("Fragments not found on their storage nodes, asking all nodes")
+        for name in coded_fragments:
+            if name in pending:
+                request_fragment(name, None, data_req_socket, responses)
+        symbols += receive_fragments(pending, needed - len(symbols), responses)
+
+    print("%d of %d coded fragments received" % (len(symbols), len(coded_fragments)))
+
+    return symbols
+
+
+def request_fragment(name, node_id, data_req_socket, responses):
+    """
+    Send a Protobuf GET DATA request for a coded fragment to the storage node with the
+    given ID, or to all storage nodes if node_id is None.
+    """
+    task = messages_pb2.getdata_request()
+    task.filename = name
+    task.request_id = responses.request_id
+
+    # The nodes subscribe to their own ID and to 'all_nodes'
+    topic = node_id.encode('utf-8') if node_id else b"all_nodes"
+    responses.send(data_req_socket, [topic, task.SerializeToString()])
+
+
+def receive_fragments(pending, needed, responses):
+    """
+    Receive requested coded fragments, until 'needed' of them have arrived or
+    no more arrive within FRAGMENT_TIMEOUT.
+
+    :param pending: Names of the fragments that were requested but not yet received.
+                    The received ones are removed from it.
+    :param needed: How many fragments to wait for
+    :param responses: The response channel of the request (see dispatcher.py)
+    :return: The received coded symbols
+    """
     symbols = []
-    for _ in range(len(fragnames)):
-        if (response_socket.poll(1000) & zmq.POLLIN) != 0:
-            result = response_socket.recv_multipart()
-            # In this case we don't care about the received name, just use the
-            # data from the second frame
-            symbols.append({
-                "chunkname": result[0].decode('utf-8'),
-                "data": bytearray(result[1])
-            })
-    print("All coded fragments received successfully")
+    while len(symbols) < needed and (responses.poll(FRAGMENT_TIMEOUT) & zmq.POLLIN) != 0:
+        result = responses.recv_multipart(copy=False)
+        # Skip anything but the requested fragments, e.g. late responses for the previous stripe
+        name = result[0].bytes.decode('utf-8', 'replace')
+        if len(result) != 2 or name not in pending:
+            print("Discarded unexpected response")
+            continue
+        pending.remove(name)
+
+        # Use the data from the second frame, without copying it out of the message
+        symbols.append({
+            "chunkname": name,
+            "data": result[1].buffer
+        })
 
-    # Reconstruct the original file data
-    file_data = decode_file(symbols[:nodes_needed], max_erasures)
+    return symbols
 
-    return file_data[:file_size]
+
+def decode_stripe(symbols, coded_fragments, max_erasures, systematic=False, blocking=True):
+    """
+    Decode a single stripe of a file on the stripe pool. In systematic mode the
+    stripe is only decoded if some of its data fragments are unavailable.
+
+    :param symbols: The received coded symbols of the stripe
+    :param coded_fragments: Names of the coded fragments of the stripe
+    :param max_erasures: Max erasures setting that was used when storing the file
+    :param systematic: Whether the file was stored in systematic mode
+    :param blocking: Whether a small stripe may be decoded in the caller, see stripe_pool.submit_decode
+    :return: A Future of the stripe data, including the padding
+    :raises NotEnoughFragmentsError: If fewer symbols than the data was split into arrived
+    """
+    nodes_needed = len(coded_fragments) - max_erasures
+    check_fragments(symbols, nodes_needed)
+
+    if systematic:
+        stripe_data = join_data_fragments(symbols, coded_fragments, nodes_needed)
+        if stripe_data is not None:
+            future = concurrent.futures.Future()
+            future.set_result(stripe_data)
+            return future
+
+    # Reconstruct the original stripe data
+    return stripe_pool.submit_decode(symbols[:nodes_needed], max_erasures, blocking)
+
+
+def check_fragments(symbols, needed):
+    """
+    Make sure enough coded fragments arrived to decode a stripe. Decoding fewer
+    symbols than the data was split into does not fail, but returns wrong data.
+
+    :param symbols: The received coded symbols of the stripe
+    :param needed: How many symbols the data was split into
+    :raises NotEnoughFragmentsError: If fewer symbols arrived
+    """
+    if len(symbols) < needed:
+        raise NotEnoughFragmentsError("Only %d of the %d coded fragments needed to decode the file arrived"
+                                      % (len(symbols), needed))
 
 
 def get_file_delegate(coded_fragments, max_erasures, file_size,
-             data_req_socket, heartbeat_req_socket, response_socket, context):
+             data_req_socket, membership, responses, peers, systematic=False):
 
-    nodes_needed = STORAGE_NODES_NUM - max_erasures
-    fragnames = copy.deepcopy(coded_fragments)
-    connected_nodes = get_connected_nodes(heartbeat_req_socket, response_socket, STORAGE_NODES_NUM)
+    nodes_needed = len(coded_fragments) - max_erasures
+    connected_nodes = membership.connected_nodes()
 
     # if > max_erasures nodes are dead
     if len(connected_nodes) < nodes_needed:
@@ -220,48 +587,51 @@ def get_file_delegate(coded_fragments, max_erasures, file_size,
         print(msg)
         return msg
 
-    # Request the coded fragments in parallel
-    for name in fragnames:
-        task = messages_pb2.getdata_request()
-        task.filename = name
-        data_req_socket.send(
-            task.SerializeToString()
-        )
+    symbols = fetch_fragments(coded_fragments, data_req_socket, responses, nodes_needed)
+    try:
+        check_fragments(symbols, nodes_needed)
+    except NotEnoughFragmentsError as e:
+        print(e)
+        return str(e)
 
-    # Receive all chunks and insert them into the symbols array
-    symbols = []
-    for _ in range(len(fragnames)):
-        if (response_socket.poll(1000) & zmq.POLLIN) != 0:
-            result = response_socket.recv_multipart()
-            # In this case we don't care about the received name, just use the
-            # data from the second frame
-            symbols.append({
-                "chunkname": result[0].decode('utf-8'),
-                "data": bytearray(result[1])
-            })
-    print("All coded fragments received successfully")
+    # Nothing to decode if all data fragments of a systematic file arrived
+    if systematic:
+        file_data = join_data_fragments(symbols, coded_fragments, nodes_needed)
+        if file_data is not None:
+            return file_data[:file_size]
 
     rand_ip = random.choice(connected_nodes)
     print("Delegating decoding to", rand_ip)
     connected_nodes.remove(rand_ip)
 
-    decode_socket = context.socket(zmq.REQ)
     addr = "tcp://" + rand_ip + ':5543'
-    decode_socket.connect(addr)
+    try:
+        # Reuse a connection to the decoding node from the pool
+        with peers.connection(addr) as decode_socket:
+            decode_socket.send_pyobj({
+                # The received frames are copied into bytes, so they can be pickled
+                "data": [{"chunkname": symbol['chunkname'], "data": bytes(symbol['data'])}
+                         for symbol in symbols[:nodes_needed]],
+                "size": file_size,
+                "max_erasures": max_erasures
+            })
 
-    decode_socket.send_pyobj({
-        "data": symbols[:nodes_needed],
-        "size": file_size,
-        "max_erasures": max_erasures
-    })
+            file_data = decode_socket.recv()
+    except zmq.Again:
+        msg = "No response from the decoding node %s" % rand_ip
+        print(msg)
+        return msg
 
-    result = decode_socket.recv()
-    file_data = result
+    # The decoding node replies with nothing if decoding failed
+    if not file_data:
+        msg = "Decoding failed on node %s" % rand_ip
+        print(msg)
+        return msg
 
     return file_data[:file_size]
 
 
-def get_file_for_repair(fragments_to_retrieve, file_size,
+def get_file_for_repair(fragments_to_retrieve, max_erasures, file_size,
                         repair_socket, repair_response_socket):
     """
     Implements retrieving a file that is stored with Reed Solomon erasure coding for use
@@ -269,6 +639,7 @@ def get_file_for_repair(fragments_to_retrieve, file_size,
     implementation is similar to how a file is retrieved using get_file.
 
     :param fragments_to_retrieve: Names of the coded fragments that should be retrieved
+    :param max_erasures: Max erasures setting that was used when storing the file
     :param file_size: The original data size. 
     :param data_req_socket: A ZMQ SUB socket to request chunks from the storage nodes
     :param response_socket: A ZMQ PULL socket where the storage nodes respond.
@@ -288,17 +659,17 @@ def get_file_for_repair(fragments_to_retrieve, file_size,
     # Receive all chunks and insert them into the symbols array
     symbols = []
     for _ in range(len(fragments_to_retrieve)):
-        result = repair_response_socket.recv_multipart()
-        # In this case we don't care about the received name, just use the 
-        # data from the second frame
+        result = repair_response_socket.recv_multipart(copy=False)
+        # In this case we don't care about the received name, just use the
+        # data from the second frame, without copying it out of the message
         symbols.append({
-            "chunkname": result[0].decode('utf-8'),
-            "data": bytearray(result[1])
+            "chunkname": result[0].bytes.decode('utf-8'),
+            "data": result[1].buffer
         })
     print(str(len(fragments_to_retrieve)) + " coded fragments received successfully")
 
     # Reconstruct the original file data
-    file_data = decode_file(symbols)
+    file_data = decode_file(symbols, max_erasures)
 
     return file_data[:file_size]  # Reconstruct the original data with a decoder
 
@@ -311,16 +682,18 @@ def start_repair_process(files, repair_socket, repair_response_socket):
     fragment, it determines which Storage node was supposed to store it and repairs it.
     This happens by first retrieving the original file data, then re-encoding the missing
     fragment. It also handles multiple missing fragments for a file, as long as their
-    number does not exceed `max_erasures`.
+    number does not exceed `max_erasures`. Striped files are repaired stripe by stripe.
 
-    :param files: List of files to be checked
+    :param files: List of files to be checked, with their fragments (see metadata.get_fragments)
     :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
     :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
-    :return: the number of missing fragments, the number of repaired fragments
+    :return: the number of missing fragments, the number of repaired fragments, and
+             a list of (file ID, fragment name, new storage node ID) of the repaired fragments
     """
 
     number_of_missing_fragments = 0
     number_of_repaired_fragments = 0
+    relocated_fragments = []
 
     # Check that each file is actually stored on the storage nodes
     for file in files:
@@ -328,102 +701,173 @@ def start_repair_process(files, repair_socket, repair_response_socket):
         # We parse the JSON into a python dictionary
         storage_details = json.loads(file["storage_details"])
 
-        # Iterate over each coded fragment to check that it is not missing
-        nodes = set()  # list of all storage nodes
-        nodes_with_fragment = set()  # list of storage nodes with fragments
-        coded_fragments = storage_details["coded_fragments"]  # list of all coded fragments
-        missing_fragments = []  # list of missing coded fragments
-        existing_fragments = []  # list of existing coded fragments
-        for fragment in coded_fragments:
-            task = messages_pb2.fragment_status_request()
-            task.fragment_name = fragment
-            header = messages_pb2.header()
-            header.request_type = messages_pb2.FRAGMENT_STATUS_REQ
-
-            repair_socket.send_multipart([b"all_nodes",
-                                          header.SerializeToString(),
-                                          task.SerializeToString()])
-
-            fragment_found = False
-            # Wait until we receive a response from each node
-            for task_nbr in range(STORAGE_NODES_NUM):
-                msg = repair_response_socket.recv()
-                response = messages_pb2.fragment_status_response()
-                response.ParseFromString(msg)
-
-                nodes.add(response.node_id)  # Build a set of nodes
-                if response.is_present == True:
-                    nodes_with_fragment.add(response.node_id)
-                    existing_fragments.append(fragment)
-                    fragment_found = True
-
-            if fragment_found == False:
-                print("Fragment %s lost" % fragment)
-                missing_fragments.append(fragment)
-                number_of_missing_fragments += 1
-            else:
-                print("Fragment %s OK" % fragment)
-
-        # If we have lost fragments, we must figure out where they were stored
-        # We assume that each node has exactly 1 or 0 fragments
-        nodes_without_fragment = list(nodes.difference(nodes_with_fragment))
-
-        # Perform the actual repair, if necessary
-        if len(missing_fragments) > 0:
-            # Check that enough fragments still remain to be able to repair
-            if len(missing_fragments) > storage_details["max_erasures"]:
-                print("Too many lost fragments: %s. Unable to repair file. " % len(missing_fragments))
-                continue
-
-            # Retrieve sufficient fragments and decode
-            symbols = STORAGE_NODES_NUM - storage_details["max_erasures"]
-            file_data = get_file_for_repair(existing_fragments[:symbols],  # only as many as necessary
-                                            file["size"],
-                                            repair_socket,
-                                            repair_response_socket
-                                            )
-
-            # Build the encoder
-            # How many coded fragments (=symbols) will be required to reconstruct the encoded data. 
-            symbols = STORAGE_NODES_NUM - storage_details["max_erasures"]
-            # The size of one coded fragment (total size/number of symbols, rounded up)
-            symbol_size = math.ceil(len(file_data) / symbols)
-            # Kodo RLNC encoder using 2^8 finite field
-            encoder = kodo.block.Encoder(kodo.FiniteField.binary8)
-            encoder.configure(symbols, symbol_size)
-            encoder.set_symbols_storage(file_data)
-            symbol = bytearray(encoder.symbol_bytes)
-
-            # Re-encode each missing fragment: 
-            for missing_fragment in missing_fragments:
-                fragment_index = coded_fragments.index(missing_fragment)
-                # Select the appropriate Reed Solomon coefficient vector
-                coefficients = RS_CAUCHY_COEFFS[fragment_index]
-                # Generate a coded fragment with these coefficients
-                # (trim the coeffs to the actual length we need)
-                encoder.encode_symbol(symbol, coefficients[:symbols])
-
-                # Save with the same name as before
-                # Send a Protobuf STORE DATA request to the Storage Nodes
-                task = messages_pb2.storedata_request()
-                task.filename = missing_fragment
-
-                header = messages_pb2.header()
-                header.request_type = messages_pb2.STORE_FRAGMENT_DATA_REQ
-
-                node_id = nodes_without_fragment[number_of_repaired_fragments]
-
-                # Use the node_id as the topic
-                repair_socket.send_multipart([node_id.encode('UTF-8'),
-                                              header.SerializeToString(),
-                                              task.SerializeToString(),
-                                              coefficients[:symbols] + bytearray(symbol)
-                                              ])
-                number_of_repaired_fragments += 1
-
-            # Wait until we receive a response for every fragment
-            for task_nbr in range(len(missing_fragments)):
-                resp = repair_response_socket.recv_string()
-                print('Repaired fragment: %s' % resp)
-
-    return number_of_missing_fragments, number_of_repaired_fragments
+        for coded_fragments, stripe_size, _ in get_stripes(storage_details, file["size"], file["fragments"]):
+            missing, repaired = repair_stripe(coded_fragments, storage_details["max_erasures"], stripe_size,
+                                              repair_socket, repair_response_socket,
+                                              storage_details.get("systematic", False))
+            number_of_missing_fragments += missing
+            number_of_repaired_fragments += len(repaired)
+            relocated_fragments += [(file["id"], name, node_id) for name, node_id in repaired.items()]
+
+    return number_of_missing_fragments, number_of_repaired_fragments, relocated_fragments
+
+
+def encode_missing_fragments(file_data, coded_fragments, missing_fragments, max_erasures, systematic=False):
+    """
+    Re-encode lost coded fragments of a stripe from its decoded data.
+
+    :param file_data: The decoded stripe data
+    :param coded_fragments: Names of all coded fragments of the stripe, in the order they were encoded
+    :param missing_fragments: Names of the fragments to re-encode
+    :param max_erasures: Max erasures setting that was used when storing the file
+    :param systematic: Whether the file was stored in systematic mode
+    :return: The coefficient vectors and the coded symbols of the missing fragments
+    """
+    # How many coded fragments (=symbols) will be required to reconstruct the encoded data. 
+    symbols = len(coded_fragments) - max_erasures
+    # The size of one coded fragment (total size/number of symbols, rounded up)
+    symbol_size = math.ceil(len(file_data) / symbols)
+
+    # Select the appropriate Reed Solomon coefficient vectors
+    # (trimmed to the actual length we need)
+    coefficients = [get_coefficients(coded_fragments.index(missing_fragment), symbols, systematic)
+                    for missing_fragment in missing_fragments]
+    # Generate the coded fragments with these coefficients
+    coded_symbols = rs_codec.get_codec().encode(file_data, symbols, symbol_size, coefficients)
+
+    return coefficients, coded_symbols
+
+
+def repair_stripe(coded_fragments, max_erasures, stripe_size, repair_socket, repair_response_socket,
+                  systematic=False):
+    """
+    Check that every coded fragment of a stripe is stored, and re-encode the missing ones.
+
+    :param coded_fragments: Names of the coded fragments of the stripe
+    :param max_erasures: Max erasures setting that was used when storing the file
+    :param stripe_size: The original size of the stripe
+    :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
+    :param repair_response_socket: A ZMQ PULL socket on which the storage nodes respond.
+    :param systematic: Whether the file was stored in systematic mode
+    :return: the number of missing fragments, and the ID of the storage node of each repaired fragment
+    """
+    repaired_fragments = {}
+
+    # Iterate over each coded fragment to check that it is not missing
+    nodes = set()  # list of all storage nodes
+    nodes_with_fragment = set()  # list of storage nodes with fragments
+    missing_fragments = []  # list of missing coded fragments
+    existing_fragments = []  # list of existing coded fragments
+    for fragment in coded_fragments:
+        task = messages_pb2.fragment_status_request()
+        task.fragment_name = fragment
+        header = messages_pb2.header()
+        header.request_type = messages_pb2.FRAGMENT_STATUS_REQ
+
+        repair_socket.send_multipart([b"all_nodes",
+                                      header.SerializeToString(),
+                                      task.SerializeToString()])
+
+        fragment_found = False
+        # Wait until we receive a response from each node
+        for task_nbr in range(STORAGE_NODES_NUM):
+            msg = repair_response_socket.recv()
+            response = messages_pb2.fragment_status_response()
+            response.ParseFromString(msg)
+
+            nodes.add(response.node_id)  # Build a set of nodes
+            if response.is_present == True:
+                nodes_with_fragment.add(response.node_id)
+                existing_fragments.append(fragment)
+                fragment_found = True
+
+        if fragment_found == False:
+            print("Fragment %s lost" % fragment)
+            missing_fragments.append(fragment)
+        else:
+            print("Fragment %s OK" % fragment)
+
+    # If we have lost fragments, we must figure out where they were stored
+    # We assume that each node has exactly 1 or 0 fragments
+    nodes_without_fragment = list(nodes.difference(nodes_with_fragment))
+
+    # Perform the actual repair, if necessary
+    if len(missing_fragments) == 0:
+        return 0, repaired_fragments
+
+    # Check that enough fragments still remain to be able to repair
+    if len(missing_fragments) > max_erasures:
+        print("Too many lost fragments: %s. Unable to repair file. " % len(missing_fragments))
+        return len(missing_fragments), repaired_fragments
+
+    # Retrieve sufficient fragments and decode
+    symbols = len(coded_fragments) - max_erasures
+    file_data = get_file_for_repair(existing_fragments[:symbols],  # only as many as necessary
+                                    max_erasures,
+                                    stripe_size,
+                                    repair_socket,
+                                    repair_response_socket
+                                    )
+
+    coefficients, coded_symbols = encode_missing_fragments(file_data, coded_fragments, missing_fragments,
+                                                           max_erasures, systematic)
+
+    # Re-encode each missing fragment: 
+    for i, missing_fragment in enumerate(missing_fragments):
+        # Save with the same name as before
+        # Send a Protobuf STORE DATA request to the Storage Nodes
+        task = messages_pb2.storedata_request()
+        task.filename = missing_fragment
+
+        header = messages_pb2.header()
+        header.request_type = messages_pb2.STORE_FRAGMENT_DATA_REQ
+
+        node_id = nodes_without_fragment[len(repaired_fragments)]
+
+        # Use the node_id as the topic
+        repair_socket.send_multipart([node_id.encode('UTF-8'),
+                                      header.SerializeToString(),
+                                      task.SerializeToString(),
+                                      coefficients[i],
+                                      coded_symbols[i]
+                                      ], copy=False)
+        repaired_fragments[missing_fragment] = node_id
+
+    # Wait until we receive a response for every fragment
+    for task_nbr in range(len(missing_fragments)):
+        resp = repair_response_socket.recv_string()
+        print('Repaired fragment: %s' % resp)
+
+    return len(missing_fragments), repaired_fragments
+
+
+def delete_file(fragments, repair_socket):
+    """
+    Ask the storage nodes to delete the coded fragments of a file. The nodes do not respond,
+    fragments that are not deleted (e.g. because their node is offline) are left behind.
+    The repair socket is shared with the repair process, so the caller must hold its lock.
+
+    :param fragments: The fragment records of the file
+    :param repair_socket: A ZMQ PUB socket to send requests to the storage nodes
+    """
+    for frames in delete_requests(fragments):
+        repair_socket.send_multipart(frames)
+
+
+def delete_requests(fragments):
+    """
+    Returns the messages that delete the given fragments, one per storage node.
+    Fragments with an unknown location are deleted from all nodes.
+    """
+    by_node = collections.defaultdict(list)
+    for fragment in fragments:
+        by_node[fragment['node_id'] or 'all_nodes'].append(fragment['name'])
+
+    header = messages_pb2.header()
+    header.request_type = messages_pb2.DELETE_FRAGMENT_REQ
+    requests = []
+    for node_id, names in by_node.items():
+        task = messages_pb2.delete_fragment_request()
+        task.fragment_names.extend(names)
+        requests.append([node_id.encode('utf-8'), header.SerializeToString(), task.SerializeToString()])
+    return requests
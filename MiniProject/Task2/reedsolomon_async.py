@@ -0,0 +1,519 @@
+"""
+Reed Solomon erasure coding for the asyncio controller (rest-server-async.py)
+
+The same store, get and repair operations as in reedsolomon.py, as coroutines on
+zmq.asyncio sockets and AsyncResponseChannels (see dispatcher.py). While a request
+waits for the storage nodes, the event loop serves the other requests. Encoding
+and decoding still run on the stripe pool; its futures are awaited instead of
+blocking on them.
+"""
+import asyncio
+import collections
+import json
+import random
+
+import zmq
+
+import messages_pb2
+import stripe_pool
+from reedsolomon import (FRAGMENT_TIMEOUT, MAX_STRIPES_IN_FLIGHT, STORAGE_NODES_NUM, STRIPE_SIZE,
+                         NotEnoughFragmentsError, check_fragments, decode_stripe, delete_requests,
+                         encode_missing_fragments, fragment_checksum, get_stripes, join_data_fragments,
+                         trim_stripe)
+from utils import random_string, get_k_node_ips
+
+
+async def read_stripes(chunks, stripe_size=STRIPE_SIZE):
+    """
+    Async generator that collects the chunks of a stream into stripes.
+
+    :param chunks: An async iterable of bytes-like chunks, e.g. the incoming request body
+    :param stripe_size: The size of the stripes
+    :return: The stripes as bytearrays, the last one may be shorter
+    """
+    stripe = bytearray()
+    async for chunk in chunks:
+        chunk = memoryview(chunk)
+        while len(stripe) + len(chunk) >= stripe_size:
+            taken = stripe_size - len(stripe)
+            stripe += chunk[:taken]
+            chunk = chunk[taken:]
+            yield stripe
+            stripe = bytearray()
+        stripe += chunk
+
+    if stripe:
+        yield stripe
+
+
+async def store_file_stream(chunks, max_erasures, send_task_socket, responses, stripe_size=STRIPE_SIZE,
+                            systematic=False, n_fragments=STORAGE_NODES_NUM):
+    """
+    Store a file of arbitrary size one stripe at a time, see reedsolomon.store_file_stream.
+
+    :param chunks: An async iterable with the file contents
+    :param max_erasures: How many storage node failures should the data survive
+    :param send_task_socket: A zmq.asyncio PUSH socket to the storage nodes
+    :param responses: The AsyncResponseChannel of the request
+    :param stripe_size: The size of the stripes the file is split into
+    :param systematic: Store the first fragments as plain data slices, see reedsolomon.get_coefficients
+    :param n_fragments: How many coded fragments to generate for each stripe
+    :return: A list with the stripe, index, name, storage node ID, size and checksum of
+             every coded fragment (see metadata.py), and the total file size
+    """
+    return (await store_files_stream([chunks], max_erasures, send_task_socket, responses, stripe_size,
+                                     systematic, n_fragments))[0]
+
+
+async def store_files_stream(files, max_erasures, send_task_socket, responses, stripe_size=STRIPE_SIZE,
+                             systematic=False, n_fragments=STORAGE_NODES_NUM):
+    """
+    Store several files in one pipeline, see reedsolomon.store_files_stream.
+
+    :param files: A list of async iterables with the file contents
+    :return: A list with the fragments and the size of every file, see store_file_stream
+    """
+    stripes = [[] for _ in files]
+    sizes = [0] * len(files)
+    encoding = collections.deque()
+    in_flight = collections.deque()
+    in_flight_bytes = 0
+    acknowledged = {}
+
+    async def send_next_stripe():
+        nonlocal in_flight_bytes
+        file_idx, size, future = encoding.popleft()
+        fragments = await send_fragments(await future, send_task_socket, responses)
+        for idx, fragment in enumerate(fragments):
+            fragment.update(stripe=len(stripes[file_idx]), idx=idx)
+        stripes[file_idx].append(fragments)
+        in_flight.append((fragments, size))
+        in_flight_bytes += size
+
+        # Throttle the reader until the oldest stripes are stored
+        while in_flight_bytes > MAX_STRIPES_IN_FLIGHT * stripe_size:
+            fragments, size = in_flight.popleft()
+            await set_locations(fragments, responses, acknowledged)
+            in_flight_bytes -= size
+
+    for file_idx, chunks in enumerate(files):
+        async for stripe_data in read_stripes(chunks, stripe_size):
+            sizes[file_idx] += len(stripe_data)
+            encoding.append((file_idx, len(stripe_data), asyncio.wrap_future(
+                stripe_pool.submit_encode(stripe_data, max_erasures, systematic, n_fragments, blocking=False))))
+
+            # Keep every worker busy, and send the oldest stripe once it is encoded
+            while len(encoding) > stripe_pool.workers():
+                await send_next_stripe()
+
+    while encoding:
+        await send_next_stripe()
+    while in_flight:
+        await set_locations(in_flight.popleft()[0], responses, acknowledged)
+
+    return [([fragment for fragments in file_stripes for fragment in fragments], size)
+            for file_stripes, size in zip(stripes, sizes)]
+
+
+async def send_fragments(encoded_fragments, send_task_socket, responses):
+    """
+    Send coded fragments to the storage nodes under newly generated random names,
+    see reedsolomon.send_fragments.
+    """
+    fragments = []
+    messages = []
+
+    for fragment in encoded_fragments:
+        name = random_string(8)
+
+        task = messages_pb2.storedata_request()
+        task.filename = name
+        task.request_id = responses.request_id
+        messages.append([task.SerializeToString()] + fragment)
+
+        fragments.append({
+            "name": name,
+            "size": sum(len(part) for part in fragment),
+            "checksum": fragment_checksum(fragment)
+        })
+
+    await responses.send_all(send_task_socket, messages, copy=False)
+    return fragments
+
+
+async def wait_for_acks(fragment_names, responses, acknowledged=None):
+    """
+    Wait until the storage nodes have acknowledged storing the given fragments,
+    see reedsolomon.wait_for_acks.
+    """
+    if acknowledged is None:
+        acknowledged = {}
+
+    locations = {name: acknowledged.pop(name) for name in fragment_names if name in acknowledged}
+    while len(locations) < len(fragment_names):
+        resp = await responses.recv_multipart()
+        if len(resp) != 2:
+            print('Discarded unexpected response')
+            continue
+
+        name, node_id = resp[0].decode('utf-8'), resp[1].decode('utf-8')
+        print('Received: %s' % name)
+        if name in fragment_names:
+            locations[name] = node_id
+        else:
+            acknowledged[name] = node_id
+
+    return locations
+
+
+async def set_locations(fragments, responses, acknowledged):
+    """
+    Wait for the acknowledgements of a stripe, and record the ID of the storage node that stores each fragment.
+    """
+    locations = await wait_for_acks([fragment['name'] for fragment in fragments], responses, acknowledged)
+    for fragment in fragments:
+        fragment['node_id'] = locations[fragment['name']]
+
+
+def get_file(stripes, max_erasures, data_req_socket, membership, responses, start=0, stop=None, systematic=False):
+    """
+    Retrieve a file stored with Reed Solomon erasure coding, see reedsolomon.get_file.
+
+    :return: An async generator yielding the original file contents stripe by stripe,
+             or an error message if the file cannot be retrieved. The generator raises
+             NotEnoughFragmentsError if too few fragments of a stripe arrive.
+    """
+    nodes_needed = len(stripes[0][0]) - max_erasures if stripes else 0
+
+    # if > max_erasures nodes are dead
+    if len(membership.connected_nodes()) < nodes_needed:
+        msg = "Not enough nodes online to fetch file"
+        print(msg)
+        return msg
+
+    return iter_stripes(stripes, max_erasures, data_req_socket, responses, start, stop, systematic)
+
+
+async def iter_stripes(stripes, max_erasures, data_req_socket, responses, start=0, stop=None, systematic=False):
+    """
+    Async generator that retrieves and decodes the stripes overlapping the byte range
+    [start, stop) in order, see reedsolomon.iter_stripes.
+    """
+    decoding = collections.deque()
+
+    stripe_start = 0
+    for coded_fragments, stripe_size, locations in stripes:
+        stripe_stop = stripe_start + stripe_size
+        if stop is not None and stripe_start >= stop:
+            break
+
+        if stripe_stop > start:
+            symbols = await fetch_fragments(coded_fragments, data_req_socket, responses,
+                                            len(coded_fragments) - max_erasures, locations)
+            future = asyncio.wrap_future(decode_stripe(symbols, coded_fragments, max_erasures, systematic,
+                                                       blocking=False))
+            decoding.append((future, stripe_start, stripe_size))
+
+            while len(decoding) > stripe_pool.workers():
+                yield await trim_decoded_stripe(*decoding.popleft(), start, stop)
+
+        stripe_start = stripe_stop
+
+    while decoding:
+        yield await trim_decoded_stripe(*decoding.popleft(), start, stop)
+
+
+async def trim_decoded_stripe(future, stripe_start, stripe_size, start, stop):
+    """
+    Wait for a decoded stripe without blocking the event loop, then trim it (see reedsolomon.trim_stripe).
+    """
+    await future
+    return trim_stripe(future, stripe_start, stripe_size, start, stop)
+
+
+async def fetch_fragments(coded_fragments, data_req_socket, responses, needed=None, locations=None):
+    """
+    Request the coded fragments of a stripe from the storage nodes and wait for
+    the first 'needed' ones, see reedsolomon.fetch_fragments.
+    """
+    pending = set(coded_fragments)
+    if needed is None:
+        needed = len(pending)
+    if locations is None:
+        locations = [None] * len(coded_fragments)
+
+    for name, node_id in zip(coded_fragments, locations):
+        await request_fragment(name, node_id, data_req_socket, responses)
+    symbols = await receive_fragments(pending, needed, responses)
+
+    # Fall back to asking every node for the fragments that were not where they should be
+    if len(symbols) < needed and any(locations):
+        print("Fragments not found on their storage nodes, asking all nodes")
+        for name in coded_fragments:
+            if name in pending:
+                await request_fragment(name, None, data_req_socket, responses)
+        symbols += await receive_fragments(pending, needed - len(symbols), responses)
+
+    print("%d of %d coded fragments received" % (len(symbols), len(coded_fragments)))
+
+    return symbols
+
+
+async def request_fragment(name, node_id, data_req_socket, responses):
+    """
+    Send a GET DATA request for a coded fragment, see reedsolomon.request_fragment.
+    """
+    task = messages_pb2.getdata_request()
+    task.filename = name
+    task.request_id = responses.request_id
+
+    topic = node_id.encode('utf-8') if node_id else b"all_nodes"
+    await responses.send(data_req_socket, [topic, task.SerializeToString()])
+
+
+async def receive_fragments(pending, needed, responses):
+    """
+    Receive requested coded fragments, until 'needed' of them have arrived or
+    no more arrive within FRAGMENT_TIMEOUT, see reedsolomon.receive_fragments.
+    """
+    symbols = []
+    while len(symbols) < needed and (await responses.poll(FRAGMENT_TIMEOUT) & zmq.POLLIN) != 0:
+        result = await responses.recv_multipart(copy=False)
+        name = result[0].bytes.decode('utf-8', 'replace')
+        if len(result) != 2 or name not in pending:
+            print("Discarded unexpected response")
+            continue
+        pending.remove(name)
+
+        symbols.append({
+            "chunkname": name,
+            "data": result[1].buffer
+        })
+
+    return symbols
+
+
+async def store_file_delegate(data, max_erasures, membership, responses, peers, systematic=False,
+                              n_fragments=STORAGE_NODES_NUM):
+    """
+    Delegate encoding and storing a file to a random node, see reedsolomon.store_file_delegate.
+    The ConnectionPool must be created with a zmq.asyncio Context.
+    """
+    ips = get_k_node_ips(STORAGE_NODES_NUM)
+    print("Delegating encoding to", ips[0])
+
+    addr = "tcp://" + ips[0] + ':5542'
+    try:
+        with peers.connection(addr) as encode_socket:
+            await encode_socket.send_pyobj({
+                "data": data,
+                "ips": ips[1:],
+                "max_erasures": max_erasures,
+                "n_nodes": n_fragments,
+                "systematic": systematic
+            })
+
+            result = await encode_socket.recv_pyobj()
+    except zmq.Again:
+        print("No response from", ips[0])
+        return None
+    return result['names']
+
+
+async def get_file_delegate(coded_fragments, max_erasures, file_size,
+                            data_req_socket, membership, responses, peers, systematic=False):
+    """
+    Fetch the fragments of a file and delegate decoding to a random node, see reedsolomon.get_file_delegate.
+    The ConnectionPool must be created with a zmq.asyncio Context.
+    """
+    nodes_needed = len(coded_fragments) - max_erasures
+    connected_nodes = membership.connected_nodes()
+
+    if len(connected_nodes) < nodes_needed:
+        msg = "Not enough nodes online to fetch file"
+        print(msg)
+        return msg
+
+    symbols = await fetch_fragments(coded_fragments, data_req_socket, responses, nodes_needed)
+    try:
+        check_fragments(symbols, nodes_needed)
+    except NotEnoughFragmentsError as e:
+        print(e)
+        return str(e)
+
+    if systematic:
+        file_data = join_data_fragments(symbols, coded_fragments, nodes_needed)
+        if file_data is not None:
+            return file_data[:file_size]
+
+    rand_ip = random.choice(connected_nodes)
+    print("Delegating decoding to", rand_ip)
+
+    addr = "tcp://" + rand_ip + ':5543'
+    try:
+        with peers.connection(addr) as decode_socket:
+            await decode_socket.send_pyobj({
+                "data": [{"chunkname": symbol['chunkname'], "data": bytes(symbol['data'])}
+                         for symbol in symbols[:nodes_needed]],
+                "size": file_size,
+                "max_erasures": max_erasures
+            })
+
+            file_data = await decode_socket.recv()
+    except zmq.Again:
+        msg = "No response from the decoding node %s" % rand_ip
+        print(msg)
+        return msg
+
+    # The decoding node replies with nothing if decoding failed
+    if not file_data:
+        msg = "Decoding failed on node %s" % rand_ip
+        print(msg)
+        return msg
+
+    return file_data[:file_size]
+
+
+async def start_repair_process(files, repair_socket, repair_response_socket):
+    """
+    Check every fragment of the given files and repair the missing ones,
+    see reedsolomon.start_repair_process.
+
+    The repair responses carry no request ID, so only one repair may run at a time.
+    """
+    number_of_missing_fragments = 0
+    number_of_repaired_fragments = 0
+    relocated_fragments = []
+
+    for file in files:
+        print("Checking file with id: %s" % file["id"])
+        storage_details = json.loads(file["storage_details"])
+
+        for coded_fragments, stripe_size, _ in get_stripes(storage_details, file["size"], file["fragments"]):
+            missing, repaired = await repair_stripe(coded_fragments, storage_details["max_erasures"], stripe_size,
+                                                    repair_socket, repair_response_socket,
+                                                    storage_details.get("systematic", False))
+            number_of_missing_fragments += missing
+            number_of_repaired_fragments += len(repaired)
+            relocated_fragments += [(file["id"], name, node_id) for name, node_id in repaired.items()]
+
+    return number_of_missing_fragments, number_of_repaired_fragments, relocated_fragments
+
+
+async def repair_stripe(coded_fragments, max_erasures, stripe_size, repair_socket, repair_response_socket,
+                        systematic=False):
+    """
+    Check that every coded fragment of a stripe is stored, and re-encode the missing ones,
+    see reedsolomon.repair_stripe.
+    """
+    repaired_fragments = {}
+
+    nodes = set()
+    nodes_with_fragment = set()
+    missing_fragments = []
+    existing_fragments = []
+    for fragment in coded_fragments:
+        task = messages_pb2.fragment_status_request()
+        task.fragment_name = fragment
+        header = messages_pb2.header()
+        header.request_type = messages_pb2.FRAGMENT_STATUS_REQ
+
+        await repair_socket.send_multipart([b"all_nodes",
+                                            header.SerializeToString(),
+                                            task.SerializeToString()])
+
+        fragment_found = False
+        for task_nbr in range(STORAGE_NODES_NUM):
+            msg = await repair_response_socket.recv()
+            response = messages_pb2.fragment_status_response()
+            response.ParseFromString(msg)
+
+            nodes.add(response.node_id)
+            if response.is_present:
+                nodes_with_fragment.add(response.node_id)
+                existing_fragments.append(fragment)
+                fragment_found = True
+
+        if not fragment_found:
+            print("Fragment %s lost" % fragment)
+            missing_fragments.append(fragment)
+        else:
+            print("Fragment %s OK" % fragment)
+
+    nodes_without_fragment = list(nodes.difference(nodes_with_fragment))
+
+    if len(missing_fragments) == 0:
+        return 0, repaired_fragments
+
+    if len(missing_fragments) > max_erasures:
+        print("Too many lost fragments: %s. Unable to repair file. " % len(missing_fragments))
+        return len(missing_fragments), repaired_fragments
+
+    symbols = len(coded_fragments) - max_erasures
+    file_data = await get_file_for_repair(existing_fragments[:symbols], max_erasures, stripe_size,
+                                          repair_socket, repair_response_socket)
+
+    # Encode on a thread, without blocking the event loop
+    coefficients, coded_symbols = await asyncio.get_running_loop().run_in_executor(
+        None, encode_missing_fragments, file_data, coded_fragments, missing_fragments, max_erasures, systematic)
+
+    for i, missing_fragment in enumerate(missing_fragments):
+        task = messages_pb2.storedata_request()
+        task.filename = missing_fragment
+
+        header = messages_pb2.header()
+        header.request_type = messages_pb2.STORE_FRAGMENT_DATA_REQ
+
+        node_id = nodes_without_fragment[len(repaired_fragments)]
+
+        await repair_socket.send_multipart([node_id.encode('UTF-8'),
+                                            header.SerializeToString(),
+                                            task.SerializeToString(),
+                                            coefficients[i],
+                                            coded_symbols[i]
+                                            ], copy=False)
+        repaired_fragments[missing_fragment] = node_id
+
+    for task_nbr in range(len(missing_fragments)):
+        resp = await repair_response_socket.recv_string()
+        print('Repaired fragment: %s' % resp)
+
+    return len(missing_fragments), repaired_fragments
+
+
+async def get_file_for_repair(fragments_to_retrieve, max_erasures, file_size,
+                              repair_socket, repair_response_socket):
+    """
+    Retrieve and decode a stripe for the repair process, see reedsolomon.get_file_for_repair.
+    """
+    for name in fragments_to_retrieve:
+        task = messages_pb2.getdata_request()
+        task.filename = name
+        header = messages_pb2.header()
+        header.request_type = messages_pb2.FRAGMENT_DATA_REQ
+        await repair_socket.send_multipart([b"all_nodes",
+                                            header.SerializeToString(),
+                                            task.SerializeToString()])
+
+    symbols = []
+    for _ in range(len(fragments_to_retrieve)):
+        result = await repair_response_socket.recv_multipart(copy=False)
+        symbols.append({
+            "chunkname": result[0].bytes.decode('utf-8'),
+            "data": result[1].buffer
+        })
+    print(str(len(fragments_to_retrieve)) + " coded fragments received successfully")
+
+    # Decode on the stripe pool, without blocking the event loop
+    file_data = await asyncio.wrap_future(stripe_pool.submit_decode(symbols, max_erasures, blocking=False))
+
+    return file_data[:file_size]
+
+
+async def delete_file(fragments, repair_socket):
+    """
+    Ask the storage nodes to delete the coded fragments of a file, see reedsolomon.delete_file.
+    The caller must hold the repair lock.
+    """
+    for frames in delete_requests(fragments):
+        await repair_socket.send_multipart(frames)
@@ -0,0 +1,593 @@
+"""
+Aarhus University - Distributed Storage course - Lab 6
+
+REST API + Controller, asyncio version
+
+The same endpoints as rest-server.py, served by Quart on the Hypercorn ASGI server.
+Every request is a coroutine, and all communication with the storage nodes goes
+through zmq.asyncio sockets (see reedsolomon_async.py), so a request that waits for
+a slow storage node does not hold up any other request. Heartbeats and response
+routing run as tasks on the same event loop.
+"""
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+
+import zmq
+import zmq.asyncio
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+from quart import Quart, Response, make_response, g, request
+
+import metadata
+import reedsolomon_async
+import stripe_pool
+from connection_pool import ConnectionPool
+from dispatcher import AsyncResponseDispatcher
+from membership import AsyncMembership
+from object_cache import ObjectCache
+from reedsolomon import STRIPE_SIZE, NotEnoughFragmentsError, get_coding_parameters, get_stripes
+from single_flight import AsyncSingleFlight
+from utils import is_raspberry_pi, is_docker, create_logger, get_file_validators, get_requested_range
+
+logger_full_redun = create_logger("rs_full_redun", "log_rs_full_redun.log")
+logger_lead_node = create_logger("rs_lead_node", "log_rs_lead_node.log")
+
+
+def get_db():
+    if 'db' not in g:
+        g.db = sqlite3.connect(
+            'files.db',
+            detect_types=sqlite3.PARSE_DECLTYPES
+        )
+        g.db.row_factory = sqlite3.Row
+
+    return g.db
+
+
+# A coroutine, so Quart closes the connection on the event loop thread that opened it
+async def close_db(e=None):
+    db = g.pop('db', None)
+
+    if db is not None:
+        db.close()
+
+
+# Fork the coding worker processes before ZMQ starts its I/O threads
+stripe_pool.start_pool()
+
+context = zmq.asyncio.Context()
+
+# The decoded contents of popular files
+object_cache = ObjectCache()
+# Concurrent downloads of the same file share the fragments requests and the decoding
+downloads = AsyncSingleFlight()
+
+# Instantiate the Quart app (must be before the endpoint functions)
+app = Quart(__name__)
+# Uploads are streamed to the storage nodes, so their size is not limited
+app.config['MAX_CONTENT_LENGTH'] = None
+
+# Stop Hypercorn from logging every request
+logging.getLogger('hypercorn.access').setLevel(logging.ERROR)
+
+# Close the DB connection after serving the request
+app.teardown_appcontext(close_db)
+
+
+@app.before_serving
+async def start_controller():
+    """
+    Bind the ZMQ sockets and start the background tasks, on the event loop that serves the requests.
+    """
+    global send_task_socket, data_req_socket, repair_socket, repair_response_socket
+    global dispatcher, membership, peers, repair_lock
+
+    # Socket to send tasks to Storage Nodes
+    send_task_socket = context.socket(zmq.PUSH)
+    send_task_socket.bind("tcp://*:5557")
+
+    # Socket to receive messages from Storage Nodes
+    response_socket = context.socket(zmq.PULL)
+    response_socket.bind("tcp://*:5558")
+
+    # Publisher socket for data request broadcasts
+    data_req_socket = context.socket(zmq.PUB)
+    data_req_socket.bind("tcp://*:5559")
+
+    # Publisher socket for fragment repair broadcasts
+    repair_socket = context.socket(zmq.PUB)
+    repair_socket.bind("tcp://*:5560")
+
+    # Socket to receive repair messages from Storage Nodes
+    repair_response_socket = context.socket(zmq.PULL)
+    repair_response_socket.bind("tcp://*:5561")
+
+    heartbeat_socket = context.socket(zmq.PUB)
+    heartbeat_socket.bind("tcp://*:5562")
+
+    # Socket to receive heartbeat responses from Storage Nodes
+    heartbeat_response_socket = context.socket(zmq.PULL)
+    heartbeat_response_socket.bind("tcp://*:5563")
+
+    # Route the responses of the storage nodes to the requests waiting for them
+    dispatcher = AsyncResponseDispatcher(response_socket)
+    app.add_background_task(dispatcher.run)
+
+    # Heartbeat the storage nodes in the background, so requests know the live nodes without waiting
+    membership = AsyncMembership(heartbeat_socket, heartbeat_response_socket)
+    app.add_background_task(membership.run)
+
+    # Connections to the storage nodes that encode or decode delegated (type 2) files
+    peers = ConnectionPool(context)
+
+    # The repair responses carry no request ID, so repairs run one at a time,
+    # and deletes wait for them to use the repair socket
+    repair_lock = asyncio.Lock()
+
+    # Create the fragment table, and move the fragments of older files into it
+    async with app.app_context():
+        metadata.init_db(get_db())
+
+    # Wait for all workers to start and connect.
+    await asyncio.sleep(1)
+    print("Listening to ZMQ messages on tcp://*:5558 and tcp://*:5561")
+
+
+@app.route('/')
+async def hello():
+    return await make_response({'message': 'Hello World!'})
+
+
+@app.route('/files', methods=['GET'])
+async def list_files():
+    db = get_db()
+    cursor = db.execute("SELECT * FROM `file`")
+    if not cursor:
+        return await make_response({"message": "Error connecting to the database"}, 500)
+
+    files = [dict(file) for file in cursor.fetchall()]
+
+    return await make_response({"files": files})
+
+
+@app.route('/files/<int:file_id>', methods=['GET'])
+async def download_file(file_id):
+    file_data = None
+
+    db = get_db()
+    cursor = db.execute("SELECT * FROM `file` WHERE `id`=?", [file_id])
+    if not cursor:
+        return await make_response({"message": "Error connecting to the database"}, 500)
+
+    f = cursor.fetchone()
+    if not f:
+        return await make_response({"message": "File {} not found".format(file_id)}, 404)
+
+    # Convert to a Python dictionary
+    f = dict(f)
+    print("File requested: {}".format(f['filename']))
+
+    # Serve only a part of the file if the client asks for a byte range
+    etag, last_modified = get_file_validators(f)
+    byte_range = get_requested_range(request, f['size'], etag, last_modified)
+    if byte_range is False:
+        response = await make_response('Requested range not satisfiable', 416)
+        response.headers['Content-Range'] = 'bytes */%d' % f['size']
+        return response
+    start, stop = byte_range or (0, f['size'])
+
+    # Popular files are served from memory, without fetching and decoding them
+    cached = object_cache.get(file_id)
+    if cached is not None:
+        response = Response(cached[start:stop], mimetype=f['content_type'])
+        return set_download_headers(response, f, byte_range, start, stop, etag, last_modified)
+    cache_ticket = object_cache.admits(file_id, f['size'])
+
+    storage_details = json.loads(f['storage_details'])
+    fragments = metadata.get_fragments(db, file_id)
+
+    if f['storage_mode'] == 'erasure_coding_rs':
+
+        max_erasures = storage_details['max_erasures']
+        type = storage_details['type']
+        systematic = storage_details.get('systematic', False)
+
+        if type == 1:
+
+            def start_download():
+                # The responses of the storage nodes, until the whole file is sent
+                responses = dispatcher.open_channel()
+                stripes = reedsolomon_async.get_file(
+                    get_stripes(storage_details, f['size'], fragments),
+                    max_erasures,
+                    data_req_socket,
+                    membership,
+                    responses,
+                    start,
+                    stop,
+                    systematic
+                )
+                if not isinstance(stripes, str):
+                    # Stream the stripes to the client as soon as they are decoded,
+                    # and cache the file once all of them are sent
+                    stripes = close_when_done(stripes, responses, cache_ticket if byte_range is None else None, file_id)
+                return stripes, responses.close
+
+            # Concurrent requests for the same bytes of the file share one download
+            file_data = downloads.stream((file_id, start, stop), start_download)
+            if not isinstance(file_data, str):
+                try:
+                    file_data = await start_streaming(file_data)
+                except NotEnoughFragmentsError as e:
+                    return await make_response(str(e), 404)
+        elif type == 2:
+
+            async def fetch_file():
+                responses = dispatcher.open_channel()
+                try:
+                    return await reedsolomon_async.get_file_delegate(
+                        [fragment['name'] for fragment in fragments],
+                        max_erasures,
+                        f['size'],
+                        data_req_socket,
+                        membership,
+                        responses,
+                        peers,
+                        systematic
+                    )
+                finally:
+                    responses.close()
+
+            file_data = await downloads.do(file_id, fetch_file)
+            if isinstance(file_data, (bytes, bytearray)):
+                if cache_ticket is not None:
+                    object_cache.put(file_id, file_data, cache_ticket)
+                file_data = file_data[start:stop]
+
+    if file_data is None:
+        return await make_response('Something went wrong, please try again', 404)
+
+    if isinstance(file_data, str):
+        return await make_response(file_data, 404)
+
+    response = Response(file_data, mimetype=f['content_type'])
+    return set_download_headers(response, f, byte_range, start, stop, etag, last_modified)
+
+
+async def start_streaming(stripes):
+    """
+    Fetch and decode the first stripe before the response headers are sent, see
+    start_streaming in rest-server.py.
+
+    :param stripes: An async generator of the stripes
+    :return: An async generator of all the stripes
+    :raises NotEnoughFragmentsError: If the first stripe cannot be decoded
+    """
+    try:
+        first = await stripes.__anext__()
+    except StopAsyncIteration:
+        first = None
+
+    async def all_stripes():
+        try:
+            if first is not None:
+                yield first
+                async for stripe_data in stripes:
+                    yield stripe_data
+        finally:
+            await stripes.aclose()
+
+    return all_stripes()
+
+
+def set_download_headers(response, f, byte_range, start, stop, etag, last_modified):
+    """
+    Set the length, validator and range headers of a file download.
+    """
+    response.content_length = stop - start
+    response.accept_ranges = 'bytes'
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    if byte_range:
+        response.status_code = 206
+        response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, f['size'])
+
+    return response
+
+
+async def close_when_done(stripes, responses, cache_ticket=None, file_id=None):
+    """
+    Pass the decoded stripes on, and close the response channel once they are sent
+    or the client disconnects.
+
+    :param cache_ticket: The admission ticket of the file to cache once all the stripes
+                         are sent (see ObjectCache.admits), or None
+    :param file_id: The ID of the file to cache
+    """
+    sent = []
+    try:
+        async for stripe_data in stripes:
+            if cache_ticket is not None:
+                sent.append(bytes(stripe_data))
+            yield stripe_data
+    finally:
+        responses.close()
+    if cache_ticket is not None:
+        object_cache.put(file_id, b''.join(sent), cache_ticket)
+
+
+# HTTP HEAD requests are served by the GET endpoint of the same URL,
+# so we'll introduce a new endpoint URL for requesting file metadata.
+@app.route('/files/<int:file_id>/info', methods=['GET'])
+async def get_file_metadata(file_id):
+    db = get_db()
+    cursor = db.execute("SELECT * FROM `file` WHERE `id`=?", [file_id])
+    if not cursor:
+        return await make_response({"message": "Error connecting to the database"}, 500)
+
+    f = cursor.fetchone()
+    if not f:
+        return await make_response({"message": "File {} not found".format(file_id)}, 404)
+
+    return await make_response(dict(f))
+
+
+@app.route('/files/<int:file_id>', methods=['DELETE'])
+async def delete_file(file_id):
+    db = get_db()
+    cursor = db.execute("SELECT * FROM `file` WHERE `id`=?", [file_id])
+    if not cursor:
+        return await make_response({"message": "Error connecting to the database"}, 500)
+
+    f = cursor.fetchone()
+    if not f:
+        return await make_response({"message": "File {} not found".format(file_id)}, 404)
+
+    f = dict(f)
+    print("File to delete: %s" % f)
+
+    # Delete all chunks from the Storage Nodes
+    async with repair_lock:
+        await reedsolomon_async.delete_file(metadata.get_fragments(db, file_id), repair_socket)
+
+    # Delete the file record from the DB
+    metadata.delete_file(db, file_id)
+    db.commit()
+    object_cache.invalidate(file_id)
+
+    return await make_response('', 200)
+
+
+@app.route('/files_mp', methods=['POST'])
+async def add_files_multipart():
+    t1 = time.perf_counter()
+
+    # Quart separates files from the other form fields
+    payload = await request.form
+    files = await request.files
+
+    # Make sure there is a file in the request
+    if not files or not files.get('file'):
+        logging.error("No file was uploaded in the request!")
+        return await make_response("File missing!", 400)
+
+    # Reference to the file under 'file' key
+    file = files.get('file')
+    filename = file.filename
+    content_type = file.mimetype
+    print("File received: %s, type: %s" % (filename, content_type))
+
+    storage_mode = payload.get('storage', 'erasure_coding_rs')
+    print("Storage mode: %s" % storage_mode)
+
+    if storage_mode != 'erasure_coding_rs':
+        logging.error("Unexpected storage mode: %s" % storage_mode)
+        return await make_response("Wrong storage mode", 400)
+
+    return await store_file(read_chunks(file.stream), filename, content_type, payload, t1)
+
+
+async def read_chunks(stream, chunk_size=STRIPE_SIZE):
+    """
+    Read an uploaded file that was already received (e.g. a multipart form field) in chunks.
+    """
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+# Uploads the raw request body instead of a multipart form. The body is erasure coded
+# stripe by stripe while it is still arriving, so files of any size can be stored.
+@app.route('/files_stream', methods=['POST'])
+async def add_files_stream():
+    t1 = time.perf_counter()
+
+    payload = request.args
+    filename = payload.get('filename', 'unnamed')
+    content_type = request.mimetype or 'application/octet-stream'
+    print("File received: %s, type: %s" % (filename, content_type))
+
+    return await store_file(request.body, filename, content_type, payload, t1)
+
+
+async def store_file(chunks, filename, content_type, payload, t1):
+    """
+    Store an uploaded file with Reed Solomon erasure coding and insert its record in the DB,
+    see store_file in rest-server.py.
+
+    :param chunks: An async iterable with the file contents
+    """
+    storage_mode = 'erasure_coding_rs'
+    measure_redundancy = payload.get('measure_redundancy', 'false')
+
+    try:
+        n_fragments, max_erasures, systematic = get_coding_parameters(payload)
+    except ValueError as e:
+        return await make_response(str(e), 400)
+    type = int(payload.get('type', 1))
+
+    print("Fragments: %d, max erasures: %d, code rate: %.2f"
+          % (n_fragments, max_erasures, (n_fragments - max_erasures) / n_fragments))
+    storage_details = None
+    if type == 1:
+        # Store the file contents with Reed Solomon erasure coding, one stripe at a time
+        with dispatcher.open_channel() as responses:
+            fragments, size = await reedsolomon_async.store_file_stream(chunks, max_erasures, send_task_socket,
+                                                                        responses, systematic=systematic,
+                                                                        n_fragments=n_fragments)
+        if measure_redundancy == 'true':
+            t_full_redun = time.perf_counter()
+        # The fragments themselves are stored in the fragment table
+        storage_details = {
+            "stripe_size": STRIPE_SIZE,
+            "max_erasures": max_erasures,
+            "systematic": systematic,
+            "type": type
+        }
+    elif type == 2:
+        # The delegate encodes the whole file, so it has to be loaded into memory
+        data = bytearray()
+        async for chunk in chunks:
+            data += chunk
+        size = len(data)
+
+        # Store the file, delegating encoding to random node
+        with dispatcher.open_channel() as responses:
+            fragment_names = await reedsolomon_async.store_file_delegate(data, max_erasures, membership,
+                                                                         responses, peers, systematic, n_fragments)
+        if measure_redundancy == 'true':
+            # Wait for all fragments to be stored
+            timer_socket = context.socket(zmq.REP)
+            timer_socket.bind("tcp://*:5545")
+            resp = await timer_socket.recv_string()
+            timer_socket.close()
+            print(resp)
+
+            t_full_redun = time.perf_counter()
+
+        if fragment_names is not None:
+            # The delegate decides where the fragments are stored, so their locations are not known
+            fragments = [{"stripe": 0, "idx": idx, "name": name} for idx, name in enumerate(fragment_names)]
+            storage_details = {
+                "max_erasures": max_erasures,
+                "systematic": systematic,
+                "type": type
+            }
+
+    if storage_details is None:
+        return await make_response("Something went wrong, try again", 400)
+
+    print("File stored: %s, size: %d bytes" % (filename, size))
+
+    if measure_redundancy == 'true':
+        duration_full_redun = t_full_redun - t1
+        logger_full_redun.info(str(size) + "," + str(max_erasures) + "," + str(duration_full_redun))
+
+    # Insert the File record in the DB
+    db = get_db()
+    file_id = metadata.insert_file(db, filename, size, content_type, storage_mode, storage_details, fragments)
+    db.commit()
+
+    duration_server = time.perf_counter() - t1
+    logger_lead_node.info(str(size) + "," + str(max_erasures) + "," + str(duration_server))
+
+    return await make_response({"id": file_id}, 201)
+
+
+# Uploads many files in one multipart form, see add_files_batch in rest-server.py
+@app.route('/files_batch', methods=['POST'])
+async def add_files_batch():
+    t1 = time.perf_counter()
+
+    payload = await request.form
+    files = (await request.files).getlist('file')
+    if not files:
+        logging.error("No file was uploaded in the request!")
+        return await make_response("File missing!", 400)
+
+    if payload.get('storage', 'erasure_coding_rs') != 'erasure_coding_rs':
+        return await make_response("Wrong storage mode", 400)
+    if int(payload.get('type', 1)) != 1:
+        return await make_response("Batch uploads only support type 1", 400)
+    try:
+        n_fragments, max_erasures, systematic = get_coding_parameters(payload)
+    except ValueError as e:
+        return await make_response(str(e), 400)
+    print("Batch received: %d files" % len(files))
+
+    with dispatcher.open_channel() as responses:
+        stored = await reedsolomon_async.store_files_stream([read_chunks(file.stream) for file in files],
+                                                            max_erasures, send_task_socket, responses,
+                                                            systematic=systematic, n_fragments=n_fragments)
+
+    storage_details = {
+        "stripe_size": STRIPE_SIZE,
+        "max_erasures": max_erasures,
+        "systematic": systematic,
+        "type": 1
+    }
+
+    # Insert all the files in one transaction
+    db = get_db()
+    file_ids = [
+        metadata.insert_file(db, file.filename, size, file.mimetype, 'erasure_coding_rs', storage_details, fragments)
+        for file, (fragments, size) in zip(files, stored)
+    ]
+    db.commit()
+
+    size = sum(size for _, size in stored)
+    print("Batch stored: %d files, %d bytes in %.3f s" % (len(files), size, time.perf_counter() - t1))
+
+    return await make_response({"ids": file_ids}, 201)
+
+
+@app.route('/services/rs_repair', methods=['GET'])
+async def rs_repair():
+    # Retrieve the list of files stored using Reed-Solomon from the database
+    db = get_db()
+    cursor = db.execute("SELECT `id`, `storage_details`, `size` FROM `file` WHERE `storage_mode`='erasure_coding_rs'")
+    if not cursor:
+        return await make_response({"message": "Error connecting to the database"}, 500)
+
+    rs_files = [dict(file) for file in cursor.fetchall()]
+    for file in rs_files:
+        file['fragments'] = metadata.get_fragments(db, file['id'])
+
+    async with repair_lock:
+        fragments_missing, fragments_repaired, relocated = await reedsolomon_async.start_repair_process(
+            rs_files, repair_socket, repair_response_socket)
+
+    # The repaired fragments are stored on other nodes than before
+    for file_id, name, node_id in relocated:
+        metadata.set_fragment_node(db, file_id, name, node_id)
+        object_cache.invalidate(file_id)
+    db.commit()
+
+    return await make_response({"fragments_missing": fragments_missing,
+                                "fragments_repaired": fragments_repaired})
+
+
+@app.route('/services/cache_stats', methods=['GET'])
+async def cache_stats():
+    # The counters of the decoded file cache, and of the fragment cache of every
+    # storage node (from the heartbeat responses)
+    return await make_response({"files": object_cache.stats(), "nodes": membership.cache_stats()})
+
+
+@app.errorhandler(500)
+async def server_error(e):
+    logging.exception("Internal error: %s", e)
+    return await make_response({"error": str(e)}, 500)
+
+
+# Serve the app with Hypercorn (must be after the endpoint functions)
+host_local_computer = "localhost"  # Listen for connections on the local computer
+host_local_network = "0.0.0.0"  # Listen for connections on the local network
+config = Config()
+config.bind = ["%s:9000" % (host_local_network if is_raspberry_pi() or is_docker() else host_local_computer)]
+asyncio.run(serve(app, config))
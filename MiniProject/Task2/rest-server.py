@@ -4,18 +4,25 @@ Aarhus University - Distributed Storage course - Lab 6
 REST API + Controller
 """
 import flask
-from flask import Flask, make_response, g, request, send_file
+from flask import Flask, Response, make_response, g, request
 import sqlite3
+import threading
 import base64
 import logging
 
 import zmq  # For ZMQ
 import time  # For waiting a second for ZMQ connections
-import io  # For sending binary data in a HTTP response
 
+import metadata
 import reedsolomon
+import stripe_pool
+from connection_pool import ConnectionPool
+from dispatcher import ResponseDispatcher
+from membership import Membership
+from object_cache import ObjectCache
+from single_flight import SingleFlight
 
-from utils import is_raspberry_pi, is_docker, create_logger
+from utils import is_raspberry_pi, is_docker, create_logger, get_file_validators, get_requested_range
 
 logger_full_redun = create_logger("rs_full_redun", "log_rs_full_redun.log")
 logger_lead_node = create_logger("rs_lead_node", "log_rs_lead_node.log")
@@ -39,6 +46,9 @@ def close_db(e=None):
         db.close()
 
 
+# Fork the coding worker processes before ZMQ starts its I/O threads
+stripe_pool.start_pool()
+
 # Initiate ZMQ sockets
 context = zmq.Context()
 
@@ -62,9 +72,32 @@ repair_socket.bind("tcp://*:5560")
 repair_response_socket = context.socket(zmq.PULL)
 repair_response_socket.bind("tcp://*:5561")
 
+# ZMQ sockets are not thread safe, and the repair responses carry no request ID,
+# so repairs and deletes use the repair sockets one at a time
+repair_lock = threading.Lock()
+
 heartbeat_socket = context.socket(zmq.PUB)
 heartbeat_socket.bind("tcp://*:5562")
 
+# Socket to receive heartbeat responses from Storage Nodes
+heartbeat_response_socket = context.socket(zmq.PULL)
+heartbeat_response_socket.bind("tcp://*:5563")
+
+# Route the responses of the storage nodes to the requests waiting for them,
+# so several requests can be served at the same time
+dispatcher = ResponseDispatcher(response_socket)
+
+# Heartbeat the storage nodes in the background, so requests know the live nodes without waiting
+membership = Membership(heartbeat_socket, heartbeat_response_socket)
+
+# Connections to the storage nodes that encode or decode delegated (type 2) files
+peers = ConnectionPool(context)
+
+# The decoded contents of popular files
+object_cache = ObjectCache()
+# Concurrent downloads of the same file share the fragments requests and the decoding
+downloads = SingleFlight()
+
 # Wait for all workers to start and connect. 
 time.sleep(1)
 print("Listening to ZMQ messages on tcp://*:5558 and tcp://*:5561")
@@ -79,6 +112,10 @@ log.setLevel(logging.ERROR)
 # Close the DB connection after serving the request
 app.teardown_appcontext(close_db)
 
+# Create the fragment table, and move the fragments of older files into it
+with app.app_context():
+    metadata.init_db(get_db())
+
 
 @app.route('/')
 def hello():
@@ -119,36 +156,86 @@ def download_file(file_id):
     f = dict(f)
     print("File requested: {}".format(f['filename']))
 
+    # Serve only a part of the file if the client asks for a byte range
+    etag, last_modified = get_file_validators(f)
+    byte_range = get_requested_range(request, f['size'], etag, last_modified)
+    if byte_range is False:
+        response = make_response('Requested range not satisfiable', 416)
+        response.headers['Content-Range'] = 'bytes */%d' % f['size']
+        return response
+    start, stop = byte_range or (0, f['size'])
+
+    # Popular files are served from memory, without fetching and decoding them
+    cached = object_cache.get(file_id)
+    if cached is not None:
+        response = Response(cached[start:stop], mimetype=f['content_type'])
+        return set_download_headers(response, f, byte_range, start, stop, etag, last_modified)
+    cache_ticket = object_cache.admits(file_id, f['size'])
+
     # Parse the storage details JSON string
     import json
     storage_details = json.loads(f['storage_details'])
+    fragments = metadata.get_fragments(db, file_id)
 
     if f['storage_mode'] == 'erasure_coding_rs':
 
-        coded_fragments = storage_details['coded_fragments']
         max_erasures = storage_details['max_erasures']
         type = storage_details['type']
+        systematic = storage_details.get('systematic', False)
 
         if type == 1:
 
-            file_data = reedsolomon.get_file(
-                coded_fragments,
-                max_erasures,
-                f['size'],
-                data_req_socket,
-                heartbeat_socket,
-                response_socket
-            )
+            def start_download():
+                # The responses of the storage nodes, until the whole file is sent
+                responses = dispatcher.open_channel()
+                stripes = reedsolomon.get_file(
+                    reedsolomon.get_stripes(storage_details, f['size'], fragments),
+                    max_erasures,
+                    data_req_socket,
+                    membership,
+                    responses,
+                    start,
+                    stop,
+                    systematic
+                )
+                if cache_ticket is not None and byte_range is None and not isinstance(stripes, str):
+                    # Cache the file once all its stripes are sent
+                    stripes = object_cache.fill(file_id, stripes, cache_ticket)
+                elif not isinstance(stripes, str):
+                    # WSGI servers only accept bytes, but the stripes are decoded into bytearrays
+                    stripes = (bytes(stripe_data) for stripe_data in stripes)
+                return stripes, responses.close
+
+            # Concurrent requests for the same bytes of the file share one download
+            file_data = downloads.stream((file_id, start, stop), start_download)
+            if not isinstance(file_data, str):
+                try:
+                    file_data = start_streaming(file_data)
+                except reedsolomon.NotEnoughFragmentsError as e:
+                    return make_response(str(e), 404)
         elif type == 2:
-            file_data = reedsolomon.get_file_delegate(
-                coded_fragments,
-                max_erasures,
-                f['size'],
-                data_req_socket,
-                heartbeat_socket,
-                response_socket,
-                context
-            )
+
+            def fetch_file():
+                responses = dispatcher.open_channel()
+                try:
+                    return reedsolomon.get_file_delegate(
+                        [fragment['name'] for fragment in fragments],
+                        max_erasures,
+                        f['size'],
+                        data_req_socket,
+                        membership,
+                        responses,
+                        peers,
+                        systematic
+                    )
+                finally:
+                    responses.close()
+
+            file_data = downloads.do(file_id, fetch_file)
+            if isinstance(file_data, (bytes, bytearray)):
+                if cache_ticket is not None:
+                    object_cache.put(file_id, file_data, cache_ticket)
+                file_data = file_data[start:stop]
 
     if file_data is None:
         return make_response('Something went wrong, please try again', 404)
@@ -156,8 +243,47 @@ def download_file(file_id):
     if isinstance(file_data, str):
         return make_response(file_data, 404)
 
-    else:
-        return send_file(io.BytesIO(file_data), mimetype=f['content_type'])
+    # Stream the stripes to the client as soon as they are decoded
+    response = Response(file_data, mimetype=f['content_type'])
+    return set_download_headers(response, f, byte_range, start, stop, etag, last_modified)
+
+
+def start_streaming(stripes):
+    """
+    Fetch and decode the first stripe before the response headers are sent, so a file
+    whose fragments cannot be fetched gets an error status instead of a truncated body.
+    The later stripes can still fail, which ends the response early.
+
+    :param stripes: A generator of the stripes
+    :return: A generator of all the stripes
+    :raises reedsolomon.NotEnoughFragmentsError: If the first stripe cannot be decoded
+    """
+    first = next(stripes, None)
+
+    def all_stripes():
+        try:
+            if first is not None:
+                yield first
+                yield from stripes
+        finally:
+            stripes.close()
+
+    return all_stripes()
+
+
+def set_download_headers(response, f, byte_range, start, stop, etag, last_modified):
+    """
+    Set the length, validator and range headers of a file download.
+    """
+    response.content_length = stop - start
+    response.accept_ranges = 'bytes'
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    if byte_range:
+        response.status_code = 206
+        response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, f['size'])
+
+    return response
 
 
 #
@@ -199,12 +325,17 @@ def delete_file(file_id):
     f = dict(f)
     print("File to delete: %s" % f)
 
-    # TODO Delete all chunks from the Storage Nodes
+    # Delete all chunks from the Storage Nodes
+    with repair_lock:
+        reedsolomon.delete_file(metadata.get_fragments(db, file_id), repair_socket)
 
-    # TODO Delete the file record from the DB
+    # Delete the file record from the DB
+    metadata.delete_file(db, file_id)
+    db.commit()
+    object_cache.invalidate(file_id)
 
     # Return empty 200 Ok response
-    return make_response('TODO: implement this endpoint', 404)
+    return make_response('', 200)
 
 
 #
@@ -227,79 +358,166 @@ def add_files_multipart():
     # The sender encodes the file name and type together with the file contents
     filename = file.filename
     content_type = file.mimetype
-    # Load the file contents into a bytearray and measure its size
-    data = bytearray(file.read())
-    size = len(data)
-    print("File received: %s, size: %d bytes, type: %s" % (filename, size, content_type))
+    print("File received: %s, type: %s" % (filename, content_type))
 
     # Read the requested storage mode from the form (default value: 'erasure_coding_rs')
     storage_mode = payload.get('storage', 'erasure_coding_rs')
     print("Storage mode: %s" % storage_mode)
-    measure_redundancy = payload.get('measure_redundancy', 'false')
 
-    if storage_mode == 'erasure_coding_rs':
-        # Reed Solomon code
-        # Parse max_erasures (everything is a string in request.form, 
-        # we need to convert to int manually), set default value to 1
-        max_erasures = int(payload.get('max_erasures', 1))
-        type = int(payload.get('type', 1))
-
-        if max_erasures > 2:
-            return make_response('max_erasures cannot exceed 2, please try again', 400)
-        else:
-            print("Max erasures: %d" % (max_erasures))
-            fragment_names = None
-            if type == 1:
-                # Store the file contents with Reed Solomon erasure coding
-                fragment_names = reedsolomon.store_file(data, max_erasures, send_task_socket, response_socket)
-                if measure_redundancy == 'true':
-                    t_full_redun = time.perf_counter()
-            elif type == 2:
-                # Store the file, delegating encoding to random node
-                fragment_names = reedsolomon.store_file_delegate(data, max_erasures, heartbeat_socket,
-                                                                 response_socket, context)
-                if measure_redundancy == 'true':
-                    # Wait for all fragments to be stored
-                    timer_socket = context.socket(zmq.REP)
-                    timer_socket.bind("tcp://*:5545")
-                    resp = timer_socket.recv_string()
-                    timer_socket.close()
-                    print(resp)
-
-                    t_full_redun = time.perf_counter()
-
-            if fragment_names is not None:
-                storage_details = {
-                    "coded_fragments": fragment_names,
-                    "max_erasures": max_erasures,
-                    "type": type
-                }
-            else:
-                return make_response("Something went wrong, try again", 400)
-
-    else:
+    if storage_mode != 'erasure_coding_rs':
         logging.error("Unexpected storage mode: %s" % storage_mode)
         return make_response("Wrong storage mode", 400)
 
+    return store_file(file.stream, filename, content_type, payload, t1)
+
+
+# Uploads the raw request body instead of a multipart form. The body is erasure coded
+# stripe by stripe while it is still arriving, so files of any size can be stored.
+@app.route('/files_stream', methods=['POST'])
+def add_files_stream():
+    t1 = time.perf_counter()
+
+    payload = request.args
+    filename = payload.get('filename', 'unnamed')
+    content_type = request.mimetype or 'application/octet-stream'
+    print("File received: %s, type: %s" % (filename, content_type))
+
+    return store_file(request.stream, filename, content_type, payload, t1)
+
+
+def store_file(stream, filename, content_type, payload, t1):
+    """
+    Store an uploaded file with Reed Solomon erasure coding and insert its record in the DB.
+
+    :param stream: A file-like object with the file contents
+    :param filename: The original file name
+    :param content_type: The MIME type of the file
+    :param payload: The request parameters (fragments, max_erasures, type, systematic, measure_redundancy)
+    :param t1: The time the request arrived, for the measurements
+    :return: The HTTP response
+    """
+    storage_mode = 'erasure_coding_rs'
+    measure_redundancy = payload.get('measure_redundancy', 'false')
+
+    try:
+        n_fragments, max_erasures, systematic = reedsolomon.get_coding_parameters(payload)
+    except ValueError as e:
+        return make_response(str(e), 400)
+    type = int(payload.get('type', 1))
+
+    print("Fragments: %d, max erasures: %d, code rate: %.2f"
+          % (n_fragments, max_erasures, (n_fragments - max_erasures) / n_fragments))
+    storage_details = None
+    if type == 1:
+        # Store the file contents with Reed Solomon erasure coding, one stripe at a time
+        with dispatcher.open_channel() as responses:
+            fragments, size = reedsolomon.store_file_stream(stream, max_erasures, send_task_socket, responses,
+                                                            systematic=systematic, n_fragments=n_fragments)
+        if measure_redundancy == 'true':
+            t_full_redun = time.perf_counter()
+        # The fragments themselves are stored in the fragment table
+        storage_details = {
+            "stripe_size": reedsolomon.STRIPE_SIZE,
+            "max_erasures": max_erasures,
+            "systematic": systematic,
+            "type": type
+        }
+    elif type == 2:
+        # The delegate encodes the whole file, so it has to be loaded into memory
+        data = bytearray(stream.read())
+        size = len(data)
+
+        # Store the file, delegating encoding to random node
+        with dispatcher.open_channel() as responses:
+            fragment_names = reedsolomon.store_file_delegate(data, max_erasures, membership,
+                                                             responses, peers, systematic, n_fragments)
+        if measure_redundancy == 'true':
+            # Wait for all fragments to be stored
+            timer_socket = context.socket(zmq.REP)
+            timer_socket.bind("tcp://*:5545")
+            resp = timer_socket.recv_string()
+            timer_socket.close()
+            print(resp)
+
+            t_full_redun = time.perf_counter()
+
+        if fragment_names is not None:
+            # The delegate decides where the fragments are stored, so their locations are not known
+            fragments = [{"stripe": 0, "idx": idx, "name": name} for idx, name in enumerate(fragment_names)]
+            storage_details = {
+                "max_erasures": max_erasures,
+                "systematic": systematic,
+                "type": type
+            }
+
+    if storage_details is None:
+        return make_response("Something went wrong, try again", 400)
+
+    print("File stored: %s, size: %d bytes" % (filename, size))
+
     if measure_redundancy == 'true':
         duration_full_redun = t_full_redun - t1
-        logger_full_redun.info(str(len(data)) + "," + str(max_erasures) + "," + str(duration_full_redun))
+        logger_full_redun.info(str(size) + "," + str(max_erasures) + "," + str(duration_full_redun))
 
     # Insert the File record in the DB
-    import json
     db = get_db()
-
-    cursor = db.execute(
-        "INSERT INTO `file`(`filename`, `size`, `content_type`, `storage_mode`, `storage_details`) VALUES (?,?,?,?,?)",
-        (filename, size, content_type, storage_mode, json.dumps(storage_details))
-    )
+    file_id = metadata.insert_file(db, filename, size, content_type, storage_mode, storage_details, fragments)
     db.commit()
 
     t_server_done = time.perf_counter()
     duration_server = t_server_done - t1
-    logger_lead_node.info(str(len(data)) + "," + str(max_erasures) + "," + str(duration_server))
+    logger_lead_node.info(str(size) + "," + str(max_erasures) + "," + str(duration_server))
+
+    return make_response({"id": file_id}, 201)
 
-    return make_response({"id": cursor.lastrowid}, 201)
+
+# Uploads many files in one multipart form, each under the 'file' key. The files are
+# erasure coded and sent to the storage nodes in one pipeline, without waiting for the
+# acknowledgements of a file before sending the next one, and they are inserted in the
+# DB in one transaction. Only streamed (type 1) coding is supported.
+@app.route('/files_batch', methods=['POST'])
+def add_files_batch():
+    t1 = time.perf_counter()
+
+    payload = request.form
+    files = request.files.getlist('file')
+    if not files:
+        logging.error("No file was uploaded in the request!")
+        return make_response("File missing!", 400)
+
+    if payload.get('storage', 'erasure_coding_rs') != 'erasure_coding_rs':
+        return make_response("Wrong storage mode", 400)
+    if int(payload.get('type', 1)) != 1:
+        return make_response("Batch uploads only support type 1", 400)
+    try:
+        n_fragments, max_erasures, systematic = reedsolomon.get_coding_parameters(payload)
+    except ValueError as e:
+        return make_response(str(e), 400)
+    print("Batch received: %d files" % len(files))
+
+    with dispatcher.open_channel() as responses:
+        stored = reedsolomon.store_files_stream([file.stream for file in files], max_erasures, send_task_socket,
+                                                responses, systematic=systematic, n_fragments=n_fragments)
+
+    storage_details = {
+        "stripe_size": reedsolomon.STRIPE_SIZE,
+        "max_erasures": max_erasures,
+        "systematic": systematic,
+        "type": 1
+    }
+
+    # Insert all the files in one transaction
+    db = get_db()
+    file_ids = [
+        metadata.insert_file(db, file.filename, size, file.mimetype, 'erasure_coding_rs', storage_details, fragments)
+        for file, (fragments, size) in zip(files, stored)
+    ]
+    db.commit()
+
+    size = sum(size for _, size in stored)
+    print("Batch stored: %d files, %d bytes in %.3f s" % (len(files), size, time.perf_counter() - t1))
+
+    return make_response({"ids": file_ids}, 201)
 
 
 @app.route('/services/rs_repair', methods=['GET'])
@@ -312,15 +530,31 @@ def rs_repair():
 
     rs_files = cursor.fetchall()
     rs_files = [dict(file) for file in rs_files]
-
-    fragments_missing, fragments_repaired = reedsolomon.start_repair_process(rs_files,
-                                                                             repair_socket,
-                                                                             repair_response_socket)
+    for file in rs_files:
+        file['fragments'] = metadata.get_fragments(db, file['id'])
+
+    with repair_lock:
+        fragments_missing, fragments_repaired, relocated = reedsolomon.start_repair_process(rs_files,
+                                                                                            repair_socket,
+                                                                                            repair_response_socket)
+
+    # The repaired fragments are stored on other nodes than before
+    for file_id, name, node_id in relocated:
+        metadata.set_fragment_node(db, file_id, name, node_id)
+        object_cache.invalidate(file_id)
+    db.commit()
 
     return make_response({"fragments_missing": fragments_missing,
                           "fragments_repaired": fragments_repaired})
 
 
+@app.route('/services/cache_stats', methods=['GET'])
+def cache_stats():
+    # The counters of the decoded file cache, and of the fragment cache of every
+    # storage node (from the heartbeat responses)
+    return make_response({"files": object_cache.stats(), "nodes": membership.cache_stats()})
+
+
 @app.errorhandler(500)
 def server_error(e):
     logging.exception("Internal error: %s", e)
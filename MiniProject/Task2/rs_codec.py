@@ -0,0 +1,214 @@
+"""
+Reed Solomon codec backends
+
+A codec computes coded symbols from data symbols and a list of coefficient vectors,
+and solves the inverse problem when decoding. All backends use GF(2^8) with the
+same polynomial, so fragments encoded by one backend can be decoded by any other.
+
+The backend is selected with the RS_CODEC environment variable ('kodo' or 'numpy').
+By default kodo is used when it is installed, and the NumPy backend otherwise.
+
+Decoding multiplies the received symbols by the inverse of their coefficient
+matrix. There are only a few distinct sets of surviving fragments for a code, so
+the inverses are kept in an LRU cache (RS_DECODING_CACHE_SIZE entries) and the
+Gaussian elimination is only done the first time a set of fragments is seen.
+"""
+import functools
+import os
+
+import numpy as np
+
+import gf256
+
+try:
+    import kodo
+except ImportError:
+    # kodo is a licensed package that is not available on every node
+    kodo = None
+
+
+DECODING_CACHE_SIZE = int(os.environ.get('RS_DECODING_CACHE_SIZE', 128))
+
+
+@functools.lru_cache(maxsize=DECODING_CACHE_SIZE)
+def _invert(coefficients):
+    return tuple(bytes(row) for row in gf256.invert_matrix(coefficients))
+
+
+def decoding_matrix(coefficients, coded_symbols):
+    """
+    Returns the matrix that turns the coded symbols back into the data symbols.
+    The coefficient vectors identify both the code and the surviving fragments,
+    so they are used as the cache key, in a canonical order.
+
+    :param coefficients: The coefficient vectors of the coded symbols
+    :param coded_symbols: The coded symbols
+    :return: The decoding matrix as a tuple of rows, and the coded symbols in the matching order
+    """
+    received = sorted(zip((bytes(vector) for vector in coefficients), coded_symbols), key=lambda r: r[0])
+    matrix = _invert(tuple(vector for vector, _ in received))
+    return matrix, [symbol for _, symbol in received]
+
+
+class Codec:
+    """
+    Interface of the codec backends.
+    """
+    name = None
+
+    def encode(self, data, symbols, symbol_size, coefficients):
+        """
+        Compute one coded symbol for each coefficient vector.
+
+        :param data: The data to encode, at most symbols * symbol_size bytes (zero padded otherwise)
+        :param symbols: How many symbols the data is split into
+        :param symbol_size: The size of one symbol
+        :param coefficients: The coefficient vectors, each of length 'symbols'
+        :return: A list of coded symbols (bytes-like objects of length symbol_size)
+        """
+        raise NotImplementedError
+
+    def decode(self, coefficients, coded_symbols, symbol_size):
+        """
+        Rebuild the data from as many linearly independent coded symbols as there are data symbols.
+
+        :param coefficients: The coefficient vectors of the coded symbols
+        :param coded_symbols: The coded symbols (bytes-like objects of length symbol_size)
+        :param symbol_size: The size of one symbol
+        :return: The decoded data as a bytearray, including the padding
+        """
+        raise NotImplementedError
+
+
+class KodoCodec(Codec):
+    """
+    Codec backed by the kodo RLNC library.
+    """
+    name = 'kodo'
+
+    def __init__(self):
+        if kodo is None:
+            raise RuntimeError("The kodo codec was selected, but kodo is not installed")
+
+    def encode(self, data, symbols, symbol_size, coefficients):
+        # Kodo needs a bytearray as symbol storage
+        if not isinstance(data, bytearray):
+            data = bytearray(data)
+
+        # Kodo RLNC encoder using 2^8 finite field
+        encoder = kodo.block.Encoder(kodo.FiniteField.binary8)
+        encoder.configure(symbols, symbol_size)
+        encoder.set_symbols_storage(data)
+
+        coded_symbols = []
+        for vector in coefficients:
+            symbol = bytearray(encoder.symbol_bytes)
+            encoder.encode_symbol(symbol, vector)
+            coded_symbols.append(symbol)
+
+        return coded_symbols
+
+    def decode(self, coefficients, coded_symbols, symbol_size):
+        symbols = len(coded_symbols)
+        matrix, coded_symbols = decoding_matrix(coefficients, coded_symbols)
+
+        # The data symbols are linear combinations of the coded symbols, with the rows
+        # of the decoding matrix as coefficients, so an encoder can compute them directly
+        encoder = kodo.block.Encoder(kodo.FiniteField.binary8)
+        encoder.configure(symbols, symbol_size)
+        encoder.set_symbols_storage(bytearray().join(coded_symbols))
+
+        data_out = bytearray(symbols * symbol_size)
+        symbol = bytearray(encoder.symbol_bytes)
+        for i, row in enumerate(matrix):
+            encoder.encode_symbol(symbol, bytearray(row))
+            data_out[i * symbol_size:(i + 1) * symbol_size] = symbol
+
+        return data_out
+
+
+# Full GF(2^8) multiplication table: MUL_TABLE[a][b] = a * b. Multiplying a whole
+# symbol by a constant is a single table lookup per byte with NumPy.
+MUL_TABLE = np.array([[gf256.mul(a, b) for b in range(256)] for a in range(256)], dtype=np.uint8)
+
+
+def multiply_matrix(matrix, symbols, out):
+    """
+    Multiply a coefficient matrix by a list of symbols, e.g. to encode or decode data.
+
+    :param matrix: The coefficient matrix, as a list of rows
+    :param symbols: The input symbols as 1-dimensional uint8 arrays, one for each column
+    :param out: A (rows, symbol size) uint8 array for the result
+    """
+    product = np.empty(out.shape[1], dtype=np.uint8)
+    out[:] = 0
+    for r, row in enumerate(matrix):
+        for coefficient, symbol in zip(row, symbols):
+            if coefficient == 0:
+                continue
+            if coefficient == 1:
+                np.bitwise_xor(out[r], symbol, out=out[r])
+            else:
+                np.take(MUL_TABLE[coefficient], symbol, out=product)
+                np.bitwise_xor(out[r], product, out=out[r])
+
+
+class NumpyCodec(Codec):
+    """
+    Pure NumPy codec, for nodes without kodo. Whole symbols are processed
+    with vectorised table lookups, and decoding is a single multiplication by
+    the (cached) inverse of the coefficient matrix of the received symbols.
+    """
+    name = 'numpy'
+
+    def encode(self, data, symbols, symbol_size, coefficients):
+        if len(data) == symbols * symbol_size:
+            block = np.frombuffer(data, dtype=np.uint8)
+        else:
+            block = np.zeros(symbols * symbol_size, dtype=np.uint8)
+            block[:len(data)] = np.frombuffer(data, dtype=np.uint8)
+        data_symbols = [block[i * symbol_size:(i + 1) * symbol_size] for i in range(symbols)]
+
+        out = np.empty((len(coefficients), symbol_size), dtype=np.uint8)
+        multiply_matrix(coefficients, data_symbols, out)
+
+        return [row.data for row in out]
+
+    def decode(self, coefficients, coded_symbols, symbol_size):
+        symbols = len(coded_symbols)
+        matrix, coded_symbols = decoding_matrix(coefficients, coded_symbols)
+
+        # Decode straight into the output buffer
+        data_out = bytearray(symbols * symbol_size)
+        out = np.frombuffer(data_out, dtype=np.uint8).reshape(symbols, symbol_size)
+        multiply_matrix(matrix, [np.frombuffer(s, dtype=np.uint8) for s in coded_symbols], out)
+        del out
+
+        return data_out
+
+
+CODECS = {
+    KodoCodec.name: KodoCodec,
+    NumpyCodec.name: NumpyCodec
+}
+
+_codecs = {}
+
+
+def get_codec(name=None):
+    """
+    Returns the codec backend with the given name, or the one configured
+    with the RS_CODEC environment variable.
+
+    :param name: 'kodo' or 'numpy'
+    :return: A Codec instance
+    """
+    if name is None:
+        name = os.environ.get('RS_CODEC') or (KodoCodec.name if kodo is not None else NumpyCodec.name)
+
+    if name not in _codecs:
+        if name not in CODECS:
+            raise ValueError("Unknown codec: %s" % name)
+        _codecs[name] = CODECS[name]()
+
+    return _codecs[name]
@@ -0,0 +1,122 @@
+"""
+Reed Solomon coding of a stripe in memory
+
+These are the coding kernels shared by the stripe pool (see stripe_pool.py), which runs
+them on its worker processes or in the caller, and by the network code in reedsolomon.py.
+"""
+import math
+import time
+
+import gf256
+import rs_codec
+from utils import create_logger, STORAGE_NODES_NUM
+
+# Create custom loggers
+logger_encoding = create_logger("rs_encoding", "log_rs_en.log")
+logger_decoding = create_logger("rs_decoding", "log_rs_de.log")
+
+
+def get_coefficients(index, symbols, systematic=False):
+    """
+    Returns the Reed Solomon coefficient vector of the coded fragment with the given index.
+    The vectors are rows of a Cauchy matrix, generated for any number of fragments.
+    In systematic mode the first 'symbols' fragments hold the plain data (their coefficient
+    vectors are unit vectors) and only the remaining ones are coded. Every square submatrix
+    of a Cauchy matrix is invertible, so any 'symbols' fragments can still rebuild the data.
+
+    :param index: The index of the coded fragment
+    :param symbols: How many symbols the data is split into
+    :param systematic: Whether the file is stored in systematic mode
+    :return: The coefficient vector as a bytearray of length 'symbols'
+    """
+    if systematic and index < symbols:
+        coefficients = bytearray(symbols)
+        coefficients[index] = 1
+        return coefficients
+
+    return gf256.cauchy_row(index, symbols)
+
+
+def encode_file(file_data, max_erasures, systematic=False, n_fragments=STORAGE_NODES_NUM):
+    """
+    Encode data into n_fragments coded fragments, any n_fragments - max_erasures of which can rebuild it.
+    A fragment is stored as its coefficient vector followed by the symbol data, but the two
+    parts are returned separately, so they can be sent as separate frames without copying
+    them into one buffer. The symbol data may be a view of file_data, which must not change
+    until the fragments are sent.
+
+    :param file_data: The data to encode, as a bytes-like object
+    :param max_erasures: How many lost fragments the data should survive
+    :param systematic: Store the first fragments as plain data slices, see get_coefficients
+    :param n_fragments: How many coded fragments to generate
+    :return: A list of [coefficients, symbol data] pairs, one for each fragment
+    """
+    t1 = time.perf_counter()
+
+    # Make sure we can realize max_erasures with n_fragments coded fragments
+    assert (max_erasures >= 0)
+    assert (max_erasures < n_fragments)
+
+    # How many coded fragments (=symbols) will be required to reconstruct the encoded data.
+    symbols = n_fragments - max_erasures
+    # The size of one coded fragment (total size/number of symbols, rounded up)
+    symbol_size = math.ceil(len(file_data) / symbols)
+
+    # Select the Reed Solomon coefficient vector of each fragment
+    # (trimmed to the actual length we need)
+    coefficients = [get_coefficients(i, symbols, systematic) for i in range(n_fragments)]
+    # In systematic mode the data fragments are not coded
+    first_coded = symbols if systematic else 0
+
+    # Generate the coded fragments with the configured codec backend
+    coded_symbols = rs_codec.get_codec().encode(file_data, symbols, symbol_size, coefficients[first_coded:])
+
+    encoded_fragments = []
+
+    # Generate n_fragments coded fragments, normally one for each Storage Node
+    data_view = memoryview(file_data)
+    for i in range(n_fragments):
+        if i < first_coded:
+            # Data fragment: the i-th slice of the data as is
+            symbol_data = data_view[i * symbol_size:(i + 1) * symbol_size]
+            if len(symbol_data) < symbol_size:
+                # Only the last slice needs to be copied, to zero pad it to the symbol size
+                symbol_data = bytearray(symbol_data) + bytearray(symbol_size - len(symbol_data))
+            encoded_fragments.append([coefficients[i], symbol_data])
+        else:
+            encoded_fragments.append([coefficients[i], coded_symbols[i - first_coded]])
+
+    t2 = time.perf_counter()
+    duration = t2-t1
+    logger_encoding.info(str(len(file_data)) + "," + str(max_erasures) + "," + str(duration))
+
+    return encoded_fragments
+
+
+def decode_file(symbols, max_erasures):
+    """
+    Decode a file using Reed Solomon decoder and the provided coded symbols.
+    The number of symbols must be the same as the number of coded fragments - max_erasures.
+
+    :param symbols: coded symbols that contain both the coefficients and symbol data
+    :return: the decoded file data
+    """
+    t1 = time.perf_counter()
+
+    # Reconstruct the original data with the configured codec backend
+    symbols_num = len(symbols)
+    symbol_size = len(symbols[0]['data']) - symbols_num  # subtract the coefficients' size
+
+    # Separate the coefficients from the symbol data
+    coefficients = [symbol['data'][:symbols_num] for symbol in symbols]
+    coded_symbols = [memoryview(symbol['data'])[symbols_num:] for symbol in symbols]
+
+    data_out = rs_codec.get_codec().decode(coefficients, coded_symbols, symbol_size)
+
+    t2 = time.perf_counter()
+    duration = t2-t1
+    logger_decoding.info(str(len(data_out)) + "," + str(max_erasures) + "," + str(duration))
+
+    print("File decoded successfully")
+
+    return data_out
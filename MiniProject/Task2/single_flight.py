@@ -0,0 +1,358 @@
+"""
+Coalescing of concurrent downloads of the same file
+
+When many clients request the same file at the same time, its fragments are only
+requested and decoded once: the first request starts the download, and the requests
+that arrive while it is in progress send the same stripes.
+
+The stripes are pulled from the download by whichever response needs the next one
+first, so the download goes on as long as any of its clients is still connected. The
+stripes are kept in memory so late requests can start from the first one, until the
+download has produced COALESCE_WINDOW bytes; after that no more requests can join it
+and the stripes are dropped once every response has sent them.
+"""
+import asyncio
+import os
+import threading
+
+# A download can be joined until it has produced this many bytes
+COALESCE_WINDOW = int(os.environ.get('COALESCE_WINDOW', 64 * 1024 * 1024))
+
+
+class SharedStream:
+    """
+    The stripes of one download, sent by several responses.
+    """
+
+    def __init__(self, stripes, on_close, window, on_release):
+        """
+        :param stripes: An iterator of the stripes
+        :param on_close: Called once no response needs the stripes anymore
+        :param window: The number of bytes after which no more readers can join
+        :param on_release: Called once no more readers can join
+        """
+        self._stripes = stripes
+        self._on_close = on_close
+        self._window = window
+        self._on_release = on_release
+        self._cond = threading.Condition()
+        # The stripes from index self._first on, the earlier ones are sent by all readers
+        self._stripes_kept = []
+        self._first = 0
+        self._size = 0
+        # Reader token -> index of the next stripe it sends
+        self._positions = {}
+        self._producing = False
+        self._done = False
+        self._error = None
+        self._closed = False
+        self._released = False
+
+    def _joinable(self):
+        return not (self._done or self._closed or self._size > self._window or self._first)
+
+    def join(self):
+        """
+        :return: A generator of all the stripes, or None if the stream cannot be joined anymore
+        """
+        token = object()
+        with self._cond:
+            if not self._joinable():
+                return None
+            self._positions[token] = 0
+        return self._read(token)
+
+    def _read(self, token):
+        try:
+            while True:
+                with self._cond:
+                    stripe_data = self._next(token)
+                self._release_if_unjoinable()
+                if stripe_data is None:
+                    return
+                yield stripe_data
+        finally:
+            self._leave(token)
+
+    def _next(self, token):
+        # Returns the next stripe of a reader, pulling it from the download if no other
+        # reader is doing that already, or None at the end of the file
+        while True:
+            index = self._positions[token]
+            if index - self._first < len(self._stripes_kept):
+                self._positions[token] = index + 1
+                stripe_data = self._stripes_kept[index - self._first]
+                self._trim()
+                return stripe_data
+            if self._error is not None:
+                raise self._error
+            if self._done:
+                return None
+            if self._producing:
+                self._cond.wait()
+                continue
+
+            self._producing = True
+            self._cond.release()
+            try:
+                stripe_data, error = next(self._stripes, None), None
+            except Exception as e:
+                stripe_data, error = None, e
+            finally:
+                self._cond.acquire()
+                self._producing = False
+                self._cond.notify_all()
+
+            if error is not None:
+                self._error = error
+                self._done = True
+            elif stripe_data is None:
+                self._done = True
+            else:
+                self._stripes_kept.append(stripe_data)
+                self._size += len(stripe_data)
+
+    def _trim(self):
+        # Drop the stripes every reader has sent, once no new reader can start from the first one
+        if self._joinable() or not self._positions:
+            return
+        lowest = min(self._positions.values())
+        if lowest > self._first:
+            del self._stripes_kept[:lowest - self._first]
+            self._first = lowest
+
+    def _leave(self, token):
+        with self._cond:
+            del self._positions[token]
+            last = not self._positions
+            if last:
+                self._closed = True
+            else:
+                self._trim()
+        self._release_if_unjoinable()
+
+        if last:
+            # Stop the download if all clients disconnected before the end
+            if hasattr(self._stripes, 'close'):
+                self._stripes.close()
+            self._on_close()
+
+    def _release_if_unjoinable(self):
+        with self._cond:
+            if self._released or self._joinable():
+                return
+            self._released = True
+        self._on_release()
+
+
+class SingleFlight:
+    """
+    Runs the downloads of concurrent requests for the same file once. Safe to use from several threads.
+    """
+
+    def __init__(self, window=COALESCE_WINDOW):
+        """
+        :param window: The number of bytes of a download after which no more requests can join it
+        """
+        self._window = window
+        self._lock = threading.Lock()
+        # Key -> [threading.Event, result] of the calls in progress
+        self._calls = {}
+        # Key -> SharedStream of the downloads that can be joined
+        self._streams = {}
+
+    def do(self, key, fn):
+        """
+        Call fn, unless a call with the same key is in progress: then wait for it and return its result.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = [threading.Event(), None, None]
+
+        if not leader:
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2]
+            return call[1]
+
+        try:
+            call[1] = fn()
+        except Exception as e:
+            call[2] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call[0].set()
+        return call[1]
+
+    def stream(self, key, start):
+        """
+        Join the download with the same key, or start a new one.
+
+        :param start: Starts the download. It returns an iterator of the stripes, or an error
+                      message, and a function to call when the stripes are not needed anymore.
+        :return: A generator of the stripes, or the error message of start
+        """
+        with self._lock:
+            stream = self._streams.get(key)
+            reader = stream.join() if stream is not None else None
+            if reader is not None:
+                return reader
+
+            stripes, on_close = start()
+            if stripes is None or isinstance(stripes, str):
+                on_close()
+                return stripes
+            stream = SharedStream(stripes, on_close, self._window, lambda: self._release(key, stream))
+            self._streams[key] = stream
+            return stream.join()
+
+    def _release(self, key, stream):
+        with self._lock:
+            if self._streams.get(key) is stream:
+                del self._streams[key]
+
+
+class AsyncSharedStream:
+    """
+    SharedStream of an async generator of stripes. Everything runs on the event loop,
+    so no locks are needed.
+    """
+
+    def __init__(self, stripes, on_close, window, on_release):
+        self._stripes = stripes
+        self._on_close = on_close
+        self._window = window
+        self._on_release = on_release
+        # Set once the stripe that is being pulled from the download is there
+        self._produced = None
+        self._stripes_kept = []
+        self._first = 0
+        self._size = 0
+        self._positions = {}
+        self._done = False
+        self._error = None
+        self._closed = False
+        self._released = False
+
+    _joinable = SharedStream._joinable
+    _trim = SharedStream._trim
+
+    def join(self):
+        token = object()
+        if not self._joinable():
+            return None
+        self._positions[token] = 0
+        return self._read(token)
+
+    async def _read(self, token):
+        try:
+            while True:
+                stripe_data = await self._next(token)
+                self._release_if_unjoinable()
+                if stripe_data is None:
+                    return
+                yield stripe_data
+        finally:
+            await self._leave(token)
+
+    async def _next(self, token):
+        while True:
+            index = self._positions[token]
+            if index - self._first < len(self._stripes_kept):
+                self._positions[token] = index + 1
+                stripe_data = self._stripes_kept[index - self._first]
+                self._trim()
+                return stripe_data
+            if self._error is not None:
+                raise self._error
+            if self._done:
+                return None
+            if self._produced is not None:
+                await self._produced.wait()
+                continue
+
+            produced = self._produced = asyncio.Event()
+            try:
+                stripe_data, error = await self._stripes.__anext__(), None
+            except StopAsyncIteration:
+                stripe_data, error = None, None
+            except Exception as e:
+                stripe_data, error = None, e
+            finally:
+                self._produced = None
+                produced.set()
+
+            if error is not None:
+                self._error = error
+                self._done = True
+            elif stripe_data is None:
+                self._done = True
+            else:
+                self._stripes_kept.append(stripe_data)
+                self._size += len(stripe_data)
+
+    async def _leave(self, token):
+        del self._positions[token]
+        last = not self._positions
+        if last:
+            self._closed = True
+        else:
+            self._trim()
+        self._release_if_unjoinable()
+
+        if last:
+            await self._stripes.aclose()
+            self._on_close()
+
+    def _release_if_unjoinable(self):
+        if not self._released and not self._joinable():
+            self._released = True
+            self._on_release()
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight for the asyncio controller.
+    """
+
+    def __init__(self, window=COALESCE_WINDOW):
+        self._window = window
+        # Key -> asyncio.Task of the calls in progress
+        self._calls = {}
+        self._streams = {}
+
+    async def do(self, key, fn):
+        """
+        Await fn(), unless a call with the same key is in progress: then await its result.
+        A caller that is cancelled does not cancel the call for the others.
+        """
+        task = self._calls.get(key)
+        if task is None:
+            task = self._calls[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        return await asyncio.shield(task)
+
+    def stream(self, key, start):
+        """
+        Join the download with the same key, or start a new one, see SingleFlight.stream.
+        """
+        stream = self._streams.get(key)
+        reader = stream.join() if stream is not None else None
+        if reader is not None:
+            return reader
+
+        stripes, on_close = start()
+        if stripes is None or isinstance(stripes, str):
+            on_close()
+            return stripes
+        stream = AsyncSharedStream(stripes, on_close, self._window, lambda: self._release(key, stream))
+        self._streams[key] = stream
+        return stream.join()
+
+    def _release(self, key, stream):
+        if self._streams.get(key) is stream:
+            del self._streams[key]
@@ -3,6 +3,7 @@ Aarhus University - Distributed Storage course - Lab 4
 
 Storage Node
 """
+import pickle
 import socket
 import time
 
@@ -14,11 +15,116 @@ import os
 import random
 import string
 
-from utils import random_string, write_file, is_raspberry_pi, is_docker, create_logger
-import reedsolomon
+from utils import random_string, is_raspberry_pi, is_docker, create_logger
+import stripe_pool
+from connection_pool import ConnectionPool
+from workers import WorkerPool
+from group_commit import remove_temp_files
+from chunk_store import open_chunk_store, CachedChunkStore
 
 MAX_CHUNKS_PER_FILE = 10
 
+
+# The jobs below run on the worker threads (see workers.py). They return the
+# frames of the reply, which the polling thread sends, or None for no reply.
+
+def store_chunk(filename, data, reply):
+    """
+    Write a received chunk to disk.
+
+    :param filename: The name of the chunk
+    :param data: The chunk contents, as a list of buffers
+    :param reply: The frames to reply with once the chunk is written
+    """
+    print('Chunk to save: %s, size: %d bytes' % (filename, sum(len(part) for part in data)))
+
+    # Store the chunk with the given filename, it is only acknowledged once it is on disk
+    store.put(filename, data)
+    print("Chunk saved: %s" % filename)
+
+    return reply
+
+
+def read_chunk(filename, header):
+    """
+    Read a chunk from disk, if it is stored on this node.
+
+    :param filename: The name of the chunk
+    :param header: The frames to send before the chunk contents
+    :return: The header frames and the chunk contents, or None if the chunk is not found
+    """
+    print("Data chunk request: %s" % filename)
+
+    # Try to load the requested chunk, send response only if found
+    data = store.get(filename)
+    if data is None:
+        # This is OK here
+        return None
+
+    print("Found chunk %s, sending it back" % filename)
+    return header + [data]
+
+
+def delete_chunks(filenames):
+    """
+    Delete the chunks of a deleted file.
+    """
+    for filename in filenames:
+        if store.delete(filename):
+            print("Chunk deleted: %s" % filename)
+
+
+def encode_and_forward(data, ips, max_erasures, n_nodes, systematic, fragment_names):
+    """
+    Encode a delegated file, send its fragments to the other nodes and store the last one.
+    """
+    # Encode on the coding worker processes, so concurrent delegations use all cores
+    encoded_fragments = stripe_pool.submit_encode(data, max_erasures, systematic, n_nodes).result()
+
+    sockets = []
+    for i, fragment in enumerate(encoded_fragments[:-1]):
+        ip = ips[i % len(ips)]
+        print("Sending fragment to:", ip)
+        addr = "tcp://" + ip + ":5544"
+        # Reuse a connection to the node from the pool
+        sock = peers.checkout(addr)
+        sockets.append((addr, sock))
+        task = messages_pb2.storedata_request()
+        task.filename = fragment_names[i]
+        sock.send_multipart([task.SerializeToString()] + fragment, copy=False)
+
+    store_chunk(fragment_names[-1], encoded_fragments[-1], None)
+
+    for addr, sock in sockets:
+        try:
+            resp = sock.recv_pyobj()
+        except zmq.Again:
+            print(f'No response from {addr}')
+            peers.discard(sock)
+            continue
+        peers.checkin(addr, sock)
+        if resp is None:
+            print(f'Storing a fragment on {addr} failed')
+            continue
+        res_filename = resp['filename']
+        res_ip = resp['ip']
+        print(f'File {res_filename} stored on {res_ip}')
+
+    # Send all fragments done
+    timer_socket = context.socket(zmq.REQ)
+    timer_socket.connect(timer_address)
+    timer_socket.send_string("All fragments stored")
+    timer_socket.close()
+
+
+def decode(symbols, max_erasures, file_size):
+    """
+    Decode a delegated file.
+    """
+    data = stripe_pool.submit_decode(symbols, max_erasures).result()
+    return [data[:file_size]]
+
+
 own_ip = (([ip for ip in socket.gethostbyname_ex(socket.gethostname())[2] if not ip.startswith("127.")] or [[(s.connect(("8.8.8.8", 53)), s.getsockname()[0], s.close()) for s in [socket.socket(socket.AF_INET, socket.SOCK_DGRAM)]][0][1]]) + ["no IP found"])[0]
 print("IP:", own_ip)
 
@@ -34,6 +140,16 @@ if data_folder != "./":
         pass
 print("Data folder: %s" % data_folder)
 
+# Fork the coding worker processes before any thread is started
+stripe_pool.start_pool()
+
+# Remove the temporary files of writes that were interrupted by a crash
+remove_temp_files(data_folder)
+
+# The chunks are stored one per file, or in pack files (see chunk_store.py),
+# and the most requested ones are kept in memory
+store = CachedChunkStore(open_chunk_store(data_folder))
+
 # Check whether the node has an id. If it doesn't, generate one and save it to disk.
 try:
     with open(data_folder + '/.id', "r") as id_file:
@@ -57,6 +173,7 @@ if is_raspberry_pi():
     repair_subscriber_address = "tcp://192.168.0." + server_address + ":5560"
     repair_sender_address = "tcp://192.168.0." + server_address + ":5561"
     heartbeat_subscriber_address = "tcp://192.168.0." + server_address + ":5562"
+    heartbeat_sender_address = "tcp://192.168.0." + server_address + ":5563"
     timer_address = "tcp://192.168.0." + server_address + ":5545"
 
 
@@ -68,6 +185,7 @@ elif is_docker():
     repair_subscriber_address = "tcp://" + server_address + ":5560"
     repair_sender_address = "tcp://" + server_address + ":5561"
     heartbeat_subscriber_address = "tcp://" + server_address + ":5562"
+    heartbeat_sender_address = "tcp://" + server_address + ":5563"
     timer_address = "tcp://" + server_address + ":5545"
 
 else:
@@ -78,6 +196,7 @@ else:
     repair_subscriber_address = "tcp://localhost:5560"
     repair_sender_address = "tcp://localhost:5561"
     heartbeat_subscriber_address = "tcp://localhost:5562"
+    heartbeat_sender_address = "tcp://localhost:5563"
     timer_address = "tcp://localhost:5545"
 
 context = zmq.Context()
@@ -95,8 +214,10 @@ sender.connect(push_address)
 # Socket to receive Get Chunk messages from the controller
 subscriber = context.socket(zmq.SUB)
 subscriber.connect(subscriber_address)
-# Receive every message (empty subscription)
-subscriber.setsockopt(zmq.SUBSCRIBE, b'')
+# Receive requests broadcast to all nodes (for fragments with an unknown location)
+subscriber.setsockopt(zmq.SUBSCRIBE, b'all_nodes')
+# Receive requests for the fragments stored on this node
+subscriber.setsockopt(zmq.SUBSCRIBE, node_id.encode('UTF-8'))
 
 # Socket to receive Repair request messages from the controller
 repair_subscriber = context.socket(zmq.SUB)
@@ -114,6 +235,10 @@ heartbeat_subscriber = context.socket(zmq.SUB)
 heartbeat_subscriber.connect(heartbeat_subscriber_address)
 heartbeat_subscriber.setsockopt(zmq.SUBSCRIBE, b'all_nodes')
 
+# Socket to answer the heartbeats, apart from the responses to data requests
+heartbeat_sender = context.socket(zmq.PUSH)
+heartbeat_sender.connect(heartbeat_sender_address)
+
 encode_socket = context.socket(zmq.REP)
 encode_socket.bind("tcp://*:5542")
 
@@ -123,6 +248,12 @@ decode_socket.bind("tcp://*:5543")
 delegation_socket = context.socket(zmq.REP)
 delegation_socket.bind("tcp://*:5544")
 
+# Connections to the other nodes, to forward the fragments of delegated files
+peers = ConnectionPool(context)
+
+# Disk I/O and coding run on worker threads, so the sockets are polled while they are busy
+workers = WorkerPool(context)
+
 # Use a Poller to monitor three sockets at the same time
 poller = zmq.Poller()
 poller.register(receiver, zmq.POLLIN)
@@ -132,6 +263,17 @@ poller.register(heartbeat_subscriber, zmq.POLLIN)
 poller.register(encode_socket, zmq.POLLIN)
 poller.register(decode_socket, zmq.POLLIN)
 poller.register(delegation_socket, zmq.POLLIN)
+poller.register(workers.results, zmq.POLLIN)
+
+
+def submit_request(rep_socket, fn, *args, error_reply):
+    """
+    Run the job of a request received on a REP socket. A REP socket must reply before
+    it receives the next request, so it is not polled until the job is done.
+    """
+    poller.unregister(rep_socket)
+    workers.submit(rep_socket, fn, *args, error_reply=error_reply,
+                   on_done=lambda: poller.register(rep_socket, zmq.POLLIN))
 
 while True:
     try:
@@ -145,61 +287,45 @@ while True:
 
     if receiver in socks:
         # Incoming message on the 'receiver' socket where we get tasks to store a chunk
-        msg = receiver.recv_multipart()
+        # Receive the frames without copying them, they are written to disk as they are
+        msg = receiver.recv_multipart(copy=False)
         # Parse the Protobuf message from the first frame
         task = messages_pb2.storedata_request()
-        task.ParseFromString(msg[0])
+        task.ParseFromString(msg[0].bytes)
 
-        # The data is the second frame
-        data = msg[1]
+        # The data is in the remaining frames (the coefficients and the symbol data)
+        data = [frame.buffer for frame in msg[1:]]
 
-        print('Chunk to save: %s, size: %d bytes' % (task.filename, len(data)))
-
-        # Store the chunk with the given filename
-        chunk_local_path = data_folder + '/' + task.filename
-        write_file(data, chunk_local_path)
-        print("Chunk saved to %s" % chunk_local_path)
-
-        # Send response (just the file name)
-        sender.send_string(task.filename)
+        # Store the chunk on a worker, then send the response (the request ID, the file name and
+        # this node's ID, which the controller records to request the fragment from this node only)
+        workers.submit(sender, store_chunk, task.filename, data,
+                       [task.request_id.encode('utf-8'), task.filename.encode('utf-8'), node_id.encode('utf-8')])
 
     if subscriber in socks:
         # Incoming message on the 'subscriber' socket where we get retrieve requests
-        msg = subscriber.recv()
+        msg = subscriber.recv_multipart()
 
-        # Parse the Protobuf message from the first frame
+        # The topic is the first frame, parse the Protobuf message from the second frame
         task = messages_pb2.getdata_request()
-        task.ParseFromString(msg)
-
-        filename = task.filename
-        print("Data chunk request: %s" % filename)
+        task.ParseFromString(msg[1])
 
-        # Try to load the requested file from the local file system,
-        # send response only if found
-        try:
-            with open(data_folder + '/' + filename, "rb") as in_file:
-                print("Found chunk %s, sending it back" % filename)
+        # Read the chunk on a worker, the response is only sent if it is found
+        workers.submit(sender, read_chunk, task.filename,
+                       [task.request_id.encode('utf-8'), bytes(task.filename, 'utf-8')])
 
-                sender.send_multipart([
-                    bytes(filename, 'utf-8'),
-                    in_file.read()
-                ])
-        except FileNotFoundError:
-            # This is OK here
-            pass
+    if workers.results in socks:
+        # Send the replies of the jobs that are done
+        workers.send_results()
 
     if heartbeat_subscriber in socks:
-        msg = heartbeat_subscriber.recv_multipart()
-        task = messages_pb2.heartbeat_request()
-        task.ParseFromString(msg[1])
-
-        print("Status request for node: %s - Alive" % node_id)
+        heartbeat_subscriber.recv_multipart()
 
         # Send the response
         response = messages_pb2.heartbeat_response()
         response.node_ip = own_ip
+        response.cache_hits, response.cache_misses, response.cache_bytes = store.stats()
 
-        sender.send(response.SerializeToString())
+        heartbeat_sender.send(response.SerializeToString())
 
     if encode_socket in socks:
         msg = encode_socket.recv_pyobj()
@@ -207,6 +333,7 @@ while True:
         ips = msg['ips']
         max_erasures = int(msg['max_erasures'])
         n_nodes = int(msg['n_nodes'])
+        systematic = msg.get('systematic', False)
 
         fragment_names = [random_string(8) for _ in range(n_nodes)]
 
@@ -215,56 +342,20 @@ while True:
             "names": fragment_names
         })
 
-        encoded_fragments = reedsolomon.encode_file(data, max_erasures)
-
-        sockets = []
-        for i, fragment in enumerate(encoded_fragments[:-1]):
-            ip = ips[i % len(ips)]
-            sock = context.socket(zmq.REQ)
-            print("Sending fragment to:", ip)
-            addr = "tcp://" + ip + ":5544"
-            sock.connect(addr)
-            sockets.append(sock)
-            task = messages_pb2.storedata_request()
-            task.filename = fragment_names[i]
-            sock.send_multipart([
-                task.SerializeToString(),
-                fragment
-            ])
-
-        data = encoded_fragments[-1]
-        # Store the chunk with the given filename
-        chunk_local_path = data_folder + '/' + fragment_names[-1]
-        write_file(data, chunk_local_path)
-        print("Chunk saved to %s" % chunk_local_path)
-
-        for socket in sockets:
-            resp = socket.recv_pyobj()
-            res_filename = resp['filename']
-            res_ip = resp['ip']
-            print(f'File {res_filename} stored on {res_ip}')
-
-        # Send all fragments done
-        timer_socket = context.socket(zmq.REQ)
-        timer_socket.connect(timer_address)
-        timer_socket.send_string("All fragments stored")
-        timer_socket.close()
+        # Encode and distribute the fragments on a worker, there is no further reply
+        workers.submit(None, encode_and_forward, data, ips, max_erasures, n_nodes, systematic, fragment_names)
 
     if delegation_socket in socks:
-        msg = delegation_socket.recv_multipart()
+        msg = delegation_socket.recv_multipart(copy=False)
 
         task = messages_pb2.storedata_request()
-        task.ParseFromString(msg[0])
-
-        for i in range(0, len(msg) - 1):
-            data = msg[1 + i]
-            print('Chunk to save: %s, size: %d bytes' % (task.filename, len(data)))
-            # Store the chunk with the given filename
-            chunk_local_path = data_folder + '/' + task.filename
-            write_file(data, chunk_local_path)
-            print("Chunk saved to %s" % chunk_local_path)
+        task.ParseFromString(msg[0].bytes)
 
-        delegation_socket.send_pyobj({'filename': task.filename, 'ip': own_ip})
+        # The fragment is split over the remaining frames
+        data = [frame.buffer for frame in msg[1:]]
+        submit_request(delegation_socket, store_chunk, task.filename, data,
+                       [pickle.dumps({'filename': task.filename, 'ip': own_ip})],
+                       error_reply=[pickle.dumps(None)])
 
     if decode_socket in socks:
         msg = decode_socket.recv_pyobj()
@@ -272,15 +363,14 @@ while True:
         file_size = msg['size']
         max_erasures = msg['max_erasures']
 
-        data = reedsolomon.decode_file(symbols, max_erasures)
-
-        decode_socket.send(data[:file_size])
+        # An empty reply tells the controller that decoding failed
+        submit_request(decode_socket, decode, symbols, max_erasures, file_size, error_reply=[b''])
 
     if repair_subscriber in socks:
         # Incoming message on the 'repair_subscriber' socket
 
         # Parse the multi-part message
-        msg = repair_subscriber.recv_multipart()
+        msg = repair_subscriber.recv_multipart(copy=False)
 
         # The topic is sent a frame 0
         # topic = str(msg[0])
@@ -288,18 +378,17 @@ while True:
         # Parse the header from frame 1. This is used to distinguish between
         # different types of requests
         header = messages_pb2.header()
-        header.ParseFromString(msg[1])
+        header.ParseFromString(msg[1].bytes)
 
         # Parse the actual message based on the header
         if header.request_type == messages_pb2.FRAGMENT_STATUS_REQ:
             # Fragment Status requests
             task = messages_pb2.fragment_status_request()
-            task.ParseFromString(msg[2])
+            task.ParseFromString(msg[2].bytes)
 
             fragment_name = task.fragment_name
-            # Check whether the fragment is on the disk
-            fragment_found = os.path.exists(data_folder + '/' + fragment_name) and \
-                             os.path.isfile(data_folder + '/' + fragment_name)
+            # Check whether the fragment is stored
+            fragment_found = store.contains(fragment_name)
 
             if fragment_found == True:
                 print("Status request for fragment: %s - Found" % fragment_name)
@@ -318,43 +407,28 @@ while True:
             # Fragment data request - same implementation as serving normal data
             # requests, except for the different socket the response is sent on
             task = messages_pb2.getdata_request()
-            task.ParseFromString(msg[2])
-
-            filename = task.filename
-            print("Data chunk request: %s" % filename)
-
-            # Try to load the requested file from the local file system,
-            # send response only if found
-            try:
-                with open(data_folder + '/' + filename, "rb") as in_file:
-                    print("Found chunk %s, sending it back" % filename)
+            task.ParseFromString(msg[2].bytes)
 
-                    repair_sender.send_multipart([
-                        bytes(filename, 'utf-8'),
-                        in_file.read()
-                    ])
-            except FileNotFoundError:
-                # This is OK here
-                pass
+            workers.submit(repair_sender, read_chunk, task.filename, [bytes(task.filename, 'utf-8')])
 
         elif header.request_type == messages_pb2.STORE_FRAGMENT_DATA_REQ:
             # Fragment store request - same implementation as serving normal data
             # requests, except for the different socket the response is sent on
             task = messages_pb2.storedata_request()
-            task.ParseFromString(msg[2])
+            task.ParseFromString(msg[2].bytes)
 
-            # The data is the third frame
-            data = msg[3]
+            # The data is in the remaining frames (the coefficients and the symbol data)
+            data = [frame.buffer for frame in msg[3:]]
 
-            print('Chunk to save: %s, size: %d bytes' % (task.filename, len(data)))
+            # Send response (just the file name)
+            workers.submit(repair_sender, store_chunk, task.filename, data, [task.filename.encode('utf-8')])
 
-            # Store the chunk with the given filename
-            chunk_local_path = data_folder + '/' + task.filename
-            write_file(data, chunk_local_path)
-            print("Chunk saved to %s" % chunk_local_path)
+        elif header.request_type == messages_pb2.DELETE_FRAGMENT_REQ:
+            # The fragments of a deleted file, there is no response
+            task = messages_pb2.delete_fragment_request()
+            task.ParseFromString(msg[2].bytes)
 
-            # Send response (just the file name)
-            repair_sender.send_string(task.filename)
+            workers.submit(None, delete_chunks, list(task.fragment_names))
 
         else:
             print("Message type not supported")
@@ -0,0 +1,217 @@
+"""
+Process pool for encoding and decoding stripes in parallel
+
+The stripes of a file are coded independently, so they can be spread over a
+persistent pool of worker processes and use every core of the machine. The stripe
+data is handed to the workers in a shared memory segment instead of being pickled,
+and the workers write their results back into the same segment.
+
+The controllers and the storage nodes (for delegated coding) fork the pool with
+start_pool at startup, before any threads are created. Until then (or with
+RS_WORKERS=0) all stripes are coded in the caller, or on a thread for callers
+that must not block.
+"""
+import concurrent.futures
+import math
+import multiprocessing
+import os
+import threading
+import traceback
+from multiprocessing import resource_tracker, shared_memory
+
+import rs_coding
+from utils import STORAGE_NODES_NUM
+
+# Stripes smaller than this are coded inline, the IPC overhead would outweigh the gain
+PARALLEL_MIN_SIZE = 256 * 1024
+
+_pool = None
+_workers = 1
+# Codes the small stripes of the callers that must not block, started on first use
+_threads = None
+_threads_lock = threading.Lock()
+
+
+def start_pool(workers=None):
+    """
+    Start the persistent worker pool.
+
+    :param workers: The number of worker processes. Defaults to the RS_WORKERS
+                    environment variable, or the number of cores.
+    """
+    global _pool, _workers
+
+    if workers is None:
+        workers = int(os.environ.get('RS_WORKERS', os.cpu_count() or 1))
+    if workers < 1:
+        return
+
+    # Start the resource tracker first, so the workers share it. Otherwise every worker
+    # starts its own, which tries to remove the segments again when the worker exits.
+    resource_tracker.ensure_running()
+
+    # Fork explicitly: the server scripts have no main guard, so they
+    # must not be re-imported by 'spawn'ed workers
+    _pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                   mp_context=multiprocessing.get_context('fork'))
+    _workers = workers
+    # Fork the workers right away, while the process is still single threaded
+    _pool.submit(os.getpid).result()
+    print("Started %d coding worker processes" % workers)
+
+
+def workers():
+    """
+    Returns how many stripes can be coded at the same time.
+    """
+    return _workers
+
+
+def _completed(result):
+    future = concurrent.futures.Future()
+    future.set_result(result)
+    return future
+
+
+def _run_inline(fn, args, blocking):
+    """
+    Code a stripe that is not sent to the worker pool: in the caller, or on a
+    thread if the caller must not block, like the event loop of the asyncio controller.
+    """
+    global _threads
+    if blocking:
+        return _completed(fn(*args))
+    with _threads_lock:
+        if _threads is None:
+            _threads = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1,
+                                                             thread_name_prefix='stripe-coding')
+    return _threads.submit(fn, *args)
+
+
+def _run_in_pool(fn, shm, args, read_result):
+    """
+    Run fn on the pool and call read_result on the shared memory segment once it is done.
+    The segment is released in any case.
+    """
+    result = concurrent.futures.Future()
+
+    def done(future):
+        try:
+            if future.exception() is not None:
+                result.set_exception(future.exception())
+            else:
+                result.set_result(read_result(shm.buf, future.result()))
+        finally:
+            shm.close()
+            shm.unlink()
+
+    _pool.submit(fn, shm.name, *args).add_done_callback(done)
+    return result
+
+
+def _drop_views(error):
+    # The frames of the traceback keep their views of the shared memory alive,
+    # closing it would then fail with a BufferError that hides the error
+    traceback.clear_frames(error.__traceback__)
+
+
+def _encode_worker(shm_name, size, max_erasures, systematic, n_fragments):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        data = shm.buf[:size]
+        encoded_fragments = fragment = part = None
+        try:
+            encoded_fragments = rs_coding.encode_file(data, max_erasures, systematic, n_fragments)
+
+            # Write the fragments (coefficients, then symbol data) after the stripe data
+            offset = size
+            for fragment in encoded_fragments:
+                for part in fragment:
+                    shm.buf[offset:offset + len(part)] = part
+                    offset += len(part)
+        except BaseException as e:
+            _drop_views(e)
+            raise
+        finally:
+            # Data fragments are views of the stripe data, drop them before releasing it
+            encoded_fragments = fragment = part = None
+            data.release()
+    finally:
+        shm.close()
+
+
+def submit_encode(stripe_data, max_erasures, systematic=False, n_fragments=STORAGE_NODES_NUM, blocking=True):
+    """
+    Encode a stripe on the worker pool, see rs_coding.encode_file.
+
+    :param blocking: Whether a stripe that is not sent to the worker pool may be encoded
+                     in the caller. Otherwise it is encoded on a thread.
+    :return: A Future of the list of encoded fragments
+    """
+    size = len(stripe_data)
+    if _pool is None or size < PARALLEL_MIN_SIZE:
+        return _run_inline(rs_coding.encode_file, (stripe_data, max_erasures, systematic, n_fragments), blocking)
+
+    # Every fragment holds the coefficients and one symbol
+    symbols = n_fragments - max_erasures
+    fragment_size = symbols + math.ceil(size / symbols)
+
+    shm = shared_memory.SharedMemory(create=True, size=size + n_fragments * fragment_size)
+    shm.buf[:size] = stripe_data
+
+    def read_fragments(buf, _):
+        fragments = []
+        for i in range(n_fragments):
+            offset = size + i * fragment_size
+            fragments.append([bytes(buf[offset:offset + symbols]),
+                              bytearray(buf[offset + symbols:offset + fragment_size])])
+        return fragments
+
+    return _run_in_pool(_encode_worker, shm, (size, max_erasures, systematic, n_fragments), read_fragments)
+
+
+def _decode_worker(shm_name, n_symbols, fragment_size, max_erasures):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        symbols = [{"chunkname": "", "data": shm.buf[i * fragment_size:(i + 1) * fragment_size]}
+                   for i in range(n_symbols)]
+        try:
+            data_out = rs_coding.decode_file(symbols, max_erasures)
+        except BaseException as e:
+            _drop_views(e)
+            raise
+        finally:
+            for symbol in symbols:
+                symbol['data'].release()
+
+        # Write the decoded data after the coded symbols
+        offset = n_symbols * fragment_size
+        shm.buf[offset:offset + len(data_out)] = data_out
+        return len(data_out)
+    finally:
+        shm.close()
+
+
+def submit_decode(symbols, max_erasures, blocking=True):
+    """
+    Decode a stripe on the worker pool, see rs_coding.decode_file.
+
+    :param blocking: Whether a stripe that is not sent to the worker pool may be decoded
+                     in the caller. Otherwise it is decoded on a thread.
+    :return: A Future of the decoded data
+    """
+    n_symbols = len(symbols)
+    fragment_size = len(symbols[0]['data'])
+    in_size = n_symbols * fragment_size
+    if _pool is None or in_size < PARALLEL_MIN_SIZE:
+        return _run_inline(rs_coding.decode_file, (symbols, max_erasures), blocking)
+
+    # The decoded data is the symbols without their coefficients
+    shm = shared_memory.SharedMemory(create=True, size=in_size + n_symbols * (fragment_size - n_symbols))
+    for i, symbol in enumerate(symbols):
+        shm.buf[i * fragment_size:(i + 1) * fragment_size] = symbol['data']
+
+    def read_data(buf, data_size):
+        return bytearray(buf[in_size:in_size + data_size])
+
+    return _run_in_pool(_decode_worker, shm, (n_symbols, fragment_size, max_erasures), read_data)
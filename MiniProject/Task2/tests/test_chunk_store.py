@@ -0,0 +1,343 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import chunk_store
+from chunk_store import PackChunkStore, CachedChunkStore
+
+
+class TestPackChunkStore(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def open(self, **kwargs):
+        # No background maintenance, the tests checkpoint and compact explicitly
+        store = PackChunkStore(self.folder, checkpoint_interval=3600, **kwargs)
+        self.addCleanup(self.close, store)
+        return store
+
+    def close(self, store):
+        for pack in store._packs.values():
+            if not pack.retired:
+                pack.retired = True
+                pack.close()
+
+    def reopen(self, store, **kwargs):
+        self.close(store)
+        return self.open(**kwargs)
+
+    def assertStored(self, store, fragments):
+        for name, data in fragments.items():
+            self.assertEqual(bytes(store.get(name)), data, name)
+
+    def pack_path(self, pack_id):
+        return os.path.join(self.folder, 'pack-%06d.dat' % pack_id)
+
+    def flip_byte(self, path, offset):
+        with open(path, 'r+b') as f:
+            f.seek(offset)
+            byte = f.read(1)
+            f.seek(offset)
+            f.write(bytes([byte[0] ^ 0x01]))
+
+    def test_put_get_delete(self):
+        store = self.open()
+        store.put('a', b'first')
+        store.put('b', [b'second ', b'fragment'])
+        self.assertStored(store, {'a': b'first', 'b': b'second fragment'})
+        self.assertTrue(store.contains('a'))
+        self.assertIsNone(store.get('c'))
+
+        store.put('a', b'overwritten')
+        self.assertEqual(bytes(store.get('a')), b'overwritten')
+
+        self.assertTrue(store.delete('a'))
+        self.assertFalse(store.delete('a'))
+        self.assertFalse(store.contains('a'))
+        self.assertIsNone(store.get('a'))
+
+    def test_replay_after_checkpoint(self):
+        store = self.open()
+        store.put('a', b'first')
+        store.put('b', b'second')
+        store.checkpoint()
+        self.assertTrue(os.path.exists(os.path.join(self.folder, chunk_store.CHECKPOINT_NAME)))
+        store.put('c', b'third')
+        store.delete('a')
+        store.put('b', b'second again')
+
+        store = self.reopen(store)
+        self.assertStored(store, {'b': b'second again', 'c': b'third'})
+        self.assertFalse(store.contains('a'))
+
+    def test_torn_tail(self):
+        store = self.open()
+        store.put('a', b'first')
+        store.put('b', b'second')
+        size = os.path.getsize(self.pack_path(1))
+
+        # A crash while appending a record
+        record = chunk_store._encode_record(chunk_store.RECORD_PUT, 'c', [b'third'])
+        with open(self.pack_path(1), 'ab') as f:
+            f.write(record[:len(record) - 2])
+
+        store = self.reopen(store)
+        self.assertEqual(os.path.getsize(self.pack_path(1)), size)
+        self.assertStored(store, {'a': b'first', 'b': b'second'})
+        self.assertFalse(store.contains('c'))
+
+        # Appending goes on after the last complete record
+        store.put('c', b'third')
+        store = self.reopen(store)
+        self.assertStored(store, {'a': b'first', 'b': b'second', 'c': b'third'})
+
+    def test_corrupt_record_in_the_middle(self):
+        store = self.open()
+        store.put('a', b'first')
+        store.put('b', b'second')
+        store.put('c', b'third')
+        _, offset, length = store._index['b']
+        size = os.path.getsize(self.pack_path(1))
+        self.flip_byte(self.pack_path(1), offset + length - 1)
+
+        # The records after the corrupt one were acknowledged, they must survive
+        store = self.reopen(store)
+        self.assertEqual(os.path.getsize(self.pack_path(1)), size)
+        self.assertStored(store, {'a': b'first', 'c': b'third'})
+        self.assertFalse(store.contains('b'))
+
+    def test_unreadable_tail_of_an_older_pack(self):
+        store = self.open(pack_size=40)
+        for name in 'abcd':
+            store.put(name, name.encode() * 20)
+        self.assertGreater(len(store._packs), 2)
+
+        # Only the newest pack file can have a torn record, the others are kept as they are
+        with open(self.pack_path(1), 'ab') as f:
+            f.write(b'\xff' * 20)
+        size = os.path.getsize(self.pack_path(1))
+
+        store = self.reopen(store, pack_size=40)
+        self.assertEqual(os.path.getsize(self.pack_path(1)), size)
+        self.assertStored(store, {name: name.encode() * 20 for name in 'abcd'})
+
+    def test_compaction(self):
+        store = self.open(pack_size=100)
+        fragments = {}
+        for i in range(10):
+            fragments['f%d' % i] = b'%d' % i * 30
+            store.put('f%d' % i, fragments['f%d' % i])
+        first_pack = min(store._packs)
+        # Overwrite and delete most of the first pack files
+        for i in range(6):
+            if i % 2:
+                store.delete('f%d' % i)
+                del fragments['f%d' % i]
+            else:
+                fragments['f%d' % i] = b'new %d' % i
+                store.put('f%d' % i, fragments['f%d' % i])
+
+        store.compact()
+        self.assertNotIn(first_pack, store._packs)
+        self.assertFalse(os.path.exists(self.pack_path(first_pack)))
+        self.assertStored(store, fragments)
+        for i in (1, 3, 5):
+            self.assertIsNone(store.get('f%d' % i))
+
+        store = self.reopen(store, pack_size=100)
+        self.assertStored(store, fragments)
+        for i in (1, 3, 5):
+            self.assertFalse(store.contains('f%d' % i))
+
+    def test_compaction_drops_corrupt_records(self):
+        store = self.open(pack_size=100)
+        store.put('a', b'a' * 30)
+        store.put('b', b'b' * 30)
+        store.put('c', b'c' * 30)
+        store.put('d', b'd' * 30)
+        pack_id, offset, length = store._index['b']
+        self.assertEqual(store._index['c'][0], pack_id)
+        store.delete('a')
+        store.delete('c')
+        self.flip_byte(self.pack_path(pack_id), offset + length - 1)
+
+        store.compact()
+        self.assertNotIn(pack_id, store._packs)
+        self.assertFalse(store.contains('b'))
+        self.assertStored(store, {'d': b'd' * 30})
+
+        store = self.reopen(store, pack_size=100)
+        self.assertFalse(store.contains('b'))
+        self.assertStored(store, {'d': b'd' * 30})
+
+
+class MemoryStore:
+    """
+    A store in a dictionary. A read can be held until the test lets it finish.
+    """
+
+    def __init__(self):
+        self.fragments = {}
+        self.reads = 0
+        # Set by the test to hold the reads: the first event is set when a read started,
+        # the read returns when the test sets the second one
+        self.hold = None
+
+    def put(self, name, data):
+        self.fragments[name] = bytes(data)
+
+    def get(self, name):
+        self.reads += 1
+        data = self.fragments.get(name)
+        if self.hold is not None:
+            started, finish = self.hold
+            started.set()
+            finish.wait()
+        return data
+
+    def contains(self, name):
+        return name in self.fragments
+
+    def delete(self, name):
+        return self.fragments.pop(name, None) is not None
+
+
+class TestCachedChunkStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = MemoryStore()
+        # 640 bytes for the protected segment, fragments up to 100 bytes
+        self.cache = CachedChunkStore(self.store, budget=800)
+
+    def fragment(self, name, size=100):
+        data = name.encode() * size
+        self.store.put(name, data)
+        return data
+
+    def assertCached(self, name):
+        reads = self.store.reads
+        self.cache.get(name)
+        self.assertEqual(self.store.reads, reads, name)
+
+    def assertNotCached(self, name):
+        reads = self.store.reads
+        self.cache.get(name)
+        self.assertEqual(self.store.reads, reads + 1, name)
+
+    def test_hits_and_misses(self):
+        data = self.fragment('a')
+        self.assertEqual(self.cache.get('a'), data)
+        self.assertEqual(self.cache.get('a'), data)
+        self.assertIsNone(self.cache.get('missing'))
+        self.assertEqual(self.cache.stats(), (1, 2, 100))
+        self.assertEqual(self.store.reads, 2)
+
+    def test_large_fragment(self):
+        self.fragment('a', 101)
+        self.cache.get('a')
+        self.assertNotCached('a')
+        self.assertEqual(self.cache.stats(), (0, 2, 0))
+
+    def test_budget(self):
+        for name in 'abcdefghij':
+            self.fragment(name)
+            self.cache.get(name)
+        self.assertEqual(self.cache.stats()[2], 800)
+        # Least recently used first
+        self.assertNotCached('a')
+        self.assertNotCached('b')
+        self.assertCached('j')
+        self.assertEqual(self.cache.stats()[2], 800)
+
+    def test_promotion(self):
+        for name in 'ab':
+            self.fragment(name)
+            self.cache.get(name)
+        # Read again: protected
+        self.cache.get('a')
+        self.assertIn('a', self.cache._protected)
+        self.assertIn('b', self.cache._probation)
+
+        # Fragments that are read once do not push the protected one out
+        for name in 'cdefghijkl':
+            self.fragment(name)
+            self.cache.get(name)
+        self.assertCached('a')
+        self.assertNotCached('b')
+        self.assertEqual(self.cache.stats()[2], 800)
+
+    def test_protected_budget(self):
+        for name in 'abcdefgh':
+            self.fragment(name)
+            self.cache.get(name)
+            self.cache.get(name)
+        # The least recently used protected fragments are moved back to probation
+        self.assertEqual(list(self.cache._protected), list('cdefgh'))
+        self.assertEqual(list(self.cache._probation), list('ab'))
+        self.assertEqual(self.cache._protected_size, 600)
+
+        self.fragment('i')
+        self.cache.get('i')
+        self.assertNotCached('a')
+        self.assertCached('c')
+
+    def test_overwrite_and_delete(self):
+        self.fragment('a')
+        self.cache.get('a')
+        self.cache.put('a', b'new')
+        self.assertEqual(self.cache.get('a'), b'new')
+        self.assertEqual(self.cache.stats()[2], 3)
+
+        self.assertTrue(self.cache.delete('a'))
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.stats()[2], 0)
+
+    def load_while(self, change):
+        """
+        Read a fragment from the store, and call change while the read is in progress.
+
+        :return: What the read returned
+        """
+        self.fragment('a')
+        started, finish = threading.Event(), threading.Event()
+        self.store.hold = started, finish
+        loaded = []
+        reader = threading.Thread(target=lambda: loaded.append(self.cache.get('a')))
+        reader.start()
+        started.wait()
+        self.store.hold = None
+        change()
+        finish.set()
+        reader.join()
+        return loaded[0]
+
+    def test_delete_while_loading(self):
+        self.assertEqual(self.load_while(lambda: self.cache.delete('a')), b'a' * 100)
+        # The contents read before the delete are not cached
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.stats()[2], 0)
+
+    def test_overwrite_while_loading(self):
+        self.assertEqual(self.load_while(lambda: self.cache.put('a', b'new')), b'a' * 100)
+        self.assertEqual(self.cache.get('a'), b'new')
+        self.assertCached('a')
+        self.assertEqual(self.cache.get('a'), b'new')
+
+    def test_disabled(self):
+        cache = CachedChunkStore(self.store, budget=0)
+        self.fragment('a')
+        cache.get('a')
+        cache.get('a')
+        self.assertEqual(self.store.reads, 2)
+        self.assertEqual(cache.stats(), (0, 2, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
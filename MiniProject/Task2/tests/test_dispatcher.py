@@ -0,0 +1,104 @@
+import asyncio
+import os
+import sys
+import threading
+import unittest
+
+import zmq
+import zmq.asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import messages_pb2
+import reedsolomon
+import reedsolomon_async
+from dispatcher import ResponseDispatcher, AsyncResponseDispatcher
+
+NODES = 4
+STRIPES = 100
+
+
+class TestConcurrentUploads(unittest.TestCase):
+    """
+    Concurrent uploads send their fragments on one round-robin PUSH socket.
+    Every node must still get exactly one fragment of every stripe.
+    """
+
+    def setUp(self):
+        # Not terminated: the dispatcher thread keeps its socket open
+        self.context = zmq.Context()
+        self.fragment = [bytes(2), b'symbol data']
+
+    def connect_nodes(self, context, address):
+        nodes = []
+        for _ in range(NODES):
+            node = context.socket(zmq.PULL)
+            node.connect(address)
+            nodes.append(node)
+        return nodes
+
+    def check_placement(self, nodes, stripes):
+        node_of = {}
+        for i, node in enumerate(nodes):
+            while node.poll(100):
+                task = messages_pb2.storedata_request()
+                task.ParseFromString(node.recv_multipart()[0])
+                node_of[task.filename] = i
+            node.close()
+
+        self.assertEqual(len(node_of), len(stripes) * NODES)
+        for names in stripes:
+            self.assertEqual(sorted(node_of[name] for name in names), list(range(NODES)))
+
+    def test_threads(self):
+        push = self.context.socket(zmq.PUSH)
+        push.bind('inproc://fragments')
+        nodes = self.connect_nodes(self.context, 'inproc://fragments')
+        response_socket = self.context.socket(zmq.PULL)
+        response_socket.bind('inproc://responses')
+        dispatcher = ResponseDispatcher(response_socket)
+
+        stripes = []
+
+        def upload():
+            with dispatcher.open_channel() as responses:
+                for _ in range(STRIPES):
+                    fragments = reedsolomon.send_fragments([self.fragment] * NODES, push, responses)
+                    stripes.append([fragment['name'] for fragment in fragments])
+
+        threads = [threading.Thread(target=upload) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.check_placement(nodes, stripes)
+        push.close()
+
+    def test_asyncio(self):
+        # inproc sockets must share the context
+        context = zmq.asyncio.Context.shadow(self.context)
+        nodes = self.connect_nodes(self.context, 'inproc://async-fragments')
+        stripes = []
+
+        async def run():
+            push = context.socket(zmq.PUSH)
+            push.bind('inproc://async-fragments')
+            dispatcher = AsyncResponseDispatcher(context.socket(zmq.PULL))
+
+            async def upload():
+                with dispatcher.open_channel() as responses:
+                    for _ in range(STRIPES):
+                        fragments = await reedsolomon_async.send_fragments([self.fragment] * NODES, push, responses)
+                        stripes.append([fragment['name'] for fragment in fragments])
+                        await asyncio.sleep(0)
+
+            await asyncio.gather(*[upload() for _ in range(4)])
+            push.close()
+
+        asyncio.run(run())
+        self.check_placement(nodes, stripes)
+
+
+if __name__ == '__main__':
+    unittest.main()
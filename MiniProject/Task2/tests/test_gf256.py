@@ -0,0 +1,35 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gf256
+
+
+class TestCauchyRow(unittest.TestCase):
+
+    def test_last_row(self):
+        for symbols in (1, 4, 16, 128):
+            last = 255 - symbols
+            row = gf256.cauchy_row(last, symbols)
+            self.assertEqual(len(row), symbols)
+            self.assertNotIn(0, row)
+            with self.assertRaises(ValueError):
+                gf256.cauchy_row(last + 1, symbols)
+
+    def test_boundary_rows_decode(self):
+        # The last rows of the matrix are as invertible as the first ones
+        symbols = 4
+        rows = [gf256.cauchy_row(index, symbols) for index in range(255 - symbols - 3, 256 - symbols)]
+        inverse = gf256.invert_matrix(rows)
+        for i in range(symbols):
+            product = [0] * symbols
+            for j in range(symbols):
+                for k in range(symbols):
+                    product[j] ^= gf256.mul(rows[i][k], inverse[k][j])
+            self.assertEqual(product, [1 if i == j else 0 for j in range(symbols)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import group_commit
+
+
+class TestGroupCommit(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        # Every flush to disk, as (thread name, whether it flushed a directory)
+        self.syncs = []
+        self.real_fsync = os.fsync
+        self.real_syncfs = group_commit._syncfs
+
+    def record(self, sync):
+        def recorded(fd):
+            self.syncs.append((threading.current_thread().name, stat.S_ISDIR(os.fstat(fd).st_mode)))
+            sync(fd)
+        return recorded
+
+    def write_concurrently(self, committer, count):
+        # Start all writes at once, so they can share commits
+        barrier = threading.Barrier(count)
+
+        def write(i):
+            barrier.wait()
+            committer.write(os.path.join(self.folder, 'f%d' % i), [b'fragment ', b'%d' % i])
+
+        threads = [threading.Thread(target=write, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def check_files(self, count):
+        for i in range(count):
+            with open(os.path.join(self.folder, 'f%d' % i), 'rb') as f:
+                self.assertEqual(f.read(), b'fragment %d' % i)
+        self.assertFalse([name for name in os.listdir(self.folder) if name.endswith(group_commit.TEMP_SUFFIX)])
+
+    @unittest.skipIf(group_commit._syncfs is None, "syncfs is not available")
+    def test_one_sync_per_batch(self):
+        committer = group_commit.GroupCommitter(window=200)
+        with mock.patch('os.fsync', self.record(self.real_fsync)), \
+                mock.patch.object(group_commit, '_syncfs', self.record(self.real_syncfs)):
+            self.write_concurrently(committer, 32)
+
+        self.check_files(32)
+        self.assertLess(committer.commits, 16)
+        # The writers never flush, every commit flushes the file system and the directory once
+        self.assertEqual({name for name, _ in self.syncs}, {'group-commit'})
+        self.assertEqual(sum(1 for _, directory in self.syncs if not directory), committer.commits)
+        self.assertEqual(sum(1 for _, directory in self.syncs if directory), committer.commits)
+
+    def test_fsync_without_syncfs(self):
+        committer = group_commit.GroupCommitter(window=200)
+        with mock.patch('os.fsync', self.record(self.real_fsync)), \
+                mock.patch.object(group_commit, '_syncfs', None):
+            self.write_concurrently(committer, 32)
+
+        self.check_files(32)
+        self.assertLess(committer.commits, 16)
+        # The files are flushed by the commit thread, the directory once per commit
+        self.assertEqual({name for name, _ in self.syncs}, {'group-commit'})
+        self.assertEqual(sum(1 for _, directory in self.syncs if not directory), 32)
+        self.assertEqual(sum(1 for _, directory in self.syncs if directory), committer.commits)
+
+    def test_replace_existing_file(self):
+        committer = group_commit.GroupCommitter()
+        path = os.path.join(self.folder, 'f')
+        committer.write(path, b'old')
+        committer.write(path, b'new')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'new')
+
+    def test_commit_failure(self):
+        committer = group_commit.GroupCommitter(window=200)
+
+        def fail(batch):
+            raise RuntimeError("commit failed")
+
+        # The writes of the batch fail, and the commit thread keeps committing the later ones
+        with mock.patch.object(group_commit, '_sync_files', fail):
+            with self.assertRaisesRegex(RuntimeError, "commit failed"):
+                committer.write(os.path.join(self.folder, 'f0'), b'fragment 0')
+        self.assertEqual(os.listdir(self.folder), [])
+
+        self.write_concurrently(committer, 4)
+        self.check_files(4)
+
+    @unittest.skipIf(group_commit._syncfs is None, "syncfs is not available")
+    def test_fstat_failure(self):
+        committer = group_commit.GroupCommitter()
+        with mock.patch('os.fstat', side_effect=OSError("fstat failed")):
+            with self.assertRaisesRegex(OSError, "fstat failed"):
+                committer.write(os.path.join(self.folder, 'f0'), b'fragment 0')
+        self.assertEqual(os.listdir(self.folder), [])
+
+        committer.write(os.path.join(self.folder, 'f0'), b'fragment 0')
+        self.check_files(1)
+
+    def test_missing_folder(self):
+        committer = group_commit.GroupCommitter()
+        with self.assertRaises(OSError):
+            committer.write(os.path.join(self.folder, 'missing', 'f'), b'data')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from object_cache import ObjectCache
+
+
+class TestObjectCache(unittest.TestCase):
+
+    def request(self, cache, file_id, size):
+        # A download that found nothing in the cache
+        self.assertIsNone(cache.get(file_id))
+        return cache.admits(file_id, size)
+
+    def cache_file(self, cache, file_id, data):
+        self.request(cache, file_id, len(data))
+        cache.put(file_id, data, self.request(cache, file_id, len(data)))
+
+    def test_admission(self):
+        cache = ObjectCache(budget=1000, max_file=100)
+        # Files are only cached from their second request on
+        self.assertIsNone(self.request(cache, 1, 10))
+        ticket = self.request(cache, 1, 10)
+        self.assertIsNotNone(ticket)
+        self.assertIsNone(cache.get(2))
+        self.assertIsNone(cache.admits(2, 10))
+
+        cache.put(1, b'x' * 10, ticket)
+        self.assertEqual(cache.get(1), b'x' * 10)
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 3, "files": 1, "bytes": 10})
+
+    def test_concurrent_downloads_share_the_ticket(self):
+        cache = ObjectCache(budget=1000, max_file=100)
+        self.request(cache, 1, 10)
+        first = self.request(cache, 1, 10)
+        second = self.request(cache, 1, 10)
+        self.assertIs(first, second)
+
+        cache.put(1, b'first', first)
+        cache.put(1, b'again', second)
+        self.assertEqual(cache.get(1), b'first')
+
+    def test_history_limit(self):
+        cache = ObjectCache(budget=1000, max_file=100, history=2)
+        self.request(cache, 1, 10)
+        self.request(cache, 2, 10)
+        self.request(cache, 3, 10)
+        # The first request of file 1 is forgotten
+        self.assertIsNone(self.request(cache, 1, 10))
+
+    def test_max_file(self):
+        cache = ObjectCache(budget=1000, max_file=100)
+        self.request(cache, 1, 101)
+        self.assertIsNone(self.request(cache, 1, 101))
+        self.request(cache, 2, 100)
+        self.assertIsNotNone(self.request(cache, 2, 100))
+
+    def test_budget(self):
+        cache = ObjectCache(budget=100, max_file=50)
+        for file_id in range(1, 4):
+            self.cache_file(cache, file_id, bytes([file_id]) * 40)
+        # Least recently used first
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.stats()["bytes"], 80)
+
+        self.assertIsNotNone(cache.get(2))
+        self.cache_file(cache, 4, b'4' * 40)
+        self.assertIsNotNone(cache.get(2))
+        self.assertIsNone(cache.get(3))
+
+    def test_disabled(self):
+        cache = ObjectCache(budget=0)
+        self.request(cache, 1, 10)
+        self.assertIsNone(self.request(cache, 1, 10))
+
+    def test_fill(self):
+        cache = ObjectCache(budget=1000, max_file=100)
+        self.request(cache, 1, 10)
+        ticket = self.request(cache, 1, 10)
+        self.assertEqual(list(cache.fill(1, iter([bytearray(b'01234'), bytearray(b'56789')]), ticket)),
+                         [b'01234', b'56789'])
+        self.assertEqual(cache.get(1), b'0123456789')
+
+    def test_client_disconnects(self):
+        cache = ObjectCache(budget=1000, max_file=100)
+        self.request(cache, 1, 10)
+        stripes = cache.fill(1, iter([b'01234', b'56789']), self.request(cache, 1, 10))
+        next(stripes)
+        stripes.close()
+        self.assertIsNone(cache.get(1))
+
+    def test_invalidate(self):
+        cache = ObjectCache(budget=1000, max_file=100)
+        self.cache_file(cache, 1, b'data')
+        cache.invalidate(1)
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.stats()["bytes"], 0)
+
+    def test_invalidate_during_fill(self):
+        cache = ObjectCache(budget=1000, max_file=100)
+        self.request(cache, 1, 10)
+        stripes = cache.fill(1, iter([b'01234', b'56789']), self.request(cache, 1, 10))
+        next(stripes)
+
+        # The file is deleted while it is being sent, it must not come back into the cache
+        cache.invalidate(1)
+        self.assertEqual(list(stripes), [b'56789'])
+        self.assertIsNone(cache.get(1))
+
+        # A download that starts after the deletion is admitted again
+        ticket = cache.admits(1, 10)
+        self.assertIsNotNone(ticket)
+        cache.put(1, b'0123456789', ticket)
+        self.assertEqual(cache.get(1), b'0123456789')
+
+
+if __name__ == '__main__':
+    unittest.main()
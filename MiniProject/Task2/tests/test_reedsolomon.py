@@ -0,0 +1,141 @@
+import asyncio
+import collections
+import os
+import sys
+import unittest
+
+import zmq
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import messages_pb2
+import reedsolomon
+import reedsolomon_async
+from reedsolomon import NotEnoughFragmentsError
+
+
+class FakeChannel:
+    """
+    A response channel whose storage nodes answer GET DATA requests for the fragments they have.
+    """
+    request_id = 'test'
+
+    def __init__(self, fragments):
+        self._fragments = fragments
+        self._responses = collections.deque()
+
+    def send(self, socket, frames, copy=True):
+        task = messages_pb2.getdata_request()
+        task.ParseFromString(frames[1])
+        if task.filename in self._fragments:
+            self._responses.append([zmq.Frame(task.filename.encode('utf-8')),
+                                    zmq.Frame(self._fragments[task.filename])])
+
+    def poll(self, timeout=None):
+        return zmq.POLLIN if self._responses else 0
+
+    def recv_multipart(self, copy=True):
+        return self._responses.popleft()
+
+
+class AsyncFakeChannel(FakeChannel):
+
+    async def send(self, socket, frames, copy=True):
+        FakeChannel.send(self, socket, frames, copy)
+
+    async def poll(self, timeout=None):
+        return FakeChannel.poll(self, timeout)
+
+    async def recv_multipart(self, copy=True):
+        return FakeChannel.recv_multipart(self, copy)
+
+
+class FakeMembership:
+
+    def connected_nodes(self):
+        return ['node%d' % i for i in range(reedsolomon.STORAGE_NODES_NUM)]
+
+
+def store_stripe(data, max_erasures, systematic=False, available=None):
+    """
+    Encode a stripe, and keep the fragments with the given indexes as if they were stored on the nodes.
+
+    :return: The stripes of the file (see reedsolomon.get_stripes) and the stored fragments by name
+    """
+    encoded = reedsolomon.encode_file(bytearray(data), max_erasures, systematic, 4)
+    names = ['fragment%d' % i for i in range(len(encoded))]
+    if available is None:
+        available = range(len(encoded))
+    stored = {names[i]: b''.join(bytes(part) for part in encoded[i]) for i in available}
+    return [(names, len(data), [None] * len(names))], stored
+
+
+class TestDecodeWithMissingFragments(unittest.TestCase):
+
+    data = os.urandom(10000)
+
+    def read(self, max_erasures, available, systematic=False):
+        stripes, stored = store_stripe(self.data, max_erasures, systematic, available)
+        return b''.join(reedsolomon.iter_stripes(stripes, max_erasures, None, FakeChannel(stored),
+                                                 systematic=systematic))
+
+    def test_all_fragments(self):
+        self.assertEqual(self.read(1, range(4)), self.data)
+
+    def test_max_erasures_missing(self):
+        self.assertEqual(self.read(2, [1, 3]), self.data)
+        self.assertEqual(self.read(2, [2, 3], systematic=True), self.data)
+
+    def test_too_few_fragments(self):
+        with self.assertRaises(NotEnoughFragmentsError):
+            self.read(1, [0, 2])
+        with self.assertRaises(NotEnoughFragmentsError):
+            self.read(1, [0, 1], systematic=True)
+
+    def test_no_fragments(self):
+        with self.assertRaises(NotEnoughFragmentsError):
+            self.read(1, [])
+
+    def test_delegate_too_few_fragments(self):
+        stripes, stored = store_stripe(self.data, 1, available=[3])
+        result = reedsolomon.get_file_delegate(stripes[0][0], 1, len(self.data), None, FakeMembership(),
+                                               FakeChannel(stored), None)
+        self.assertIsInstance(result, str)
+
+    def test_async_too_few_fragments(self):
+        stripes, stored = store_stripe(self.data, 1, available=[1])
+
+        async def read():
+            return [stripe_data async for stripe_data in reedsolomon_async.iter_stripes(
+                stripes, 1, None, AsyncFakeChannel(stored))]
+
+        with self.assertRaises(NotEnoughFragmentsError):
+            asyncio.run(read())
+
+        stripes, stored = store_stripe(self.data, 1, available=[0, 1, 3])
+
+        async def read_all():
+            return b''.join([stripe_data async for stripe_data in reedsolomon_async.iter_stripes(
+                stripes, 1, None, AsyncFakeChannel(stored))])
+
+        self.assertEqual(asyncio.run(read_all()), self.data)
+
+
+class TestCodingParameters(unittest.TestCase):
+
+    def test_defaults(self):
+        self.assertEqual(reedsolomon.get_coding_parameters({}), (reedsolomon.STORAGE_NODES_NUM, 1, False))
+
+    def test_parameters(self):
+        self.assertEqual(reedsolomon.get_coding_parameters({'fragments': '3', 'max_erasures': '2',
+                                                            'systematic': 'true'}), (3, 2, True))
+
+    def test_invalid(self):
+        for payload in ({'fragments': '0'}, {'fragments': str(reedsolomon.STORAGE_NODES_NUM + 1)},
+                        {'fragments': '2', 'max_erasures': '2'}, {'max_erasures': '-1'}, {'fragments': 'x'}):
+            with self.assertRaises(ValueError, msg=payload):
+                reedsolomon.get_coding_parameters(payload)
+
+
+if __name__ == '__main__':
+    unittest.main()
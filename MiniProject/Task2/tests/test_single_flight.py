@@ -0,0 +1,285 @@
+import asyncio
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from single_flight import SingleFlight, AsyncSingleFlight
+
+STRIPES = [b'stripe %d ' % i for i in range(5)]
+
+
+class Download:
+    """
+    A fake download of STRIPES, which can fail after some of them.
+    """
+
+    def __init__(self, fail_after=None, gate=None):
+        self.fail_after = fail_after
+        # Set to let the download produce its next stripe
+        self.gate = gate
+        self.starts = 0
+        self.closes = 0
+        self.produced = 0
+
+    def stripes(self):
+        for i, stripe_data in enumerate(STRIPES):
+            if self.gate is not None:
+                self.gate.wait()
+            if i == self.fail_after:
+                raise IOError("node failed")
+            self.produced += 1
+            yield stripe_data
+
+    def start(self):
+        self.starts += 1
+        return self.stripes(), self.close
+
+    def close(self):
+        self.closes += 1
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_one_download(self):
+        flight = SingleFlight()
+        download = Download()
+        first = flight.stream('file', download.start)
+        second = flight.stream('file', download.start)
+        self.assertEqual(b''.join(first), b''.join(STRIPES))
+        self.assertEqual(b''.join(second), b''.join(STRIPES))
+        self.assertEqual(download.starts, 1)
+        self.assertEqual(download.produced, len(STRIPES))
+        self.assertEqual(download.closes, 1)
+
+    def test_slow_consumer(self):
+        flight = SingleFlight(window=20)
+        download = Download()
+        slow = flight.stream('file', download.start)
+        fast = flight.stream('file', download.start)
+
+        # The fast reader does not wait for the slow one
+        self.assertEqual(b''.join(fast), b''.join(STRIPES))
+        self.assertEqual(download.closes, 0)
+        # Past the window no one can join anymore, a new request starts its own download
+        third = flight.stream('file', download.start)
+        self.assertEqual(download.starts, 2)
+        self.assertEqual(b''.join(third), b''.join(STRIPES))
+
+        # The slow reader still gets every stripe
+        self.assertEqual(b''.join(slow), b''.join(STRIPES))
+        self.assertEqual(download.closes, 2)
+
+    def test_slow_consumer_threads(self):
+        flight = SingleFlight(window=20)
+        download = Download()
+        readers = [flight.stream('file', download.start) for _ in range(4)]
+        received = [None] * len(readers)
+
+        def read(i):
+            received[i] = b''.join(readers[i])
+
+        threads = [threading.Thread(target=read, args=(i,)) for i in range(len(readers))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(received, [b''.join(STRIPES)] * len(readers))
+        self.assertEqual(download.produced, len(STRIPES))
+
+    def test_leader_fails(self):
+        flight = SingleFlight()
+        download = Download(fail_after=2)
+        leader = flight.stream('file', download.start)
+        follower = flight.stream('file', download.start)
+
+        # Everyone gets the error, not a truncated file
+        received = []
+        with self.assertRaises(IOError):
+            for stripe_data in leader:
+                received.append(stripe_data)
+        self.assertEqual(received, STRIPES[:2])
+        with self.assertRaises(IOError):
+            list(follower)
+        self.assertEqual(download.closes, 1)
+
+    def test_leader_fails_while_follower_waits(self):
+        gate = threading.Event()
+        flight = SingleFlight()
+        download = Download(fail_after=0, gate=gate)
+        leader = flight.stream('file', download.start)
+        follower = flight.stream('file', download.start)
+        errors = []
+
+        def read(reader):
+            try:
+                list(reader)
+            except IOError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=read, args=(reader,)) for reader in (leader, follower)]
+        for thread in threads:
+            thread.start()
+        gate.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 2)
+
+    def test_late_joiner(self):
+        flight = SingleFlight()
+        download = Download()
+        self.assertEqual(b''.join(flight.stream('file', download.start)), b''.join(STRIPES))
+
+        # The finished download cannot be joined, the file is downloaded again
+        self.assertEqual(b''.join(flight.stream('file', download.start)), b''.join(STRIPES))
+        self.assertEqual(download.starts, 2)
+        self.assertEqual(download.closes, 2)
+
+    def test_all_clients_disconnect(self):
+        flight = SingleFlight()
+        download = Download()
+        readers = [flight.stream('file', download.start) for _ in range(2)]
+        for reader in readers:
+            next(reader)
+            reader.close()
+        self.assertEqual(download.produced, 1)
+        self.assertEqual(download.closes, 1)
+        self.assertEqual(download.starts, 1)
+
+        flight.stream('file', download.start)
+        self.assertEqual(download.starts, 2)
+
+    def test_start_fails(self):
+        flight = SingleFlight()
+        closes = []
+        self.assertEqual(flight.stream('file', lambda: ("Not enough nodes online", lambda: closes.append(1))),
+                         "Not enough nodes online")
+        self.assertEqual(closes, [1])
+
+    def coalesce(self, flight, fn):
+        """
+        Call do from three threads while the first call is blocked on a gate.
+
+        :return: What each thread returned or raised, and the number of calls of fn
+        """
+        gate = threading.Event()
+        calls = []
+
+        def call():
+            calls.append(1)
+            gate.wait()
+            return fn()
+
+        results = []
+
+        def caller():
+            try:
+                results.append(flight.do('file', call))
+            except IOError as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=caller) for _ in range(3)]
+        threads[0].start()
+        while not calls:
+            gate.wait(0.01)
+        for thread in threads[1:]:
+            thread.start()
+        # Let the followers wait for the leader
+        gate.wait(0.1)
+        gate.set()
+        for thread in threads:
+            thread.join()
+        return results, len(calls)
+
+    def test_do(self):
+        flight = SingleFlight()
+        self.assertEqual(self.coalesce(flight, lambda: b'file'), ([b'file'] * 3, 1))
+        # The finished call is not kept
+        self.assertEqual(flight.do('file', lambda: b'again'), b'again')
+
+    def test_do_fails(self):
+        flight = SingleFlight()
+
+        def fail():
+            raise IOError("node failed")
+
+        results, calls = self.coalesce(flight, fail)
+        self.assertEqual(calls, 1)
+        self.assertEqual([type(result) for result in results], [OSError] * 3)
+        self.assertEqual(flight.do('file', lambda: b'again'), b'again')
+
+
+class AsyncDownload(Download):
+
+    async def stripes(self):
+        for i, stripe_data in enumerate(STRIPES):
+            await asyncio.sleep(0)
+            if i == self.fail_after:
+                raise IOError("node failed")
+            self.produced += 1
+            yield stripe_data
+
+
+async def join_all(reader):
+    return b''.join([stripe_data async for stripe_data in reader])
+
+
+class TestAsyncSingleFlight(unittest.TestCase):
+
+    def test_concurrent_readers(self):
+        download = AsyncDownload()
+
+        async def run():
+            flight = AsyncSingleFlight(window=20)
+            readers = [flight.stream('file', download.start) for _ in range(3)]
+            return await asyncio.gather(*[join_all(reader) for reader in readers])
+
+        self.assertEqual(asyncio.run(run()), [b''.join(STRIPES)] * 3)
+        self.assertEqual(download.starts, 1)
+        self.assertEqual(download.produced, len(STRIPES))
+        self.assertEqual(download.closes, 1)
+
+    def test_leader_fails(self):
+        download = AsyncDownload(fail_after=3)
+
+        async def run():
+            flight = AsyncSingleFlight()
+            readers = [flight.stream('file', download.start) for _ in range(3)]
+            return await asyncio.gather(*[join_all(reader) for reader in readers], return_exceptions=True)
+
+        results = asyncio.run(run())
+        self.assertEqual([type(result) for result in results], [OSError] * 3)
+        self.assertEqual(download.closes, 1)
+
+    def test_late_joiner(self):
+        download = AsyncDownload()
+
+        async def run():
+            flight = AsyncSingleFlight()
+            first = await join_all(flight.stream('file', download.start))
+            return first, await join_all(flight.stream('file', download.start))
+
+        self.assertEqual(asyncio.run(run()), (b''.join(STRIPES), b''.join(STRIPES)))
+        self.assertEqual(download.starts, 2)
+
+    def test_do(self):
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return b'file'
+
+        async def run():
+            flight = AsyncSingleFlight()
+            return await asyncio.gather(*[flight.do('file', fetch) for _ in range(3)])
+
+        self.assertEqual(asyncio.run(run()), [b'file'] * 3)
+        self.assertEqual(len(calls), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import os
+import sys
+import threading
+import unittest
+from multiprocessing import shared_memory
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rs_coding
+import stripe_pool
+
+
+def failing_coder(data, *args):
+    # Fail while holding a view of the stripe, like the coder does
+    view = memoryview(data if not isinstance(data, list) else data[0]['data'])
+    raise ValueError("coding failed on %d bytes" % len(view))
+
+
+class TestWorkers(unittest.TestCase):
+
+    def setUp(self):
+        self.shm = shared_memory.SharedMemory(create=True, size=64 * 1024)
+        self.addCleanup(self.shm.unlink)
+        self.addCleanup(self.shm.close)
+
+    def test_encode(self):
+        data = os.urandom(10000)
+        self.shm.buf[:len(data)] = data
+        stripe_pool._encode_worker(self.shm.name, len(data), 1, False, 4)
+
+        expected = b''.join(bytes(part) for fragment in rs_coding.encode_file(bytearray(data), 1, False, 4)
+                            for part in fragment)
+        self.assertEqual(bytes(self.shm.buf[len(data):len(data) + len(expected)]), expected)
+
+    def test_encode_error(self):
+        with mock.patch.object(rs_coding, 'encode_file', failing_coder):
+            with self.assertRaisesRegex(ValueError, "coding failed"):
+                stripe_pool._encode_worker(self.shm.name, 10000, 1, False, 4)
+
+    def test_decode_error(self):
+        with mock.patch.object(rs_coding, 'decode_file', failing_coder):
+            with self.assertRaisesRegex(ValueError, "coding failed"):
+                stripe_pool._decode_worker(self.shm.name, 3, 1000, 1)
+
+
+class TestInlineCoding(unittest.TestCase):
+    """
+    Stripes that are not sent to the worker pool (it is not started in the tests).
+    """
+
+    def coded_on(self, name):
+        # Records the thread the coder runs on
+        real = getattr(rs_coding, name)
+        threads = []
+
+        def coder(*args):
+            threads.append(threading.current_thread())
+            return real(*args)
+
+        return mock.patch.object(rs_coding, name, coder), threads
+
+    def test_blocking(self):
+        patch, threads = self.coded_on('encode_file')
+        with patch:
+            stripe_pool.submit_encode(bytearray(os.urandom(1000)), 1).result()
+        self.assertEqual(threads, [threading.current_thread()])
+
+    def test_not_blocking(self):
+        data = os.urandom(1000)
+        patch, threads = self.coded_on('encode_file')
+        with patch:
+            fragments = stripe_pool.submit_encode(bytearray(data), 1, blocking=False).result()
+        self.assertEqual(len(threads), 1)
+        self.assertNotIn(threading.current_thread(), threads)
+
+        symbols = [{"chunkname": "", "data": b''.join(bytes(part) for part in fragment)} for fragment in fragments[1:]]
+        patch, threads = self.coded_on('decode_file')
+        with patch:
+            decoded = stripe_pool.submit_decode(symbols, 1, blocking=False).result()
+        self.assertEqual(len(threads), 1)
+        self.assertNotIn(threading.current_thread(), threads)
+        self.assertEqual(bytes(decoded[:len(data)]), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
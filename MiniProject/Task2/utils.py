@@ -1,13 +1,24 @@
+import mmap
+import os
 import random
 import string
 import platform
+from datetime import datetime, timezone
 
 import messages_pb2
 import zmq
 import logging
 
-node_ips = ['192.168.0.10' + i for i in ["1", "2", "3", "4"]]
-node_names_for_docker = ['node' + i for i in ["1", "2", "3", "4"]]
+from group_commit import GroupCommitter
+
+# The number of storage nodes in the cluster, 4 unless configured otherwise
+STORAGE_NODES_NUM = int(os.environ.get('STORAGE_NODES_NUM', 4))
+
+# Files at least this large are memory-mapped when they are read (see load_file)
+MMAP_THRESHOLD = int(os.environ.get('MMAP_THRESHOLD', zmq.COPY_THRESHOLD))
+
+node_ips = ['192.168.0.%d' % (100 + i) for i in range(1, STORAGE_NODES_NUM + 1)]
+node_names_for_docker = ['node%d' % i for i in range(1, STORAGE_NODES_NUM + 1)]
 
 
 def random_string(length=8):
@@ -21,11 +32,17 @@ def random_string(length=8):
     return ''.join([random.SystemRandom().choice(string.ascii_letters + string.digits) for n in range(length)])
 
 
+# Flushes the written files to disk in batches
+committer = GroupCommitter()
+
+
 def write_file(data, filename=None):
     """
-    Write the given data to a local file with the given filename
+    Write the given data to a local file with the given filename.
+    Returns once the file is durably stored.
 
-    :param data: A bytes object that stores the file contents
+    :param data: A bytes-like object that stores the file contents, or a list of them
+                 (e.g. the buffers of received ZMQ frames) that are written one after the other
     :param filename: The file name. If not given, a random string is generated
     :return: The file name of the newly written file, or None if there was an error
     """
@@ -36,11 +53,9 @@ def write_file(data, filename=None):
         filename += ".bin"
 
     try:
-        # Open filename for writing binary content ('wb')
-        # note: when a file is opened using the 'with' statment, 
-        # it is closed automatically when the scope ends
-        with open('./' + filename, 'wb') as f:
-            f.write(data)
+        # The file is written to a temporary file first and renamed once it is on disk,
+        # so it is either complete or missing after a crash (see group_commit.py)
+        committer.write('./' + filename, data)
     except EnvironmentError as e:
         print("Error writing file: {}".format(e))
         return None
@@ -48,21 +63,42 @@ def write_file(data, filename=None):
     return filename
 
 
-def get_connected_nodes(heartbeat_request_socket, response_socket, n_nodes):
-    connected_nodes_ip = []
+def map_file(fd, offset, length):
+    """
+    Memory-map a part of an open file.
+
+    :param fd: The file descriptor, the mapping stays valid after it is closed
+    :param offset: The offset of the part
+    :param length: The length of the part, at least 1
+    :return: A memoryview of the mapped part
+    """
+    # Mappings must start at a multiple of the allocation granularity
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    mapped = mmap.mmap(fd, offset + length - start, offset=start, access=mmap.ACCESS_READ)
+    return memoryview(mapped)[offset - start:]
 
-    task = messages_pb2.heartbeat_request()
-    heartbeat_request_socket.send_multipart([b"all_nodes", task.SerializeToString()])
 
-    # Check to see which nodes are alive
-    for i in range(n_nodes):
-        if (response_socket.poll(500) & zmq.POLLIN) != 0:
-            msg = response_socket.recv()
-            response = messages_pb2.heartbeat_response()
-            response.ParseFromString(msg)
-            connected_nodes_ip.append(response.node_ip)
+def load_file(path, offset=0, length=None):
+    """
+    Read a file, or a part of it. Large parts are memory-mapped instead of read into a new
+    bytes object, so they can be sent as zero-copy ZMQ frames: ZMQ keeps a reference to the
+    mapping until the frame is sent, and it is unmapped once the last reference is gone.
+
+    :param path: The path of the file
+    :param offset: The offset to start reading from
+    :param length: The number of bytes to read, or None to read until the end of the file
+    :return: A bytes-like object with the contents
+    :raises FileNotFoundError: If the file does not exist
+    """
+    with open(path, 'rb') as in_file:
+        size = os.fstat(in_file.fileno()).st_size
+        length = max(min(size - offset, length if length is not None else size), 0)
 
-    return connected_nodes_ip
+        # pyzmq copies small frames anyway, and mapping them is slower than reading them
+        if length < MMAP_THRESHOLD:
+            in_file.seek(offset)
+            return in_file.read(length)
+        return map_file(in_file.fileno(), offset, length)
 
 
 def is_raspberry_pi():
@@ -92,3 +128,57 @@ def get_k_node_ips(k: int):
         return random.sample(node_names_for_docker, k)
     else:
         return random.sample(node_ips, k)
+
+
+def get_file_validators(f):
+    """
+    Returns the ETag and the Last-Modified date of a stored file. Stored files are
+    never modified, so both are derived from the file record.
+
+    :param f: The file record from the database, as a dictionary
+    :return: The (unquoted) entity tag and the last modification time
+    """
+    last_modified = datetime.strptime(f['created'], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+    etag = "%d-%d-%d" % (f['id'], f['size'], last_modified.timestamp())
+    return etag, last_modified
+
+
+def get_requested_range(request, size, etag, last_modified):
+    """
+    Evaluates the Range and If-Range headers of a download request.
+    Only single byte ranges are supported, anything else is answered with the whole file.
+
+    :param request: The Flask request
+    :param size: The size of the requested file
+    :param etag: The current entity tag of the file
+    :param last_modified: The last modification time of the file
+    :return: A (start, stop) tuple for a partial response, None if the whole file
+             should be sent, or False if the range cannot be satisfied
+    """
+    byte_range = request.range
+    if byte_range is None or byte_range.units != 'bytes' or len(byte_range.ranges) != 1:
+        return None
+
+    # If-Range: only send a part if the client's copy is still current (strong comparison)
+    if 'If-Range' in request.headers:
+        if request.headers['If-Range'].startswith('W/'):
+            return None
+        if_range = request.if_range
+        if if_range.etag is not None and if_range.etag != etag:
+            return None
+        if if_range.etag is None and if_range.date != last_modified:
+            return None
+
+    start, stop = byte_range.ranges[0]
+    if stop is None:
+        if start < 0:
+            # Suffix range, e.g. the last 500 bytes
+            start = max(size + start, 0)
+        stop = size
+    else:
+        stop = min(stop, size)
+
+    if start >= stop:
+        return False
+
+    return start, stop